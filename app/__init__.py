@@ -2,7 +2,7 @@ import os
 
 from flask import Flask
 
-from app import db
+from app import cache, db, metrics
 from app.api import bp as api_bp
 
 
@@ -20,6 +20,8 @@ def create_app(test_config=None):
         app.config.from_mapping(test_config)
 
     db.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
 
     app.register_blueprint(api_bp)
 
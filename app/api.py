@@ -1,20 +1,62 @@
-from flask import Blueprint, request, abort, jsonify, url_for, make_response
+from flask import (
+    Blueprint, request, abort, jsonify, url_for, make_response, current_app, json, stream_with_context
+)
 
-from app.models import Node
+from app import formats
+from app.bulk import rows_from_tree, rows_from_ndjson
+from app.cache import get_subtree_cache
+from app.changes import get_changes, get_changes_version
+from app.db import get_pool, get_replica_pools, atomic, TransactionConflict
+from app.metrics import serialization_timer, render_metrics
+from app.models import Node, BulkError
+from app.replica import get_replica
 
 
 bp = Blueprint('api', __name__)
 
+# limit of ids in GET /items
+MAX_BATCH_ITEMS = 1000
+# page sizes of GET /item/<id>/children, /subtree and /hierarchy
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+# `since` of GET /changes which brings a copy of a /hierarchy or /subtree response up to date
+CHANGES_VERSION_HEADER = 'X-Changes-Version'
+
 
 def api_message(status, message):
     return make_response(jsonify(message=message)), status
 
 
+def get_int_arg(name, default=None, minimum=0, maximum=None):
+    """Integer query parameter, ValueError if it is not a number within the bounds."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    value = int(value)
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(name)
+    return value
+
+
+def json_response(*args, **kwargs):
+    """jsonify counting its time as serialization in request metrics."""
+    with serialization_timer():
+        return jsonify(*args, **kwargs)
+
+
 @bp.errorhandler(404)
 def not_found_error(e):
     return api_message(404, 'Not found')
 
 
+@bp.errorhandler(TransactionConflict)
+def transaction_conflict_error(e):
+    response, status = api_message(503, str(e))
+    response.headers['Retry-After'] = '1'
+    return response, status
+
+
 @bp.route('/item', methods=('POST',))
 def item():
     data = request.get_json()
@@ -40,8 +82,143 @@ def item():
     return '', 201, {'Location': url_for('.item_by_id', item_id=node.id)}
 
 
-@bp.route('/item/<int:item_id>', methods=('GET', 'POST', 'DELETE'))
-def item_by_id(item_id):
+@bp.route('/items', methods=('GET',))
+def items():
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',') if id]
+    except ValueError:
+        return api_message(400, 'Invalid "ids"')
+    if len(ids) > MAX_BATCH_ITEMS:
+        return api_message(400, f'At most {MAX_BATCH_ITEMS} "ids" allowed')
+
+    # disallow direct access to the root node
+    nodes = Node.get_by_ids([id for id in ids if id != Node.get_root_id()])
+    return json_response(items=Node.to_items(nodes))
+
+
+class OperationError(Exception):
+    def __init__(self, index, status, message):
+        super().__init__(message)
+        self.index = index
+        self.status = status
+        self.message = message
+
+
+@bp.route('/batch', methods=('POST',))
+def batch():
+    operations = request.get_json()
+    if not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations):
+        return api_message(400, 'List of operations required')
+
+    try:
+        results = apply_operations(operations)
+    except OperationError as e:
+        return make_response(jsonify(message=e.message, index=e.index)), e.status
+    return json_response(results=results)
+
+
+@atomic
+def apply_operations(operations):
+    """
+    Apply create/rename/move/delete operations in one transaction.
+    Consecutive creates under the same parent are inserted at once, so the parent's interval is opened once.
+    """
+    results = []
+    i = 0
+    while i < len(operations):
+        op = operations[i]
+        try:
+            if op.get('op') == 'create':
+                j = i + 1
+                while j < len(operations) and operations[j].get('op') == 'create' \
+                        and 'parent_id' in operations[j] and operations[j]['parent_id'] == op.get('parent_id'):
+                    j += 1
+                results += create_items(operations[i:j], i)
+                i = j
+                continue
+            elif op.get('op') == 'rename':
+                if 'name' not in op:
+                    raise OperationError(i, 400, '"name" required')
+                node = get_operation_node(op, i)
+                results.append(node.rename(op['name']).to_item() if op['name'] != node.name else node.to_item())
+            elif op.get('op') == 'move':
+                node = get_operation_node(op, i)
+                parent_node = get_operation_parent(op, i)
+                if parent_node.id != node.parent_id:
+                    node = node.move(parent_node)
+                results.append(node.to_item())
+            elif op.get('op') == 'delete':
+                get_operation_node(op, i).delete()
+                results.append(None)
+            else:
+                raise OperationError(i, 400, 'Unknown "op"')
+        except ValueError as e:
+            raise OperationError(i, 400, str(e))
+        i += 1
+    return results
+
+
+def create_items(operations, index):
+    if any('name' not in op for op in operations):
+        raise OperationError(index, 400, '"name" required')
+    parent_node = get_operation_parent(operations[0], index)
+    try:
+        ids = Node.bulk_create([(op['name'], None) for op in operations], parent_node)
+    except BulkError as e:
+        raise OperationError(index + e.errors[0]['row'], 400, e.errors[0]['message'])
+    return Node.to_items(Node.get_by_ids(ids))
+
+
+def get_operation_node(op, index):
+    # operations see the primary as changed by the previous ones, not the replica
+    node = Node.get_by_id(op['id'], replica=False) if isinstance(op.get('id'), int) else None
+    # disallow direct access to the root node
+    if node is None or node.is_root:
+        raise OperationError(index, 404, 'Item not found')
+    return node
+
+
+def get_operation_parent(op, index):
+    if 'parent_id' not in op:
+        raise OperationError(index, 400, '"parent_id" required')
+    parent_id = op['parent_id']
+    if parent_id is None:
+        parent_id = Node.get_root_id()
+    parent_node = Node.get_by_id(parent_id, replica=False) if isinstance(parent_id, int) else None
+    if parent_node is None:
+        raise OperationError(index, 400, 'Invalid "parent_id"')
+    return parent_node
+
+
+@bp.route('/bulk', methods=('POST',))
+def bulk():
+    parent_id = request.args.get('parent_id', type=int)
+    if parent_id is None:
+        parent_id = Node.get_root_id()
+
+    parent_node = Node.get_by_id(parent_id)
+    if parent_node is None:
+        return api_message(400, 'Invalid "parent_id"')
+
+    if request.mimetype == 'application/x-ndjson':
+        rows, errors = rows_from_ndjson(request.stream)
+    else:
+        rows, errors = rows_from_tree(request.get_json())
+
+    if not errors:
+        try:
+            ids = Node.bulk_create(rows, parent_node)
+        except BulkError as e:
+            errors = e.errors
+        except ValueError as e:
+            return api_message(400, str(e))
+
+    if errors:
+        return make_response(jsonify(message='Invalid items', errors=errors)), 400
+    return json_response(ids=ids), 201
+
+
+def get_item_node(item_id):
     # disallow direct access to the root node
     if item_id == Node.get_root_id():
         abort(404)
@@ -49,9 +226,15 @@ def item_by_id(item_id):
     node = Node.get_by_id(item_id)
     if node is None:
         abort(404)
+    return node
+
+
+@bp.route('/item/<int:item_id>', methods=('GET', 'POST', 'DELETE'))
+def item_by_id(item_id):
+    node = get_item_node(item_id)
 
     if request.method == 'GET':
-        return jsonify(node.to_item())
+        return json_response(node.to_item())
     
     if request.method == 'DELETE':
         node.delete()
@@ -60,7 +243,8 @@ def item_by_id(item_id):
     if request.method == 'POST':
         data = request.get_json()
 
-        node = Node.get_by_id(item_id)
+        # a lagging replica would make a change look like a no-op
+        node = Node.get_by_id(item_id, replica=False)
         if node is None:
             return api_message(404, 'Item not found')
     
@@ -76,7 +260,7 @@ def item_by_id(item_id):
                 parent_id = Node.get_root_id()
 
             if parent_id != node.parent_id:
-                parent_node = Node.get_by_id(parent_id)
+                parent_node = Node.get_by_id(parent_id, replica=False)
                 if parent_node is None:
                     return api_message(404, 'Parent item not found')
 
@@ -84,22 +268,242 @@ def item_by_id(item_id):
                     node = node.move(parent_node)
                 except ValueError as e:
                     return api_message(400, str(e))
-        return jsonify(node.to_item())
+        return json_response(node.to_item())
+
+
+@bp.route('/item/<int:item_id>/copy', methods=('POST',))
+def item_copy(item_id):
+    """Copy the item with its subtree under "parent_id", "on_conflict" is "error" or "rename"."""
+    node = get_item_node(item_id)
+    data = request.get_json()
+    if 'parent_id' not in data:
+        return api_message(400, '"parent_id" required')
+
+    parent_id = data['parent_id']
+    if parent_id is None:
+        parent_id = Node.get_root_id()
+
+    parent_node = Node.get_by_id(parent_id)
+    if parent_node is None:
+        return api_message(400, 'Invalid "parent_id"')
+
+    try:
+        copy = node.copy(parent_node, data.get('on_conflict', 'error'))
+    except ValueError as e:
+        return api_message(400, str(e))
+
+    return json_response(copy.to_item()), 201, {'Location': url_for('.item_by_id', item_id=copy.id)}
+
+
+@bp.route('/item/<int:item_id>/path', methods=('GET',))
+def item_path(item_id):
+    node = get_item_node(item_id)
+    return json_response(items=[ancestor._item() for ancestor in node.get_path()])
+
+
+@bp.route('/item/<int:item_id>/children', methods=('GET',))
+def item_children(item_id):
+    node = get_item_node(item_id)
+
+    try:
+        limit = get_int_arg('limit', DEFAULT_PAGE_LIMIT, 1, MAX_PAGE_LIMIT)
+    except ValueError:
+        return api_message(400, f'"limit" should be between 1 and {MAX_PAGE_LIMIT}')
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            return api_message(400, 'Invalid "after"')
+
+    # one extra row tells whether there is a next page
+    children = node.get_children(limit + 1, after)
+    next_token = str(children[limit - 1].lft) if len(children) > limit else None
+    return json_response(items=Node.to_items(children[:limit]), next=next_token)
+
+
+@bp.route('/search', methods=('GET',))
+def search():
+    """
+    Items with names containing ?q= (starting with it if ?prefix=1) ignoring case, optionally within
+    the tree of the top-level item ?tree_id=. Each item has "path" of its ancestors from the top of the tree.
+    """
+    query = request.args.get('q', '')
+    if query == '':
+        return api_message(400, '"q" required')
+    try:
+        limit = get_int_arg('limit', DEFAULT_PAGE_LIMIT, 1, MAX_PAGE_LIMIT)
+    except ValueError:
+        return api_message(400, f'"limit" should be between 1 and {MAX_PAGE_LIMIT}')
+    try:
+        tree_id = get_int_arg('tree_id', None, 1)
+    except ValueError:
+        return api_message(400, 'Invalid "tree_id"')
+    try:
+        prefix = bool(get_int_arg('prefix', 0, 0, 1))
+    except ValueError:
+        return api_message(400, '"prefix" should be 0 or 1')
+    after = request.args.get('after')
+    if after is not None:
+        # the id of the last match and its search key, which may contain dots itself
+        id, _, key = after.partition('.')
+        try:
+            after = key, int(id)
+        except ValueError:
+            return api_message(400, 'Invalid "after"')
+
+    # one extra match tells whether there is a next page
+    matches = Node.search(query, limit + 1, tree_id, prefix, after)
+    next_token = None
+    if len(matches) > limit:
+        last = matches[limit - 1][0]
+        next_token = f'{last.id}.{Node.get_search_key(last.name)}'
+    # depth is the length of the path, counting ancestors by bounds would scan the trees again
+    items = [
+        {**node._item(), 'path': [ancestor._item() for ancestor in ancestors]} for node, ancestors in matches[:limit]
+    ]
+    return json_response(items=items, next=next_token)
+
+
+def encode_page_token(state):
+    tree_id, lft, rgts = state
+    return '.'.join(map(str, [tree_id, lft, *rgts]))
+
+
+def decode_page_token(node, token):
+    """Page state of Node.get_subtree_page, ValueError if the token is not one of the node's subtree."""
+    tree_id, lft, *rgts = map(int, token.split('.'))
+    if not node.has_position(tree_id, lft):
+        raise ValueError(token)
+    return tree_id, lft, rgts
+
+
+def subtree_response(node, children_only=False):
+    """
+    Serialized subtree of the node served from the cache or streamed if STREAM_SUBTREES is set.
+    ETag is the version of the tree and the query, so clients can revalidate without downloading it again.
+    ?depth limits levels below the node, ?limit and ?after return flat pages in tree order instead.
+    Accept chooses between nested JSON (the default) and flat columns of app.formats.
+    """
+    try:
+        max_depth = get_int_arg('depth')
+    except ValueError:
+        return api_message(400, '"depth" should be a non-negative number')
+    try:
+        limit = get_int_arg('limit', DEFAULT_PAGE_LIMIT, 1, MAX_PAGE_LIMIT)
+    except ValueError:
+        return api_message(400, f'"limit" should be between 1 and {MAX_PAGE_LIMIT}')
+    paginate = 'limit' in request.args or 'after' in request.args
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = decode_page_token(node, after)
+        except ValueError:
+            return api_message(400, 'Invalid "after"')
+
+    # pages are always JSON items
+    mimetype = formats.JSON if paginate else request.accept_mimetypes.best_match(formats.MIMETYPES, formats.JSON)
+
+    # before the version, so changes after it cover everything the response lacks
+    changes_version = get_changes_version()
+    version = node.get_version()
+    etag = f'{node.id}.{version}'
+    # responses to other queries of the subtree differ, like keys of the cache
+    if max_depth is not None:
+        etag += f'.depth{max_depth}'
+    if paginate:
+        etag += f'.limit{limit}' + (f'.after{encode_page_token(after)}' if after is not None else '')
+    etag += formats.ETAG_SUFFIXES[mimetype]
+
+    def set_headers(response):
+        response.set_etag(etag)
+        response.headers[CHANGES_VERSION_HEADER] = str(changes_version)
+        response.vary.add('Accept')
+        return response
+
+    if request.if_none_match.contains(etag):
+        return set_headers(make_response('', 304))
+
+    if paginate:
+        items, state = node.get_subtree_page(limit, after, max_depth)
+        return set_headers(json_response(items=items, next=state and encode_page_token(state)))
+
+    if mimetype == formats.JSON and current_app.config.get('STREAM_SUBTREES', False):
+        return set_headers(current_app.response_class(
+            stream_with_context(node.stream_subtree(children_only, max_depth)), mimetype=mimetype
+        ))
+
+    cache = get_subtree_cache()
+    key = (node.id, max_depth, mimetype)
+    body = cache.get(key, version)
+    if body is None:
+        if mimetype == formats.JSON:
+            subtree = node.get_subtree(max_depth, version)
+            with serialization_timer():
+                body = json.dumps(subtree['children'] if children_only else subtree).encode()
+        else:
+            # columns of /hierarchy have no root item either
+            columns = node.get_subtree_columns(max_depth, version)
+            with serialization_timer():
+                body = formats.ENCODERS[mimetype](columns)
+        # the tree could change while the subtree was being read
+        if node.get_version() == version:
+            cache.set(key, version, body)
+
+    return set_headers(current_app.response_class(body, mimetype=mimetype))
 
 
 @bp.route('/hierarchy', methods=('GET',))
 def hierarchy():
-    return jsonify(Node.get_by_id(Node.get_root_id()).get_subtree()['children'])
+    return subtree_response(Node.get_root_node(), children_only=True)
 
 
 @bp.route('/subtree/<int:root_item_id>', methods=('GET',))
 def subtree(root_item_id):
-    # disallow direct access to the root node
-    if root_item_id == Node.get_root_id():
-        abort(404)
+    return subtree_response(get_item_node(root_item_id))
 
-    node = Node.get_by_id(root_item_id)
-    if node is None:
-        abort(404)
-        
-    return jsonify(node.get_subtree())
+
+@bp.route('/changes', methods=('GET',))
+def changes():
+    """
+    Changes after ?since= in the order they were made, for clients mirroring the hierarchy.
+    410 means some of them are no longer kept and the hierarchy should be reloaded.
+    """
+    try:
+        since = get_int_arg('since', 0)
+    except ValueError:
+        return api_message(400, '"since" should be a non-negative number')
+    try:
+        limit = get_int_arg('limit', DEFAULT_PAGE_LIMIT, 1, MAX_PAGE_LIMIT)
+    except ValueError:
+        return api_message(400, f'"limit" should be between 1 and {MAX_PAGE_LIMIT}')
+
+    res = get_changes(since, limit)
+    if res is None:
+        return api_message(410, f'Changes since {since} are not kept, reload the hierarchy')
+    items, more = res
+    return json_response(items=items, next=items[-1]['version'] if items else since, more=more)
+
+
+@bp.route('/metrics/pool', methods=('GET',))
+def pool_metrics():
+    return json_response(get_pool().get_stats())
+
+
+@bp.route('/metrics/cache', methods=('GET',))
+def cache_metrics():
+    return json_response(get_subtree_cache().get_stats())
+
+
+@bp.route('/metrics', methods=('GET',))
+def metrics():
+    gauges = {f'db_pool_{name}': value for name, value in get_pool().get_stats().items()}
+    for pool in get_replica_pools():
+        for name, value in pool.get_stats().items():
+            gauges[f'db_replica_pool_{name}'] = gauges.get(f'db_replica_pool_{name}', 0) + value
+    gauges.update({f'subtree_cache_{name}': value for name, value in get_subtree_cache().get_stats().items()})
+    gauges.update({f'tree_gap_{name}': value for name, value in Node.get_gap_stats().items()})
+    replica = get_replica()
+    if replica is not None:
+        gauges.update({f'replica_{name}': value for name, value in replica.get_stats().items()})
+    return current_app.response_class(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
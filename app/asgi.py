@@ -0,0 +1,23 @@
+"""
+ASGI entry point serving the same app, e.g. with uvicorn workers of gunicorn:
+
+    gunicorn --bind=0.0.0.0:8000 --workers=2 -k uvicorn.workers.UvicornWorker "app.asgi:create_asgi_app()"
+
+This is uvicorn's WSGI middleware around the synchronous app, not an async driver: the event loop
+holds client connections, and requests run on ASGI_THREADS threads with connections from the
+worker's ConnectionPool, so as many requests run at a time as there are threads. gunicorn's gthread
+workers (see the Dockerfile) give the same concurrency without the event loop.
+"""
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from app import create_app
+
+
+def wrap_wsgi_app(wsgi_app, config):
+    """ASGI app running wsgi_app on ASGI_THREADS threads, a request holds a pooled connection while it runs."""
+    return WSGIMiddleware(wsgi_app, workers=config.get('ASGI_THREADS', config.get('POSTGRES_POOL_SIZE', 10)))
+
+
+def create_asgi_app(test_config=None):
+    app = create_app(test_config)
+    return wrap_wsgi_app(app, app.config)
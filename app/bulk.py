@@ -0,0 +1,71 @@
+"""
+Parsing of trees imported with POST /bulk and `flask import-tree`.
+Both formats are flattened into (name, parent_row) rows for Node.bulk_create,
+where parent_row is an index of a previous row or None for top-level items.
+"""
+import json
+
+
+def error(row, message):
+    return {'row': row, 'message': message}
+
+
+def rows_from_tree(items):
+    """Rows in preorder from nested items: [{"name": ..., "children": [...]}, ...]."""
+    if not isinstance(items, list):
+        return [], [error(None, 'List of items required')]
+
+    rows, errors = [], []
+    stack = [(item, None) for item in reversed(items)]
+    while stack:
+        item, parent_row = stack.pop()
+        row = len(rows)
+        if not isinstance(item, dict) or not isinstance(item.get('name'), str):
+            errors.append(error(row, '"name" required'))
+            rows.append((None, parent_row))
+            continue
+        rows.append((item['name'], parent_row))
+
+        children = item.get('children', [])
+        if not isinstance(children, list):
+            errors.append(error(row, '"children" should be a list'))
+            continue
+        stack.extend((child, row) for child in reversed(children))
+    return rows, errors
+
+
+def rows_from_ndjson(lines):
+    """
+    Rows from lines of {"name": ..., "parent": ...} objects, where "parent" is the name
+    of one of the previous items or null for top-level items. Lines are str or UTF-8 bytes,
+    empty lines are skipped.
+    """
+    rows, errors = [], []
+    # the latest row with the name
+    rows_by_name = {}
+    for line in lines:
+        if not line.strip():
+            continue
+        row = len(rows)
+        if isinstance(line, bytes):
+            try:
+                line = line.decode()
+            except UnicodeDecodeError:
+                errors.append(error(row, 'Invalid UTF-8'))
+                rows.append((None, None))
+                continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get('name'), str):
+            errors.append(error(row, '"name" required'))
+            rows.append((None, None))
+            continue
+
+        parent = data.get('parent')
+        if parent is not None and parent not in rows_by_name:
+            errors.append(error(row, 'Invalid "parent"'))
+        rows.append((data['name'], rows_by_name.get(parent)))
+        rows_by_name[data['name']] = row
+    return rows, errors
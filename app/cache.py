@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class SubtreeCache:
+    """
+    LRU cache of serialized subtrees keyed by node id, depth limit and format.
+    Every value is stored with the version of its tree, so writes invalidate
+    only subtrees of the trees they touch. Total size of values is bounded by `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != version:
+                self.stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats['hits'] += 1
+            return item[1]
+
+    def set(self, key, version, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._items[key] = (version, value)
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, 'items': len(self._items), 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+
+def get_subtree_cache():
+    return current_app.extensions['subtree_cache']
+
+
+def init_app(app):
+    app.extensions['subtree_cache'] = SubtreeCache(app.config.get('SUBTREE_CACHE_BYTES', 64 * 1024 * 1024))
@@ -0,0 +1,102 @@
+"""
+Log of changes for clients mirroring the hierarchy (GET /changes).
+
+Writes record their changes during the transaction and append them right before the commit
+under a lock held until the end of it, so versions of changes become visible in increasing order
+and a client reading changes after a version never skips one committed later. Records older than
+CHANGE_LOG_RETENTION_SECONDS or beyond the newest CHANGE_LOG_MAX_ROWS are removed and the horizon
+is moved past them: clients behind the horizon have to reload the hierarchy.
+"""
+import psycopg2.extensions
+from flask import current_app, g
+
+from app.db import get_db_conn, is_replica_conn, before_commit
+
+
+# advisory lock namespace of appends, see TREE_LOCK of app.models
+CHANGE_LOG_LOCK = 2
+
+# appends run the retention policy every time versions pass a multiple of this
+COMPACT_EVERY = 1000
+
+
+class PendingChanges(list):
+    """(op, node_id, parent_id, name) changes of the current transaction, appended before it is committed."""
+
+    def __call__(self):
+        with get_db_conn().cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute('SELECT pg_advisory_xact_lock(%s, 0)', (CHANGE_LOG_LOCK,))
+            cur.execute(
+                'INSERT INTO change_log (op, node_id, parent_id, name) '
+                'SELECT * FROM unnest(%s::text[], %s::integer[], %s::integer[], %s::text[]) '
+                'RETURNING version',
+                [list(column) for column in zip(*self)]
+            )
+            versions = [res[0] for res in cur.fetchall()]
+            if (min(versions) - 1) // COMPACT_EVERY != max(versions) // COMPACT_EVERY:
+                compact_changes(
+                    current_app.config.get('CHANGE_LOG_RETENTION_SECONDS', 7 * 24 * 3600),
+                    current_app.config.get('CHANGE_LOG_MAX_ROWS', 1000000),
+                )
+
+
+def log_change(op, node_id, parent_id=None, name=None):
+    """Record a change made by the current atomic function, parent_id of top-level nodes is None."""
+    pending = next((callback for callback in g.db_before_commit if isinstance(callback, PendingChanges)), None)
+    if pending is None:
+        pending = PendingChanges()
+        before_commit(pending)
+    pending.append((op, node_id, parent_id, name))
+
+
+def get_changes(since, limit):
+    """
+    Up to `limit` changes after the version in the order they were made and whether there are more,
+    None if some of them are no longer kept or the version is unknown. A replica behind the version
+    the client has already seen on a fresher one has no changes for it yet.
+    """
+    with get_db_conn().cursor() as cur:
+        cur.execute(
+            'SELECT version, op, node_id, parent_id, name FROM change_log WHERE version > %s ORDER BY version LIMIT %s',
+            (since, limit + 1)
+        )
+        rows = cur.fetchall()
+        # after the changes, records removed in between move the horizon
+        cur.execute('SELECT version, (SELECT max(version) FROM change_log) FROM change_log_horizon')
+        horizon, latest = cur.fetchone()
+    if since < horizon:
+        return None
+    if since > max(horizon, latest or 0):
+        if is_replica_conn():
+            return [], False
+        return None
+    changes = [
+        {'version': version, 'op': op, 'id': node_id, 'parent_id': parent_id, 'name': name}
+        for version, op, node_id, parent_id, name in rows[:limit]
+    ]
+    return changes, len(rows) > limit
+
+
+def get_changes_version():
+    """Version of the latest change, reading changes after it catches up with the current hierarchy."""
+    with get_db_conn().cursor() as cur:
+        cur.execute('SELECT greatest(version, (SELECT max(version) FROM change_log)) FROM change_log_horizon')
+        return cur.fetchone()[0]
+
+
+def compact_changes(max_age, max_rows):
+    """Remove changes older than max_age seconds or beyond the newest max_rows, returns their number."""
+    with get_db_conn().cursor() as cur:
+        # the log stays contiguous: everything up to the newest expired record goes
+        cur.execute(
+            'WITH deleted AS ('
+            '    DELETE FROM change_log WHERE version <= greatest('
+            '        (SELECT max(version) FROM change_log) - %s,'
+            "        (SELECT max(version) FROM change_log WHERE created_at < now() - %s * interval '1 second')"
+            '    ) RETURNING version'
+            ') '
+            'UPDATE change_log_horizon SET version = greatest(version, (SELECT max(version) FROM deleted)) '
+            'RETURNING (SELECT count(*) FROM deleted)',
+            (max_rows, max_age)
+        )
+        return cur.fetchone()[0]
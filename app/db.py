@@ -1,59 +1,536 @@
+import functools
+import json
+import os
+import random
+import re
+import threading
 import time
 
+import psycopg2.errors
 import psycopg2.extras
 import click
-from flask import current_app, g
+from flask import current_app, g, request, has_request_context
 from flask.cli import with_appcontext
 
+from app import metrics
 
-def get_db_conn():
-    if 'db_conn' not in g:
-        tries = 5
-        while tries > 0:
+
+class ConnectionPool:
+    """
+    Per worker pool of connections. Checkout blocks while all `size` connections are in use.
+    """
+
+    def __init__(self, connect, size, timeout):
+        self.pid = os.getpid()
+        self._connect = connect
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._checked_out = {}
+        self.size = size
+        self.stats = {
+            'checkouts': 0,
+            'checkout_timeouts': 0,
+            'connects': 0,
+            'discarded': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'hold_seconds': 0.0,
+        }
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self._timeout):
+            with self._lock:
+                self.stats['checkout_timeouts'] += 1
+            raise RuntimeError('Timed out waiting for a postgres connection')
+        now = time.monotonic()
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['wait_seconds'] += now - start
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], now - start)
+            conn = self._idle.pop() if self._idle else None
+        if conn is None or conn.closed:
             try:
-                g.db_conn = psycopg2.connect(
-                    dbname=current_app.config['POSTGRES_DB'],
-                    user=current_app.config['POSTGRES_USER'],
-                    password=current_app.config['POSTGRES_PASSWORD'],
-                    host='postgres',
-                    port=current_app.config['POSTGRES_PORT'],
-                    cursor_factory=psycopg2.extras.DictCursor,
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+            with self._lock:
+                self.stats['connects'] += 1
+        with self._lock:
+            self._checked_out[id(conn)] = now
+        return conn
+
+    def putconn(self, conn):
+        # a rollback resets the session and fails on a broken connection
+        try:
+            conn.rollback()
+            healthy = conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        except psycopg2.Error:
+            healthy = False
+        with self._lock:
+            self.stats['hold_seconds'] += time.monotonic() - self._checked_out.pop(id(conn))
+            if healthy:
+                self._idle.append(conn)
+            else:
+                self.stats['discarded'] += 1
+        if not healthy:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'size': self.size,
+                'idle': len(self._idle),
+                'in_use': len(self._checked_out),
+            }
+
+
+_pool_lock = threading.Lock()
+
+
+def get_connect_params(config, host=None):
+    """Parameters of connections to the primary or to a replica given as host[:port]."""
+    host, _, port = (host or config.get('POSTGRES_HOST', 'postgres')).partition(':')
+    return {
+        'dbname': config['POSTGRES_DB'],
+        'user': config['POSTGRES_USER'],
+        'password': config['POSTGRES_PASSWORD'],
+        'host': host,
+        'port': port or config['POSTGRES_PORT'],
+    }
+
+
+def get_pool():
+    with _pool_lock:
+        pool = current_app.extensions.get('db_pool')
+        # connections can not be shared with a forked worker
+        if pool is None or pool.pid != os.getpid():
+            config = current_app.config
+            pool = current_app.extensions['db_pool'] = ConnectionPool(
+                functools.partial(connect, **get_connect_params(config)),
+                size=config.get('POSTGRES_POOL_SIZE', 10),
+                timeout=config.get('POSTGRES_POOL_TIMEOUT', 30),
+            )
+    return pool
+
+
+def get_replica_pools():
+    """Pools of POSTGRES_REPLICA_HOSTS, connections to an unavailable replica are not retried."""
+    hosts = current_app.config.get('POSTGRES_REPLICA_HOSTS', [])
+    if not hosts:
+        return []
+    with _pool_lock:
+        pools = current_app.extensions.get('db_replica_pools')
+        if pools is None or pools[0].pid != os.getpid():
+            config = current_app.config
+            pools = current_app.extensions['db_replica_pools'] = [
+                ConnectionPool(
+                    functools.partial(connect, tries=1, **get_connect_params(config, host)),
+                    size=config.get('POSTGRES_POOL_SIZE', 10),
+                    timeout=config.get('POSTGRES_POOL_TIMEOUT', 30),
                 )
-            except psycopg2.OperationalError:
+                for host in hosts
+            ]
+    return pools
+
+
+def close_pool(app):
+    pools = [app.extensions.pop('db_pool', None)] + app.extensions.pop('db_replica_pools', [])
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+
+
+class InstrumentedCursorMixin:
+    """Reports every statement to the metrics of the current request."""
+
+    def execute(self, query, vars=None):
+        with metrics.query_timer(self, query):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with metrics.query_timer(self, query):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        with metrics.query_timer(self, sql):
+            return super().copy_expert(sql, file, *args, **kwargs)
+
+    def copy_from(self, file, table, *args, **kwargs):
+        with metrics.query_timer(self, f'COPY {table} FROM STDIN'):
+            return super().copy_from(file, table, *args, **kwargs)
+
+
+class InstrumentedCursor(InstrumentedCursorMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class InstrumentedDictCursor(InstrumentedCursorMixin, psycopg2.extras.DictCursor):
+    pass
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connection which replaces the plain and dict cursors it creates with instrumented ones."""
+
+    cursor_classes = {
+        psycopg2.extensions.cursor: InstrumentedCursor,
+        psycopg2.extras.DictCursor: InstrumentedDictCursor,
+    }
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        cursor_factory = cursor_factory or self.cursor_factory or psycopg2.extensions.cursor
+        return super().cursor(
+            *args, cursor_factory=self.cursor_classes.get(cursor_factory, cursor_factory), **kwargs
+        )
+
+
+def connect(tries=5, **kwargs):
+    for attempt in range(tries):
+        try:
+            return psycopg2.connect(
+                connection_factory=InstrumentedConnection, cursor_factory=psycopg2.extras.DictCursor, **kwargs
+            )
+        except psycopg2.OperationalError:
+            if attempt < tries - 1:
                 time.sleep(1)
-                tries -= 1
-            else:
-                break
-        else:
-            raise RuntimeError('Could not connect to postgres')
+    raise RuntimeError('Could not connect to postgres')
+
+
+def get_db_conn():
+    """
+    Connection of the current app context. GET and HEAD requests read from a replica
+    if there are any, others use the primary.
+    """
+    if 'db_conn' not in g:
+        pool, conn = None, None
+        if has_request_context() and request.method in READ_METHODS:
+            pool, conn = get_replica_conn(get_min_lsn())
+        if conn is None:
+            pool = get_pool()
+            conn = pool.getconn()
+        g.db_conn_pool = pool
+        g.db_conn = conn
 
     return g.db_conn
 
 
+def is_replica_conn():
+    """Whether the connection of the current app context goes to a replica, which may lag behind the primary."""
+    get_db_conn()
+    return g.db_conn_pool is not get_pool()
+
+
+READ_METHODS = ('GET', 'HEAD')
+
+# clients send back the position of their last write in the header or the cookie
+LSN_HEADER = 'X-LSN'
+LSN_COOKIE = 'lsn'
+LSN_COOKIE_SECONDS = 60
+LSN_RE = re.compile(r'[0-9A-F]{1,8}/[0-9A-F]{1,8}')
+
+# seconds between checks of a lagging replica
+REPLICA_POLL_INTERVAL = 0.005
+
+
+def get_min_lsn():
+    """WAL position the replica should have replayed to show the client its own writes."""
+    lsn = request.headers.get(LSN_HEADER) or request.cookies.get(LSN_COOKIE)
+    return lsn if lsn is not None and LSN_RE.fullmatch(lsn) else None
+
+
+def get_replica_conn(min_lsn=None):
+    """
+    Connection to a random replica which has replayed WAL up to min_lsn, waiting for it
+    up to REPLICA_MAX_WAIT seconds. (None, None) if there is none, so the primary should be used.
+    """
+    pools = get_replica_pools()
+    if not pools:
+        return None, None
+    pool = random.choice(pools)
+    try:
+        conn = pool.getconn()
+    except RuntimeError:
+        return None, None
+    if min_lsn is None:
+        return pool, conn
+
+    deadline = time.monotonic() + current_app.config.get('REPLICA_MAX_WAIT', 0.1)
+    try:
+        with conn.cursor() as cur:
+            while True:
+                # a primary listed as a replica (e.g. in development) is never behind
+                cur.execute(
+                    'SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END '
+                    '>= %s::pg_lsn',
+                    (min_lsn,)
+                )
+                if cur.fetchone()[0]:
+                    return pool, conn
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(REPLICA_POLL_INTERVAL)
+    except psycopg2.Error:
+        pass
+    pool.putconn(conn)
+    return None, None
+
+
+def get_commit_lsn():
+    """WAL position after the last commit of the current connection."""
+    conn = get_db_conn()
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_current_wal_lsn()')
+        lsn = cur.fetchone()[0]
+    conn.rollback()
+    return lsn
+
+
+def add_commit_lsn(response):
+    """Give the client the position of its write, so its next reads wait for replicas to replay it."""
+    lsn = g.get('db_commit_lsn')
+    if lsn is not None:
+        response.headers[LSN_HEADER] = lsn
+        response.set_cookie(LSN_COOKIE, lsn, max_age=LSN_COOKIE_SECONDS, httponly=True)
+    return response
+
+
+class TransactionConflict(Exception):
+    """Raised when a transaction collides with a concurrent one, the outermost atomic call retries it."""
+
+
+# seconds to wait before the first retry of a conflicting transaction and at most
+RETRY_DELAY = 0.01
+RETRY_MAX_DELAY = 0.5
+
+# errors after which a transaction can simply be run again
+RETRY_ERRORS = (
+    TransactionConflict,
+    psycopg2.errors.DeadlockDetected,
+    psycopg2.errors.SerializationFailure,
+)
+
+
+def atomic(fn):
+    """
+    Run fn in a transaction. It is committed when the outermost atomic function returns
+    and rolled back if it raises, so nested calls share one transaction.
+    On conflicts with concurrent transactions the outermost call runs fn again
+    up to TRANSACTION_RETRIES times with exponential backoff.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if g.get('db_atomic', False):
+            return fn(*args, **kwargs)
+
+        retries = current_app.config.get('TRANSACTION_RETRIES', 5)
+        for attempt in range(retries + 1):
+            g.db_atomic = True
+            g.db_before_commit = []
+            g.db_on_commit = []
+            try:
+                res = fn(*args, **kwargs)
+                for callback in g.db_before_commit:
+                    callback()
+                get_db_conn().commit()
+                break
+            except RETRY_ERRORS as e:
+                get_db_conn().rollback()
+                if attempt == retries:
+                    raise TransactionConflict('Too many concurrent writes, try again') from e
+            except Exception:
+                get_db_conn().rollback()
+                raise
+            finally:
+                g.db_atomic = False
+            time.sleep(min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** attempt) * random.uniform(0.5, 1))
+
+        # outside of the retries, fn must not run again once it is committed
+        for callback in g.db_on_commit:
+            callback()
+        if current_app.config.get('POSTGRES_REPLICA_HOSTS'):
+            g.db_commit_lsn = get_commit_lsn()
+        return res
+    return wrapper
+
+
+def before_commit(callback):
+    """Call callback at the end of the transaction of the current atomic function, right before the commit."""
+    g.db_before_commit.append(callback)
+
+
+def on_commit(callback):
+    """Call callback after the transaction of the current atomic function is committed."""
+    g.db_on_commit.append(callback)
+
+
 def teardown_db(e=None):
     db_conn = g.pop('db_conn', None)
 
     if db_conn is not None:
-        db_conn.close()
+        pool = g.pop('db_conn_pool', None) or get_pool()
+        pool.putconn(db_conn)
 
 
 def init_db():
+    from app.partitions import init_partitions
+
     db_conn = get_db_conn()
 
     with db_conn.cursor() as cur:
         with current_app.open_resource('schema.sql') as f:
             cur.execute(f.read())
+        init_partitions()
         cur.execute("INSERT INTO node (name, lft, rgt) VALUES ('root', 0, 1)")
+        # schema.sql is always up to date
+        cur.executemany('INSERT INTO schema_migration (name) VALUES (%s)', [(m,) for m in get_migrations()])
     
     db_conn.commit()
 
 
+def get_migrations():
+    return sorted(
+        name for name in os.listdir(os.path.join(current_app.root_path, 'migrations'))
+        if name.endswith('.sql')
+    )
+
+
+def migrate():
+    db_conn = get_db_conn()
+
+    with db_conn.cursor() as cur:
+        cur.execute('CREATE TABLE IF NOT EXISTS schema_migration (name TEXT PRIMARY KEY)')
+        cur.execute('SELECT name FROM schema_migration')
+        applied = {row[0] for row in cur.fetchall()}
+        for name in get_migrations():
+            if name in applied:
+                continue
+            with current_app.open_resource(os.path.join('migrations', name)) as f:
+                cur.execute(f.read())
+            cur.execute('INSERT INTO schema_migration (name) VALUES (%s)', (name,))
+            click.echo(f'Applied {name}')
+
+    db_conn.commit()
+
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
     init_db()
 
 
+@click.command('import-tree')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--parent-id', type=int, help='Item to import the tree under, top level by default.')
+@click.option('--ndjson', is_flag=True, help='Read lines of {"name", "parent"} instead of nested items.')
+@with_appcontext
+def import_tree_command(file, parent_id, ndjson):
+    """Import a tree from FILE in one transaction."""
+    from app.bulk import rows_from_tree, rows_from_ndjson
+    from app.models import Node, BulkError
+
+    parent_node = Node.get_by_id(parent_id if parent_id is not None else Node.get_root_id())
+    if parent_node is None:
+        raise click.BadParameter('Item not found', param_hint='--parent-id')
+
+    try:
+        if ndjson:
+            rows, errors = rows_from_ndjson(file)
+        else:
+            rows, errors = rows_from_tree(json.load(file))
+        if not errors:
+            ids = Node.bulk_create(rows, parent_node)
+    except BulkError as e:
+        errors = e.errors
+    except ValueError as e:
+        # invalid JSON or UTF-8, or the parent deleted meanwhile
+        raise click.ClickException(str(e))
+    if errors:
+        for e in errors:
+            click.echo(f'Row {e["row"]}: {e["message"]}', err=True)
+        raise click.ClickException('Nothing imported')
+    click.echo(f'Imported {len(ids)} items')
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    migrate()
+
+
+@click.command('renumber-trees')
+@with_appcontext
+def renumber_trees_command():
+    """Compute nested set bounds from parent links, needed after running with the adjacency_list STORAGE_ENGINE."""
+    from app.models import Node
+
+    with get_db_conn().cursor() as cur:
+        cur.execute('SELECT id FROM node WHERE parent_id = %s ORDER BY id', (Node.get_root_id(),))
+        tree_ids = [res[0] for res in cur.fetchall()]
+    # a transaction per tree, so writes to other trees are not blocked
+    count = sum(Node.renumber_tree(tree_id) for tree_id in tree_ids)
+    click.echo(f'Renumbered {len(tree_ids)} trees of {count} items')
+
+
+@click.command('compact')
+@with_appcontext
+def compact_command():
+    """Renumber dense trees with positions left unused by deferred deletes (DEFERRED_DELETE)."""
+    from app.models import Node
+
+    positions = Node.get_gap_stats()['positions']
+    tree_ids = Node.get_gap_tree_ids()
+    # a transaction per tree, so writes to other trees are not blocked
+    count = sum(Node.renumber_tree(tree_id) for tree_id in tree_ids)
+    click.echo(f'Compacted {len(tree_ids)} trees of {count} items, {positions} positions freed')
+
+
+@click.command('partition-nodes')
+@click.option('--partitions', type=click.IntRange(min=1), default=16, help='Number of hash partitions, 16 by default.')
+@with_appcontext
+def partition_nodes_command(partitions):
+    """Hash partition the node table by tree_id (or change the number of partitions) while the app keeps running."""
+    from app.partitions import partition_nodes
+
+    def progress(done, total):
+        if done % 1000 == 0 or done == total:
+            click.echo(f'Copied {done} of {total} trees')
+
+    trees = partition_nodes(partitions, progress)
+    click.echo(f'Partitioned {trees} trees into {partitions} partitions')
+
+
+@click.command('compact-changes')
+@with_appcontext
+def compact_changes_command():
+    """Remove changes beyond CHANGE_LOG_RETENTION_SECONDS and CHANGE_LOG_MAX_ROWS."""
+    from app.changes import compact_changes
+
+    removed = compact_changes(
+        current_app.config.get('CHANGE_LOG_RETENTION_SECONDS', 7 * 24 * 3600),
+        current_app.config.get('CHANGE_LOG_MAX_ROWS', 1000000),
+    )
+    get_db_conn().commit()
+    click.echo(f'Removed {removed} changes')
+
+
 def init_app(app):
+    app.after_request(add_commit_lsn)
     app.teardown_appcontext(teardown_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(import_tree_command)
+    app.cli.add_command(renumber_trees_command)
+    app.cli.add_command(compact_command)
+    app.cli.add_command(partition_nodes_command)
+    app.cli.add_command(compact_changes_command)
+    app.cli.add_command(migrate_command)
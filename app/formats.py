@@ -0,0 +1,98 @@
+"""
+Flat columnar representations of subtrees, chosen with the Accept header of /hierarchy and /subtree.
+
+Items come in lft order as parallel columns of ids, parent ids, depths and names, so key names
+are not repeated for every item and nothing has to be nested. The binary encoding is:
+
+    b'HCOL', item count (uint32)
+    ids, parent ids (0 for top-level items), depths: item count int32 each
+    lengths of UTF-8 encoded names: item count uint32
+    names: concatenated UTF-8
+
+with all integers little-endian.
+"""
+import json
+import struct
+import sys
+from array import array
+
+
+JSON = 'application/json'
+COLUMNS_JSON = 'application/vnd.hierarchy.columns+json'
+COLUMNS_BINARY = 'application/vnd.hierarchy.columns'
+
+# nested JSON stays the default
+MIMETYPES = (JSON, COLUMNS_JSON, COLUMNS_BINARY)
+
+MAGIC = b'HCOL'
+HEADER = struct.Struct('<4sI')
+
+
+def encode_columns_json(columns):
+    return json.dumps(columns, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _to_bytes(typecode, values):
+    column = array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+
+def encode_columns_binary(columns):
+    names = [name.encode() for name in columns['names']]
+    return b''.join([
+        HEADER.pack(MAGIC, len(names)),
+        _to_bytes('i', columns['ids']),
+        _to_bytes('i', (parent_id or 0 for parent_id in columns['parent_ids'])),
+        _to_bytes('i', columns['depths']),
+        _to_bytes('I', map(len, names)),
+        *names,
+    ])
+
+
+def _from_bytes(typecode, data, offset, count):
+    column = array(typecode)
+    column.frombytes(data[offset:offset + count * column.itemsize])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column, offset + count * column.itemsize
+
+
+def decode_columns_binary(data):
+    """Columns of encode_columns_binary output, ValueError if it is malformed."""
+    if len(data) < HEADER.size:
+        raise ValueError('Not a columnar subtree')
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not a columnar subtree')
+    offset = HEADER.size
+    ids, offset = _from_bytes('i', data, offset, count)
+    parent_ids, offset = _from_bytes('i', data, offset, count)
+    depths, offset = _from_bytes('i', data, offset, count)
+    lengths, offset = _from_bytes('I', data, offset, count)
+    names = []
+    for length in lengths:
+        names.append(data[offset:offset + length].decode())
+        offset += length
+    if offset != len(data):
+        raise ValueError('Unexpected length of a columnar subtree')
+    return {
+        'ids': list(ids),
+        'parent_ids': [parent_id or None for parent_id in parent_ids],
+        'depths': list(depths),
+        'names': names,
+    }
+
+
+ENCODERS = {
+    COLUMNS_JSON: encode_columns_json,
+    COLUMNS_BINARY: encode_columns_binary,
+}
+
+# distinguish ETags of representations of one subtree
+ETAG_SUFFIXES = {
+    JSON: '',
+    COLUMNS_JSON: '.columns',
+    COLUMNS_BINARY: '.binary',
+}
@@ -0,0 +1,211 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, request, has_app_context
+
+
+# upper bounds of histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# statements which report affected rows in their status
+WRITE_COMMANDS = ('INSERT', 'UPDATE', 'DELETE', 'COPY')
+
+# characters of each statement kept for the slow request log
+MAX_LOGGED_SQL = 1000
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{format_labels(labels)}}} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> counts of buckets (not cumulative), sum and count
+        self.values = {}
+
+    def observe(self, labels, value):
+        counts = self.values.setdefault(labels, [0] * len(self.buckets) + [0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-2] += value
+        counts[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, counts in sorted(self.values.items()):
+            label_str = format_labels(labels)
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                lines.append(f'{self.name}_bucket{{{label_str},le="{bound}"}} {total}')
+            lines.append(f'{self.name}_bucket{{{label_str},le="+Inf"}} {counts[-1]}')
+            lines.append(f'{self.name}_sum{{{label_str}}} {round(counts[-2], 6)}')
+            lines.append(f'{self.name}_count{{{label_str}}} {counts[-1]}')
+        return lines
+
+
+def format_labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in zip(('endpoint', 'method', 'status'), labels))
+
+
+class RequestMetrics:
+    """
+    Per-endpoint request metrics of one worker process. Endpoints are labeled with their
+    name and method, so the number of label sets is bounded by the routes of the app.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter('http_requests_total', 'Requests by endpoint and status')
+        self.queries = Counter('db_queries_total', 'SQL statements executed by requests')
+        self.rows = Counter('db_rows_affected_total', 'Rows inserted, updated, deleted or copied by requests')
+        self.latency = Histogram('http_request_duration_seconds', 'Total latency of requests', SECONDS_BUCKETS)
+        self.db_time = Histogram('http_request_db_seconds', 'Time of requests spent in SQL statements', SECONDS_BUCKETS)
+        self.serialization_time = Histogram(
+            'http_request_serialization_seconds', 'Time of requests spent serializing JSON', SECONDS_BUCKETS
+        )
+        self.query_count = Histogram('http_request_queries', 'SQL statements per request', QUERIES_BUCKETS)
+
+    def observe(self, stats, status, duration):
+        labels = (stats.endpoint, stats.method)
+        with self._lock:
+            self.requests.inc(labels + (status,))
+            self.queries.inc(labels, stats.queries)
+            self.rows.inc(labels, stats.rows)
+            self.latency.observe(labels, duration)
+            self.db_time.observe(labels, stats.db_time)
+            self.serialization_time.observe(labels, stats.serialization_time)
+            self.query_count.observe(labels, stats.queries)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in (
+                self.requests, self.queries, self.rows, self.latency,
+                self.db_time, self.serialization_time, self.query_count,
+            ):
+                lines += metric.render()
+        return lines
+
+
+class RequestStats:
+    """Counters of the current request, statements are kept only for the slow request log."""
+
+    def __init__(self, endpoint, method, keep_statements):
+        self.endpoint = endpoint
+        self.method = method
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.db_time = 0
+        self.serialization_time = 0
+        self.statements = [] if keep_statements else None
+
+
+def get_request_metrics():
+    return current_app.extensions['request_metrics']
+
+
+def get_request_stats():
+    return g.get('request_stats') if has_app_context() else None
+
+
+@contextmanager
+def query_timer(cursor, sql):
+    """Count the statement executed by the cursor in the stats of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = get_request_stats()
+        if stats is not None:
+            duration = time.perf_counter() - start
+            stats.queries += 1
+            stats.db_time += duration
+            status = cursor.statusmessage or ''
+            if status.startswith(WRITE_COMMANDS) and cursor.rowcount > 0:
+                stats.rows += cursor.rowcount
+            if stats.statements is not None:
+                query = cursor.query or sql
+                if isinstance(query, bytes):
+                    query = query.decode(errors='replace')
+                stats.statements.append((duration, query[:MAX_LOGGED_SQL]))
+
+
+@contextmanager
+def serialization_timer():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = get_request_stats()
+        if stats is not None:
+            stats.serialization_time += time.perf_counter() - start
+
+
+def render_metrics(gauges):
+    """Request metrics and {name: value} gauges in Prometheus text format."""
+    lines = get_request_metrics().render()
+    for name, value in gauges.items():
+        lines += [f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def start_request():
+    g.request_stats = RequestStats(
+        request.endpoint or 'none',
+        request.method,
+        keep_statements=bool(current_app.config.get('SLOW_REQUEST_SECONDS')),
+    )
+
+
+def finish_request(response):
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    request_metrics = get_request_metrics()
+    logger = current_app.logger
+    slow_seconds = current_app.config.get('SLOW_REQUEST_SECONDS')
+    path = request.full_path
+
+    def observe():
+        duration = time.perf_counter() - stats.start
+        request_metrics.observe(stats, response.status_code, duration)
+        if slow_seconds and duration >= slow_seconds:
+            statements = '\n'.join(f'  {seconds * 1000:.1f} ms: {sql}' for seconds, sql in stats.statements)
+            logger.warning(
+                'Slow request %s %s: %.3f s, %d queries, %.3f s in db, %.3f s serializing\n%s',
+                stats.method, path, duration, stats.queries, stats.db_time, stats.serialization_time, statements
+            )
+
+    # streamed responses are still being written, so they are measured when closed
+    if response.is_streamed:
+        response.call_on_close(observe)
+    else:
+        observe()
+    return response
+
+
+def init_app(app):
+    app.extensions['request_metrics'] = RequestMetrics()
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,7 @@
+-- Renumber every tree (a child of the root node) starting from 1
+-- so that lft/rgt values are scoped by tree_id.
+UPDATE node SET lft = node.lft - top.lft + 1, rgt = node.rgt - top.lft + 1
+FROM node top
+WHERE top.parent_id = 1 AND node.tree_id = top.id;
+
+UPDATE node SET rgt = 1 WHERE id = 1;
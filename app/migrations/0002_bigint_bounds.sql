@@ -0,0 +1,2 @@
+-- Sparse numbering (NESTED_SET_GAP) needs a wider range of lft/rgt values.
+ALTER TABLE node ALTER COLUMN lft TYPE BIGINT, ALTER COLUMN rgt TYPE BIGINT;
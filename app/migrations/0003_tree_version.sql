@@ -0,0 +1,11 @@
+CREATE SEQUENCE tree_version_seq;
+
+CREATE TABLE tree_version (
+    tree_id INTEGER PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+CREATE INDEX tree_version_version_idx ON tree_version (version);
+
+INSERT INTO tree_version (tree_id, version)
+SELECT id, nextval('tree_version_seq') FROM node WHERE parent_id = 1;
@@ -0,0 +1,8 @@
+-- Range scans and lft/rgt shifts are always scoped by tree_id.
+-- Shifts rewrite many index entries, so leave free space in pages for them.
+-- fillfactor applies to pages written from now on, VACUUM FULL rewrites the table.
+ALTER TABLE node SET (fillfactor = 70);
+
+CREATE INDEX node_tree_lft_idx ON node (tree_id, lft) WITH (fillfactor = 70);
+CREATE INDEX node_tree_rgt_idx ON node (tree_id, rgt) WITH (fillfactor = 70);
+CREATE INDEX node_parent_idx ON node (parent_id, lft) WITH (fillfactor = 70);
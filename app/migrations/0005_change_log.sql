@@ -0,0 +1,16 @@
+-- Log of changes read by GET /changes, see app/changes.py.
+-- Clients that mirrored the hierarchy before have to reload it once.
+CREATE TABLE change_log (
+    version BIGSERIAL PRIMARY KEY,
+    op TEXT NOT NULL,
+    node_id INTEGER NOT NULL,
+    parent_id INTEGER,
+    name TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE change_log_horizon (
+    version BIGINT NOT NULL
+);
+
+INSERT INTO change_log_horizon (version) VALUES (0);
@@ -0,0 +1,20 @@
+-- Indexes of GET /search, see Node.search.
+-- Names are folded to lower case the same way whatever the locale of the database is:
+-- lower() of the "C" locale leaves cyrillic letters as they are.
+CREATE OR REPLACE FUNCTION name_search_key(name TEXT) RETURNS TEXT AS $$
+    SELECT translate(lower(name), 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ', 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя')
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+-- prefix matches in key order, across trees or within one
+CREATE INDEX node_name_key_idx ON node ((name_search_key(name) COLLATE "C"), id);
+CREATE INDEX node_tree_name_key_idx ON node (tree_id, (name_search_key(name) COLLATE "C"), id);
+
+-- substring matches, pg_trgm comes with the contrib package of PostgreSQL
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX node_name_trgm_idx ON node USING gin (name_search_key(name) gin_trgm_ops);
+EXCEPTION WHEN feature_not_supported OR undefined_file OR insufficient_privilege THEN
+    RAISE NOTICE 'pg_trgm is not available, substring search reads the whole table';
+END
+$$;
@@ -0,0 +1,5 @@
+-- lft/rgt positions of dense trees left unused by deferred deletes, see DEFERRED_DELETE.
+CREATE TABLE tree_gap (
+    tree_id INTEGER PRIMARY KEY,
+    positions BIGINT NOT NULL
+);
@@ -1,9 +1,60 @@
+import csv
+import functools
+import io
+import json
 import re, string
+from contextlib import closing
 from dataclasses import dataclass, replace
 
 import psycopg2.errors
+import psycopg2.extras
+from flask import current_app
 
-from app.db import get_db_conn
+from app.changes import log_change
+from app.db import get_db_conn, atomic, TransactionConflict
+from app.replica import get_replica, publish_versions, record_change
+
+
+# renumbering of sparse trees keeps at least this distance between lft/rgt values
+MIN_STEP = 4
+
+# first key of advisory locks on trees, the second one is tree_id
+TREE_LOCK = 1
+
+# name collision policies of Node.copy: fail, or add the first free suffix to all copied names
+COPY_POLICIES = ('error', 'rename')
+COPY_SUFFIXES = ('', ' copy', *(f' copy {i}' for i in range(2, 100)))
+
+# search key of names, the expression indexed by node_name_key_idx and node_tree_name_key_idx
+NAME_KEY = 'name_search_key(name) COLLATE "C"'
+
+# columns needed to build a subtree
+SUBTREE_COLUMNS = 'id, name, parent_id, tree_id, rgt'
+
+# rows fetched from a server-side cursor and items sent at a time by Node.stream_subtree
+STREAM_CHUNK_ITEMS = 2000
+
+
+def dispatch(fn):
+    """
+    Decorator of Node classmethods running them on the Node class of the configured storage engine,
+    so that Node.get_by_id(), Node.create() and the like work with nodes of that engine.
+    """
+    @functools.wraps(fn)
+    def wrapper(cls, *args, **kwargs):
+        engine = cls.get_engine()
+        if engine is not cls:
+            return getattr(engine, fn.__name__)(*args, **kwargs)
+        return fn(cls, *args, **kwargs)
+    return wrapper
+
+
+class BulkError(ValueError):
+    """Errors of Node.bulk_create, one {'row', 'message'} dict per invalid row."""
+
+    def __init__(self, errors):
+        super().__init__('Invalid items')
+        self.errors = errors
 
 
 @dataclass(frozen=True)
@@ -11,6 +62,10 @@ class Node:
     """
     Tree structure based on nested set model: https://en.wikipedia.org/wiki/Nested_set_model.
     Collection of trees represented by one tree with a fictional root node.
+    Every tree (a child of the root) has its own lft/rgt numbering scoped by tree_id,
+    so writes only touch rows of the affected trees.
+
+    This is the default storage engine, see AdjacencyListNode for the other one.
     """
     id: int
     name: str
@@ -23,6 +78,11 @@ class Node:
     def get_root_id():
         return 1
 
+    @staticmethod
+    def get_engine():
+        """Node class of the storage engine chosen with STORAGE_ENGINE."""
+        return STORAGE_ENGINES[current_app.config.get('STORAGE_ENGINE', 'nested_set')]
+
     @classmethod
     def get_root_node(cls):
         return cls.get_by_id(cls.get_root_id())
@@ -40,7 +100,16 @@ class Node:
             )
 
     @classmethod
-    def get_by_id(cls, id):
+    @dispatch
+    def get_by_id(cls, id, replica=True):
+        """
+        Node with the id or None. Rows of the in-memory replica may lag behind writes of other workers
+        and of the current transaction, writes deciding what to change pass replica=False.
+        """
+        replica = get_replica() if replica else None
+        res = replica and replica.get_row(id)
+        if res is not None:
+            return cls(**res)
         with get_db_conn().cursor() as cur:
             cur.execute('SELECT * FROM node WHERE id=%s', (id,))
             res = cur.fetchone()
@@ -48,7 +117,23 @@ class Node:
             return None
         return cls(**res)
     
-    def to_item(self):
+    @classmethod
+    @dispatch
+    def get_by_ids(cls, ids):
+        """Existing nodes in the order of ids, with one query for those not in the replica."""
+        replica = get_replica()
+        nodes = {}
+        if replica is not None:
+            rows = {id: replica.get_row(id) for id in ids}
+            nodes = {id: cls(**res) for id, res in rows.items() if res is not None}
+        missing = [id for id in ids if id not in nodes]
+        if missing:
+            with get_db_conn().cursor() as cur:
+                cur.execute('SELECT * FROM node WHERE id = ANY(%s)', (missing,))
+                nodes.update((res['id'], cls(**res)) for res in cur.fetchall())
+        return [nodes[id] for id in ids if id in nodes]
+    
+    def _item(self):
         return {
             'id': self.id,
             'name': self.name,
@@ -56,119 +141,1120 @@ class Node:
             'parent_id': self.parent_id if self.parent_id != self.get_root_id() else None
         }
 
+    def _item_id(self):
+        """Id of the node as a parent in items, None for the root."""
+        return None if self.is_root else self.id
+
+    def to_item(self):
+        return self.to_items([self])[0]
+
+    @classmethod
+    @dispatch
+    def to_items(cls, nodes):
+        """Items with depth and number of descendants, from the replica or with one query for the rest."""
+        if not nodes:
+            return []
+        replica = get_replica()
+        stats = {}
+        if replica is not None:
+            counts = {node.id: replica.get_counts(node) for node in nodes}
+            stats = {id: value for id, value in counts.items() if value is not None}
+        missing = [node for node in nodes if node.id not in stats]
+        if missing:
+            stats.update(cls._get_counts(missing))
+        items = []
+        for node in nodes:
+            depth, count = stats[node.id]
+            items.append({**node._item(), 'depth': depth, 'descendant_count': count})
+        return items
+
+    @classmethod
+    def _get_counts(cls, nodes):
+        """
+        {id: (depth, descendant_count)} of the nodes, computed with one query for all nodes.
+        Ancestors are found by following parent links, so depth costs a primary key lookup per level
+        instead of a range scan of everything to the left of the node. Descendants are counted
+        only in sparse mode, dense numbering gives (rgt - lft - 1) / 2.
+        """
+        dense = cls.is_dense()
+        descendants = (
+            'SELECT count(*) FROM node d WHERE d.tree_id = v.tree_id AND d.tree_id = ANY(%(tree_ids)s) '
+            'AND d.lft > v.lft AND d.lft < v.rgt'
+        )
+        if dense:
+            # only trees with positions left by deferred deletes are counted
+            descendants = (
+                'CASE WHEN EXISTS (SELECT 1 FROM tree_gap t WHERE t.tree_id = v.tree_id AND t.positions > 0) '
+                f'THEN ({descendants}) END'
+            )
+        with get_db_conn().cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            # the constant list of trees lets the planner prune partitions of the walk and the counts
+            cur.execute(
+                'WITH RECURSIVE v AS ('
+                '    SELECT * FROM unnest(%(ids)s::integer[], %(parent_ids)s::integer[], %(tree_ids)s::integer[], '
+                '        %(lfts)s::bigint[], %(rgts)s::bigint[]) AS v (id, parent_id, tree_id, lft, rgt)'
+                '), ancestors AS ('
+                '    SELECT v.id AS node_id, n.parent_id, n.tree_id FROM v '
+                '    JOIN node n ON n.id = v.parent_id AND n.tree_id = v.tree_id AND n.tree_id = ANY(%(tree_ids)s) '
+                '    UNION ALL '
+                '    SELECT a.node_id, n.parent_id, n.tree_id FROM ancestors a '
+                '    JOIN node n ON n.id = a.parent_id AND n.tree_id = a.tree_id AND n.tree_id = ANY(%(tree_ids)s)'
+                ') '
+                'SELECT v.id, (SELECT count(*) FROM ancestors a WHERE a.node_id = v.id), '
+                f'({descendants}) '
+                'FROM v',
+                {
+                    'ids': [node.id for node in nodes],
+                    'parent_ids': [node.parent_id for node in nodes],
+                    'tree_ids': [node.tree_id for node in nodes],
+                    'lfts': [node.lft for node in nodes],
+                    'rgts': [node.rgt for node in nodes],
+                }
+            )
+            depths = {id: (depth, count) for id, depth, count in cur.fetchall()}
+        return {
+            node.id: (
+                depths[node.id][0],
+                (node.rgt - node.lft - 1) // 2 if depths[node.id][1] is None else depths[node.id][1]
+            )
+            for node in nodes
+        }
+
+    def get_path(self):
+        """
+        Ancestors of the node from the top of its tree, ending with the node itself.
+        Parent links are followed with a primary key lookup per level, bounds would make it
+        a range scan of everything to the left of the node.
+        """
+        replica = get_replica()
+        rows = replica and replica.get_path_rows(self)
+        if rows is not None:
+            return [self.__class__(**res) for res in rows]
+        with get_db_conn().cursor() as cur:
+            cur.execute(
+                'WITH RECURSIVE path AS ('
+                '    SELECT *, 0 AS level FROM node WHERE id = %(id)s AND tree_id = %(tree_id)s '
+                '    UNION ALL '
+                '    SELECT n.*, p.level + 1 FROM path p '
+                '    JOIN node n ON n.id = p.parent_id AND n.tree_id = p.tree_id AND n.tree_id = %(tree_id)s'
+                ') '
+                'SELECT id, parent_id, name, lft, rgt, tree_id FROM path ORDER BY level DESC',
+                {'id': self.id, 'tree_id': self.tree_id}
+            )
+            return [self.__class__(**res) for res in cur.fetchall()]
+
+    def get_children(self, limit, after=None):
+        """
+        One page of direct children in lft order, read with the (parent_id, lft) index.
+        after is the lft of the last child of the previous page.
+        """
+        replica = get_replica()
+        rows = replica and replica.get_children_rows(self, limit, after)
+        if rows is not None:
+            return [self.__class__(**res) for res in rows]
+        scope, scope_params = self._get_children_scope()
+        with get_db_conn().cursor() as cur:
+            cur.execute(
+                f'SELECT * FROM node WHERE parent_id = %s AND {scope} AND lft > %s ORDER BY lft LIMIT %s',
+                (self.id, *scope_params, self.lft if after is None else after, limit)
+            )
+            return [self.__class__(**res) for res in cur.fetchall()]
+
+    def _get_children_scope(self):
+        """Condition on tree_id of the node's children, so that only their partition is read."""
+        if self.is_root:
+            return 'tree_id IS NOT NULL', ()
+        return 'tree_id = %s', (self.tree_id,)
+
+    @staticmethod
+    def get_search_key(name):
+        """Lower case name, equal to name_search_key() of the database for names passing validate_name."""
+        return name.lower()
+
+    @classmethod
+    @dispatch
+    def search(cls, query, limit, tree_id=None, prefix=False, after=None):
+        """
+        One page of nodes with names containing the query (or starting with it) ignoring case,
+        each with its ancestors from the top of its tree. Matches come in the order of search keys
+        and ids, after is the (key, id) of the last match of the previous page. Prefixes are looked up
+        with the btree indexes of search keys, substrings with the trigram index if pg_trgm is installed.
+        """
+        escaped = re.sub(r'([\\%_])', r'\\\1', cls.get_search_key(query))
+        params = {
+            'pattern': escaped + '%' if prefix else '%' + escaped + '%',
+            'tree_id': tree_id,
+            'limit': limit,
+        }
+        conditions = [
+            f'{NAME_KEY} LIKE %(pattern)s' if prefix else 'name_search_key(name) LIKE %(pattern)s',
+            # the root is not an item
+            'tree_id = %(tree_id)s' if tree_id is not None else 'tree_id IS NOT NULL',
+        ]
+        if after is not None:
+            conditions.append(f'({NAME_KEY}, id) > (%(after_key)s, %(after_id)s)')
+            params['after_key'], params['after_id'] = after
+        with get_db_conn().cursor() as cur:
+            cur.execute(
+                f'SELECT * FROM node WHERE {" AND ".join(conditions)} ORDER BY {NAME_KEY}, id LIMIT %(limit)s',
+                params
+            )
+            nodes = [cls(**res) for res in cur.fetchall()]
+            if not nodes:
+                return []
+            # bounds of a match would make ancestors a range scan of everything to the left of it,
+            # parent links are followed with depth primary key lookups instead
+            cur.execute(
+                'WITH RECURSIVE ancestors AS ('
+                '    SELECT m.match_id, n.*, 1 AS level '
+                '    FROM unnest(%s::integer[], %s::integer[], %s::integer[]) AS m (match_id, parent_id, tree_id) '
+                '    JOIN node n ON n.id = m.parent_id AND n.tree_id = m.tree_id '
+                '    UNION ALL '
+                '    SELECT a.match_id, n.*, a.level + 1 '
+                '    FROM ancestors a JOIN node n ON n.id = a.parent_id AND n.tree_id = a.tree_id'
+                ') '
+                'SELECT match_id, id, parent_id, name, lft, rgt, tree_id FROM ancestors ORDER BY level DESC',
+                ([node.id for node in nodes], [node.parent_id for node in nodes], [node.tree_id for node in nodes])
+            )
+            ancestors = {node.id: [] for node in nodes}
+            for res in cur.fetchall():
+                res = dict(res)
+                ancestors[res.pop('match_id')].append(cls(**res))
+        return [(node, ancestors[node.id]) for node in nodes]
+
+    @staticmethod
+    def get_gap():
+        """Distance between lft/rgt values of new nodes, 0 means dense numbering."""
+        return current_app.config.get('NESTED_SET_GAP', 0)
+
+    @classmethod
+    def is_dense(cls):
+        """Whether lft/rgt values have no gaps, so sizes of subtrees follow from the bounds."""
+        return not cls.get_gap()
+
     @classmethod
+    @dispatch
+    @atomic
     def create(cls, name, parent_node):
         cls.validate_name(name)
-        tree_id = parent_node.tree_id
+        gap = cls.get_gap()
         with get_db_conn().cursor() as cur:
-            cur.execute('UPDATE node SET rgt = rgt + 2 WHERE rgt >= %s', (parent_node.rgt,))
-            cur.execute('UPDATE node SET lft = lft + 2 WHERE lft > %s', (parent_node.rgt,))
+            parent_node = cls._lock_trees(cur, parent_node)[0]
+            if parent_node is None:
+                raise ValueError('Parent node does not exist')
+            if parent_node.is_root:
+                # a top-level node starts a new tree with its own numbering
+                lft, rgt, tree_id = 1, 1 + max(gap, 1), None
+            else:
+                lft, stop = parent_node._open_gap(cur, 2)
+                # leave the rest of the free space to next siblings
+                rgt, tree_id = lft + max(1, min(gap, (stop - lft) // 2)), parent_node.tree_id
             try:
                 cur.execute(
                     'INSERT INTO node (name, parent_id, lft, rgt, tree_id) VALUES (%s, %s, %s, %s, %s) RETURNING id',
-                    (name, parent_node.id, parent_node.rgt, parent_node.rgt + 1, tree_id)
+                    (name, parent_node.id, lft, rgt, tree_id)
                 )
             except psycopg2.errors.UniqueViolation:
                 raise ValueError('Names should be unique within a tree')
             node_id = cur.fetchone()[0]
             if tree_id is None:
-                cur.execute('UPDATE node SET tree_id = %s WHERE id = %s', (node_id, node_id,))
+                cur.execute('UPDATE node SET tree_id = %s WHERE id = %s AND tree_id IS NULL', (node_id, node_id,))
                 tree_id = node_id
-        get_db_conn().commit()
-        return cls(node_id, name, parent_node.id, parent_node.rgt, parent_node.rgt + 1, tree_id)
+            cls._bump_versions(cur, tree_id)
+        log_change('create', node_id, parent_node._item_id(), name)
+        return cls(node_id, name, parent_node.id, lft, rgt, tree_id)
+
+    @classmethod
+    @dispatch
+    @atomic
+    def bulk_create(cls, rows, parent_node):
+        """
+        Create nodes under parent_node from (name, parent_row) rows, where parent_row is an index
+        of a previous row or None. Bounds are computed in one pass, the parent's interval
+        is opened once and rows are loaded with COPY in one transaction.
+        Returns ids of the created nodes in row order.
+        """
+        errors = []
+        # new trees are identified by their top-level rows, None is the tree of parent_node
+        trees = []
+        names = set()
+        for row, (name, parent_row) in enumerate(rows):
+            if parent_row is not None:
+                trees.append(trees[parent_row])
+            else:
+                trees.append(row if parent_node.is_root else None)
+            try:
+                cls.validate_name(name)
+            except ValueError as e:
+                errors.append({'row': row, 'message': str(e)})
+                continue
+            if (trees[row], name) in names:
+                errors.append({'row': row, 'message': 'Names should be unique within a tree'})
+            names.add((trees[row], name))
+
+        with get_db_conn().cursor() as cur:
+            parent_node = cls._lock_trees(cur, parent_node)[0]
+            if parent_node is None:
+                raise ValueError('Parent node does not exist')
+            if not parent_node.is_root:
+                cur.execute(
+                    'SELECT name FROM node WHERE tree_id = %s AND name = ANY(%s)',
+                    (parent_node.tree_id, [name for name, _ in rows])
+                )
+                existing = {res[0] for res in cur.fetchall()}
+                invalid = {e['row'] for e in errors}
+                errors += [
+                    {'row': row, 'message': 'Names should be unique within a tree'}
+                    for row, (name, _) in enumerate(rows) if name in existing and row not in invalid
+                ]
+            if errors:
+                raise BulkError(sorted(errors, key=lambda e: e['row']))
+            if not rows:
+                return []
+
+            cur.execute(
+                "SELECT nextval(pg_get_serial_sequence('node', 'id')) FROM generate_series(1, %s)",
+                (len(rows),)
+            )
+            ids = [res[0] for res in cur.fetchall()]
+            children = [[] for _ in rows]
+            top_rows = []
+            for row, (_, parent_row) in enumerate(rows):
+                (children[parent_row] if parent_row is not None else top_rows).append(row)
 
+            gap = cls.get_gap()
+            if parent_node.is_root:
+                start, step = 1, max(gap, 1)
+            else:
+                start, stop = parent_node._open_gap(cur, 2 * len(rows))
+                # leave the rest of the free space to next siblings
+                step = max(1, min(gap, (stop - start) // (4 * len(rows))))
+
+            # rows in preorder, so parents are loaded before their children
+            values = []
+            pos = start - step
+            for top_row in top_rows:
+                if parent_node.is_root:
+                    # every top-level row starts a new tree
+                    pos, tree_id = start - step, ids[top_row]
+                else:
+                    tree_id = parent_node.tree_id
+                pos += step
+                stack = [(top_row, len(values), iter(children[top_row]))]
+                values.append([ids[top_row], parent_node.id, rows[top_row][0], pos, None, tree_id])
+                while stack:
+                    row, index, it = stack[-1]
+                    child = next(it, None)
+                    pos += step
+                    if child is None:
+                        stack.pop()
+                        values[index][4] = pos
+                    else:
+                        stack.append((child, len(values), iter(children[child])))
+                        values.append([ids[child], ids[row], rows[child][0], pos, None, tree_id])
+
+            buf = io.StringIO()
+            csv.writer(buf).writerows(values)
+            buf.seek(0)
+            try:
+                cur.copy_expert(
+                    'COPY node (id, parent_id, name, lft, rgt, tree_id) FROM STDIN WITH (FORMAT csv)', buf
+                )
+            except psycopg2.errors.UniqueViolation:
+                raise ValueError('Names should be unique within a tree')
+            if parent_node.is_root:
+                cls._bump_versions(cur, *(ids[row] for row in top_rows))
+            else:
+                cls._bump_versions(cur, parent_node.tree_id)
+        # parents are created before their children
+        for id, parent_id, name, *_ in values:
+            log_change('create', id, parent_id if parent_id != parent_node.id else parent_node._item_id(), name)
+        return ids
+
+    @atomic
     def rename(self, new_name):
         self.validate_name(new_name)
         with get_db_conn().cursor() as cur:
+            node = self._lock_trees(cur, self)[0]
+            if node is None:
+                raise ValueError('Node does not exist')
             try:
-                cur.execute('UPDATE node SET name = %s WHERE id = %s', (new_name, self.id))
+                cur.execute('UPDATE node SET name = %s WHERE id = %s AND tree_id = %s', (new_name, node.id, node.tree_id))
             except psycopg2.errors.UniqueViolation:
                 raise ValueError('Names should be unique within a tree')
-        get_db_conn().commit()
-        return replace(self, name=new_name)
+            record_change(node.tree_id, node.lft, node.lft + 1)
+            self._bump_versions(cur, node.tree_id)
+        log_change('rename', node.id, name=new_name)
+        return replace(node, name=new_name)
     
+    @atomic
     def delete(self):
         with get_db_conn().cursor() as cur:
-            cur.execute('DELETE FROM node WHERE lft BETWEEN %s AND %s', (self.lft, self.rgt))
-            cur.execute('UPDATE node SET lft = lft - %s WHERE lft > %s', (self._diff, self.rgt))
-            cur.execute('UPDATE node SET rgt = rgt - %s WHERE rgt > %s', (self._diff, self.rgt))
-        get_db_conn().commit()
+            node = self._lock_trees(cur, self)[0]
+            # already deleted with an ancestor
+            if node is None:
+                return
+            node._delete_subtree(cur)
+            self._bump_versions(cur, node.tree_id)
+        log_change('delete', node.id)
+
+    def _delete_subtree(self, cur):
+        cur.execute(
+            'DELETE FROM node WHERE tree_id = %s AND lft BETWEEN %s AND %s',
+            (self.tree_id, self.lft, self.rgt)
+        )
+        if self.tree_id == self.id:
+            # the whole tree is gone
+            cur.execute('DELETE FROM tree_gap WHERE tree_id = %s', (self.tree_id,))
+        elif current_app.config.get('DEFERRED_DELETE'):
+            # dense trees are compacted later by renumber_tree
+            if not self.get_gap():
+                self._add_gap(cur, self.tree_id, self._diff)
+            record_change(self.tree_id, self.lft, self.rgt + 1)
+        # sparse numbering keeps the gap for future inserts
+        elif not self.get_gap():
+            self._close_gap(cur)
+        else:
+            record_change(self.tree_id, self.lft, self.rgt + 1)
+
+    @staticmethod
+    def _add_gap(cur, tree_id, positions):
+        """Count positions of a dense tree left unused by deferred deletes."""
+        cur.execute(
+            'INSERT INTO tree_gap (tree_id, positions) VALUES (%s, %s) '
+            'ON CONFLICT (tree_id) DO UPDATE SET positions = tree_gap.positions + EXCLUDED.positions',
+            (tree_id, positions)
+        )
+
+    @staticmethod
+    def get_gap_stats():
+        """Number of dense trees with positions left by deferred deletes and the total of these positions."""
+        with get_db_conn().cursor() as cur:
+            cur.execute('SELECT count(*), coalesce(sum(positions), 0) FROM tree_gap WHERE positions > 0')
+            trees, positions = cur.fetchone()
+        return {'trees': trees, 'positions': positions}
+
+    @staticmethod
+    def get_gap_tree_ids():
+        """Trees with positions left by deferred deletes, the ones with the most of them first."""
+        with get_db_conn().cursor() as cur:
+            cur.execute('SELECT tree_id FROM tree_gap WHERE positions > 0 ORDER BY positions DESC, tree_id')
+            return [res[0] for res in cur.fetchall()]
+
+    @classmethod
+    @atomic
+    def renumber_tree(cls, tree_id):
+        """
+        Compute nested set bounds of the tree from parent links, siblings keep their lft order.
+        Trees written with AdjacencyListNode need it before they are read as nested sets,
+        dense trees are compacted with it after deferred deletes. Returns the number of nodes of the tree.
+        """
+        step = max(cls.get_gap(), 1)
+        with get_db_conn().cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute('SELECT pg_advisory_xact_lock(%s, %s)', (TREE_LOCK, tree_id))
+            cur.execute('SELECT id, parent_id FROM node WHERE tree_id = %s ORDER BY lft, id', (tree_id,))
+            children = {}
+            for id, parent_id in cur.fetchall():
+                children.setdefault(parent_id, []).append(id)
+
+            pos = 1
+            values = [[tree_id, pos, None]]
+            stack = [(0, iter(children.get(tree_id, ())))]
+            while stack:
+                index, it = stack[-1]
+                child = next(it, None)
+                pos += step
+                if child is None:
+                    stack.pop()
+                    values[index][2] = pos
+                else:
+                    stack.append((len(values), iter(children.get(child, ()))))
+                    values.append([child, pos, None])
+
+            scope = cur.mogrify('node.tree_id = %s', (tree_id,)).decode()
+            psycopg2.extras.execute_values(
+                cur,
+                f'UPDATE node SET lft = v.lft, rgt = v.rgt FROM (VALUES %s) AS v (id, lft, rgt) WHERE node.id = v.id AND {scope}',
+                values,
+                page_size=1000
+            )
+            cur.execute('DELETE FROM tree_gap WHERE tree_id = %s', (tree_id,))
+            cls._bump_versions(cur, tree_id)
+        return len(values)
+
+    def get_version(self):
+        """
+        Version of the node's tree, every write to the tree changes it.
+        Versions come from one sequence, so the greatest one is the version of the whole hierarchy.
+        """
+        with get_db_conn().cursor() as cur:
+            if self.is_root:
+                cur.execute('SELECT max(version) FROM tree_version')
+            else:
+                cur.execute('SELECT version FROM tree_version WHERE tree_id = %s', (self.tree_id,))
+            res = cur.fetchone()
+        # trees without writes yet have no version
+        if res is None or res[0] is None:
+            return 0
+        return res[0]
+
+    @classmethod
+    def _lock_trees(cls, cur, *nodes):
+        """
+        Lock trees of the nodes until the end of the transaction and return current state
+        of the nodes (None for deleted ones). Writers of one tree wait for each other,
+        writers of different trees proceed in parallel.
+        """
+        ids = [node.id for node in nodes]
+        before = cls._read_nodes(cur, ids)
+        # a fixed order, so that writers of several trees do not deadlock
+        for tree_id in sorted({node.tree_id for node in before if node is not None and node.tree_id is not None}):
+            cur.execute('SELECT pg_advisory_xact_lock(%s, %s)', (TREE_LOCK, tree_id))
+        after = cls._read_nodes(cur, ids)
+        if [node and node.tree_id for node in before] != [node and node.tree_id for node in after]:
+            # a node was moved to another tree before the lock was taken
+            raise TransactionConflict('Tree of the node has changed')
+        return after
+
+    @classmethod
+    def _read_nodes(cls, cur, ids):
+        cur.execute('SELECT * FROM node WHERE id = ANY(%s)', (ids,))
+        nodes = {res['id']: cls(**res) for res in cur.fetchall()}
+        return [nodes.get(id) for id in ids]
+
+    @staticmethod
+    def _bump_versions(cur, *tree_ids):
+        cur.execute(
+            'WITH t AS (SELECT DISTINCT unnest(%s::integer[]) AS id), '
+            'old AS (SELECT tree_id, version FROM tree_version WHERE tree_id IN (SELECT id FROM t)) '
+            "INSERT INTO tree_version (tree_id, version) SELECT id, nextval('tree_version_seq') FROM t "
+            'ON CONFLICT (tree_id) DO UPDATE SET version = EXCLUDED.version '
+            'RETURNING tree_id, (SELECT version FROM old WHERE old.tree_id = tree_version.tree_id), version',
+            (list(tree_ids),)
+        )
+        publish_versions({tree_id: (previous, version) for tree_id, previous, version in cur.fetchall()})
+
+    @property
+    def is_root(self):
+        return self.id == self.get_root_id()
 
     @property
     def _diff(self):
         return self.rgt - self.lft + 1
 
+    def _open_gap(self, cur, width):
+        """
+        Free at least `width` positions at the end of the node's interval.
+        Returns (start, stop) bounds of the free space.
+        """
+        if not self.get_gap():
+            cur.execute(
+                'UPDATE node SET rgt = rgt + %s WHERE tree_id = %s AND rgt >= %s',
+                (width, self.tree_id, self.rgt)
+            )
+            cur.execute(
+                'UPDATE node SET lft = lft + %s WHERE tree_id = %s AND lft > %s',
+                (width, self.tree_id, self.rgt)
+            )
+            record_change(self.tree_id, self.rgt, self.rgt, width)
+            return self.rgt, self.rgt + width
+
+        start, stop = self._get_free_tail(cur)
+        if stop - start < width:
+            self._renumber(cur, width)
+            start, stop = self._get_free_tail(cur)
+        record_change(self.tree_id, start, stop)
+        return start, stop
+
+    def _get_free_tail(self, cur):
+        cur.execute(
+            'SELECT coalesce(max(c.rgt), p.lft) + 1, p.rgt '
+            'FROM node p LEFT JOIN node c ON c.parent_id = p.id AND c.tree_id = %(tree_id)s '
+            'WHERE p.id = %(id)s AND p.tree_id = %(tree_id)s GROUP BY p.lft, p.rgt',
+            {'id': self.id, 'tree_id': self.tree_id}
+        )
+        return cur.fetchone()
+
+    def _renumber(self, cur, width):
+        """
+        Spread the subtree of the nearest ancestor (or the node itself) that has enough space
+        reserving `width` positions at the end of the node's interval.
+        The whole tree is spread and grown if none of the ancestors fits.
+        """
+        cur.execute(
+            'SELECT id, lft, rgt FROM node WHERE tree_id = %s AND lft <= %s AND rgt >= %s ORDER BY lft DESC',
+            (self.tree_id, self.lft, self.rgt)
+        )
+        for anchor_id, lft, rgt in cur.fetchall():
+            rows = self._get_descendant_bounds(cur, lft, rgt, self.tree_id)
+            step = (rgt - lft - width) // (2 * len(rows) + 1)
+            if step >= MIN_STEP:
+                grow = False
+                break
+        else:
+            step = max(self.get_gap(), MIN_STEP)
+            grow = True
+
+        bounds = sorted([(r_lft, id, 0) for id, r_lft, _ in rows] + [(r_rgt, id, 1) for id, _, r_rgt in rows])
+        new_bounds = {}
+        pos = lft
+        for _, id, side in bounds:
+            pos += step
+            if side == 1 and id == self.id:
+                pos += width
+            new_bounds.setdefault(id, [id, None, None, self.tree_id])[1 + side] = pos
+        if anchor_id == self.id:
+            pos += width
+        if grow:
+            new_bounds[anchor_id] = [anchor_id, lft, pos + step, self.tree_id]
+        self._update_bounds(cur, new_bounds.values(), self.tree_id, lft, rgt)
+        record_change(self.tree_id, lft, rgt + 1, pos + step - rgt if grow else 0)
+
+    @staticmethod
+    def _get_descendant_bounds(cur, lft, rgt, tree_id):
+        cur.execute(
+            'SELECT id, lft, rgt FROM node WHERE tree_id = %s AND lft > %s AND rgt < %s',
+            (tree_id, lft, rgt)
+        )
+        return cur.fetchall()
+
+    @staticmethod
+    def _update_bounds(cur, values, tree_id, lft, rgt):
+        """Set (id, lft, rgt, tree_id) values of nodes, all of them lie within lft and rgt of the tree."""
+        # the range lets the planner use an index instead of joining with the whole table
+        scope = cur.mogrify('node.tree_id = %s AND node.lft BETWEEN %s AND %s', (tree_id, lft, rgt)).decode()
+        psycopg2.extras.execute_values(
+            cur,
+            'UPDATE node SET lft = v.lft, rgt = v.rgt, tree_id = v.tree_id '
+            f'FROM (VALUES %s) AS v (id, lft, rgt, tree_id) WHERE node.id = v.id AND {scope}',
+            list(values),
+            page_size=1000
+        )
+
+    def _close_gap(self, cur):
+        cur.execute(
+            'UPDATE node SET lft = lft - %s WHERE tree_id = %s AND lft > %s',
+            (self._diff, self.tree_id, self.rgt)
+        )
+        cur.execute(
+            'UPDATE node SET rgt = rgt - %s WHERE tree_id = %s AND rgt > %s',
+            (self._diff, self.tree_id, self.rgt)
+        )
+        record_change(self.tree_id, self.lft, self.rgt + 1, -self._diff)
+
+    @atomic
     def move(self, parent_node):
+        with get_db_conn().cursor() as cur:
+            node, parent_node = self._lock_trees(cur, self, parent_node)
+            if node is None or parent_node is None:
+                raise ValueError('Node does not exist')
+            return node._move(cur, parent_node)
+
+    def _move(self, cur, parent_node):
         if self.id == parent_node.id:
             raise ValueError('Cannot move under itself')
         
-        if self.lft < parent_node.lft < self.rgt:
+        if self._contains(parent_node):
             raise ValueError('Cannot move under a child')
 
-        tree_id = parent_node.tree_id
-        if tree_id is None:
+        if parent_node.is_root:
+            if self.parent_id == parent_node.id:
+                return self
+            # the subtree becomes a new tree
             tree_id = self.id
+        else:
+            tree_id = parent_node.tree_id
+
+        try:
+            lft, rgt = self._place(cur, parent_node, tree_id)
+        except psycopg2.errors.UniqueViolation:
+            raise ValueError('Names should be unique within a tree')
+        # after relocation, so the node is not taken for a child occupying the parent's free space
+        cur.execute('UPDATE node SET parent_id = %s WHERE id = %s AND tree_id = %s', (parent_node.id, self.id, tree_id))
+        self._bump_versions(cur, self.tree_id, tree_id)
+        log_change('move', self.id, parent_node._item_id())
+        return replace(self, parent_id=parent_node.id, lft=lft, rgt=rgt, tree_id=tree_id)
+
+    def _contains(self, node):
+        """Whether the node is a descendant."""
+        return self.tree_id == node.tree_id and self.lft < node.lft < self.rgt
 
+    def _place(self, cur, parent_node, tree_id):
+        """Give the subtree new bounds at the end of the parent's interval, returns its lft and rgt."""
+        if self.get_gap():
+            return self._relocate(cur, parent_node, tree_id)
+        if tree_id == self.tree_id:
+            return self._move_within_tree(cur, parent_node)
+        return self._move_to_tree(cur, parent_node, tree_id)
+
+    @atomic
+    def copy(self, parent_node, on_conflict='error'):
+        """
+        Copy the subtree under parent_node with one INSERT ... SELECT after opening the parent's interval once.
+        Bounds of the copy are ranks of the source bounds times the step of the destination, so source
+        and destination can share a tree (the copy can even go under the source itself).
+        """
+        if on_conflict not in COPY_POLICIES:
+            raise ValueError(f'on_conflict should be one of: {", ".join(COPY_POLICIES)}')
         with get_db_conn().cursor() as cur:
-            cur.execute('UPDATE node SET parent_id = %s WHERE id = %s', (parent_node.id, self.id))
-            # temporary remove subtree, update tree_id
+            node, parent_node = self._lock_trees(cur, self, parent_node)
+            if node is None or parent_node is None:
+                raise ValueError('Node does not exist')
+            if node.is_root:
+                raise ValueError('Cannot copy the root')
+
+            cur.execute(f'SELECT count(*) FROM ({node._get_subtree_nodes_query()}) AS c', {'id': node.id})
+            count = cur.fetchone()[0]
+            suffix = node._get_copy_suffix(cur, parent_node, on_conflict)
+
+            gap = self.get_gap()
+            if parent_node.is_root:
+                start, step, tree_id = 1, max(gap, 1), None
+            else:
+                start, stop = parent_node._open_gap(cur, 2 * count)
+                # leave the rest of the free space to next siblings
+                step, tree_id = max(1, min(gap, (stop - start) // (4 * count))), parent_node.tree_id
+
+            # source bounds are read again, opening the gap could shift them
             try:
                 cur.execute(
-                    'UPDATE node SET tree_id = %s, lft = -lft, rgt = -rgt WHERE lft BETWEEN %s AND %s',
-                    (tree_id, self.lft, self.rgt)
+                    'WITH src AS ('
+                    "    SELECT c.id, c.parent_id, c.name, c.lft, c.rgt, nextval(pg_get_serial_sequence('node', 'id')) AS new_id "
+                    f'    FROM ({node._get_subtree_nodes_query()}) AS c'
+                    '), ranks AS ('
+                    '    SELECT bound, row_number() OVER (ORDER BY bound) - 1 AS rank '
+                    '    FROM (SELECT DISTINCT bound FROM src, LATERAL (VALUES (lft), (rgt)) AS b (bound)) AS b'
+                    ') '
+                    'INSERT INTO node (id, parent_id, name, lft, rgt, tree_id) '
+                    'SELECT s.new_id, coalesce(p.new_id, %(parent_id)s), s.name || %(suffix)s, '
+                    '    %(start)s + l.rank * %(step)s, %(start)s + r.rank * %(step)s, '
+                    '    coalesce(%(tree_id)s, (SELECT new_id FROM src WHERE id = %(id)s)) '
+                    'FROM src s LEFT JOIN src p ON p.id = s.parent_id '
+                    'JOIN ranks l ON l.bound = s.lft JOIN ranks r ON r.bound = s.rgt '
+                    'RETURNING id, parent_id, name, lft, rgt, tree_id',
+                    {
+                        'id': node.id, 'parent_id': parent_node.id, 'suffix': suffix,
+                        'start': start, 'step': step, 'tree_id': tree_id,
+                    }
                 )
             except psycopg2.errors.UniqueViolation:
                 raise ValueError('Names should be unique within a tree')
-            # shift right
-            cur.execute('UPDATE node SET rgt = rgt + %s WHERE rgt >= %s', (self._diff, parent_node.rgt))
-            cur.execute('UPDATE node SET lft = lft + %s WHERE lft > %s', (self._diff, parent_node.rgt))
-            # place subtree
+            rows = sorted(cur.fetchall(), key=lambda res: res['lft'])
+            self._bump_versions(cur, rows[0]['tree_id'])
+        for res in rows:
+            log_change(
+                'create', res['id'],
+                res['parent_id'] if res['parent_id'] != parent_node.id else parent_node._item_id(), res['name']
+            )
+        return self.__class__(**rows[0])
+
+    @staticmethod
+    def _get_subtree_nodes_query():
+        """Rows of a node and its descendants, the node's id is the %(id)s parameter."""
+        return (
+            'SELECT c.* FROM node s JOIN node c ON c.tree_id = s.tree_id AND c.lft >= s.lft AND c.lft <= s.rgt '
+            'WHERE s.id = %(id)s'
+        )
+
+    def _get_copy_suffix(self, cur, parent_node, on_conflict):
+        """Suffix of copied names which keeps names unique within the destination tree."""
+        # a new tree has only the copied names, which are already unique
+        if parent_node.is_root:
+            return ''
+        for suffix in COPY_SUFFIXES if on_conflict == 'rename' else COPY_SUFFIXES[:1]:
             cur.execute(
-                'UPDATE node SET lft = - lft + %s, rgt = - rgt + %s WHERE lft BETWEEN %s AND %s',
-                (parent_node.rgt - self.lft, parent_node.rgt - self.lft, -self.rgt, -self.lft)
-            )
-            # shift left
-            cur.execute('UPDATE node SET rgt = rgt - %s WHERE rgt > %s', (self._diff, self.rgt))
-            cur.execute('UPDATE node SET lft = lft - %s WHERE lft > %s', (self._diff, self.rgt))
-
-        get_db_conn().commit()
-        return replace(self, parent_id=parent_node.id, tree_id=tree_id)
-
-    def get_subtree(self):
-        subtree_rows = self._get_subtree_rows()
-        children = [[] for _ in range(len(subtree_rows))]
-        parent_index = 0
-        # track previous parent_index
-        stack = [(self.rgt, None)]
-        for i, row in enumerate(self._get_subtree_rows()[1:], 1):
-            while row['rgt'] > stack[-1][0]:
-                # level up
-                _, parent_index = stack.pop()
-            
-            children[parent_index].append({
-                'id': row['id'],
-                'name': row['name'],
-                'parent_id': row['parent_id'] if row['parent_id'] != self.get_root_id() else None,
-                'children': children[i]
-            })
-
-            stack.append((row['rgt'], parent_index))
-            parent_index = i
+                f'SELECT EXISTS (SELECT 1 FROM ({self._get_subtree_nodes_query()}) AS c '
+                'JOIN node d ON d.tree_id = %(tree_id)s AND d.name = c.name || %(suffix)s)',
+                {'id': self.id, 'tree_id': parent_node.tree_id, 'suffix': suffix}
+            )
+            if not cur.fetchone()[0]:
+                return suffix
+        raise ValueError('Names should be unique within a tree')
 
-        return {
-            **self.to_item(),
-            'children': children[0]
-        }
-    
-    def _get_subtree_rows(self):
-        with get_db_conn().cursor() as cur:
+    def _move_within_tree(self, cur, parent_node):
+        """
+        Move the subtree to the end of the parent's interval with one UPDATE. Only the subtree
+        and the band of values between its old and new position change, the band is shifted
+        by the width of the subtree to make room for it.
+        """
+        if parent_node.rgt > self.rgt:
+            # to the right: the band closes the space left by the subtree
+            lo, hi, band_shift = self.rgt + 1, parent_node.rgt - 1, -self._diff
+            lft = parent_node.rgt - self._diff
+        else:
+            lo, hi, band_shift = parent_node.rgt, self.lft - 1, self._diff
+            lft = parent_node.rgt
+        shift = lft - self.lft
+        start, stop = min(lo, self.lft), max(hi, self.rgt)
+        cur.execute(
+            'UPDATE node SET '
+            'lft = lft + CASE WHEN lft BETWEEN %(lft)s AND %(rgt)s THEN %(shift)s '
+            'WHEN lft BETWEEN %(lo)s AND %(hi)s THEN %(band_shift)s ELSE 0 END, '
+            'rgt = rgt + CASE WHEN rgt BETWEEN %(lft)s AND %(rgt)s THEN %(shift)s '
+            'WHEN rgt BETWEEN %(lo)s AND %(hi)s THEN %(band_shift)s ELSE 0 END '
+            'WHERE tree_id = %(tree_id)s AND (lft BETWEEN %(start)s AND %(stop)s OR rgt BETWEEN %(start)s AND %(stop)s)',
+            {
+                'lft': self.lft, 'rgt': self.rgt, 'shift': shift, 'lo': lo, 'hi': hi, 'band_shift': band_shift,
+                'tree_id': self.tree_id, 'start': start, 'stop': stop,
+            }
+        )
+        record_change(self.tree_id, start, stop + 1)
+        return lft, lft + self._diff - 1
+
+    def _move_to_tree(self, cur, parent_node, tree_id):
+        if parent_node.is_root:
+            lft = 1
+        else:
+            lft, _ = parent_node._open_gap(cur, self._diff)
+        # positions left by deferred deletes within the subtree go with it
+        cur.execute('SELECT positions FROM tree_gap WHERE tree_id = %s AND positions > 0', (self.tree_id,))
+        if cur.fetchone() is not None:
             cur.execute(
-                    'SELECT * FROM node WHERE lft >= %s and rgt <= %s ORDER BY lft ASC',
-                    (self.lft, self.rgt)
+                'SELECT count(*) FROM node WHERE tree_id = %s AND lft BETWEEN %s AND %s',
+                (self.tree_id, self.lft, self.rgt)
             )
+            inner_gap = self._diff - 2 * cur.fetchone()[0]
+            if inner_gap:
+                self._add_gap(cur, self.tree_id, -inner_gap)
+                self._add_gap(cur, tree_id, inner_gap)
+        cur.execute(
+            'UPDATE node SET tree_id = %s, lft = lft + %s, rgt = rgt + %s '
+            'WHERE tree_id = %s AND lft BETWEEN %s AND %s',
+            (tree_id, lft - self.lft, lft - self.lft, self.tree_id, self.lft, self.rgt)
+        )
+        # close the gap in the source tree
+        self._close_gap(cur)
+        return lft, lft + self._diff - 1
+
+    def _relocate(self, cur, parent_node, tree_id):
+        """Move the subtree into free space of the parent without shifting other nodes."""
+        cur.execute(
+            'SELECT count(*) FROM node WHERE tree_id = %s AND lft BETWEEN %s AND %s',
+            (self.tree_id, self.lft, self.rgt)
+        )
+        size = cur.fetchone()[0]
+        if parent_node.is_root:
+            start, step = 1, max(self.get_gap(), 1)
+        else:
+            start, stop = parent_node._open_gap(cur, 2 * size)
+            # leave the rest of the free space to next siblings
+            step = max(1, min(self.get_gap(), (stop - start) // (4 * size)))
+
+        # renumbering could have spread the subtree
+        cur.execute('SELECT lft, rgt FROM node WHERE id = %s AND tree_id = %s', (self.id, self.tree_id))
+        lft, rgt = cur.fetchone()
+        rows = [(self.id, lft, rgt)] + self._get_descendant_bounds(cur, lft, rgt, self.tree_id)
+        bounds = sorted([(r_lft, id, 0) for id, r_lft, _ in rows] + [(r_rgt, id, 1) for id, _, r_rgt in rows])
+        new_bounds = {}
+        for i, (_, id, side) in enumerate(bounds):
+            new_bounds.setdefault(id, [id, None, None, tree_id])[1 + side] = start + i * step
+        self._update_bounds(cur, new_bounds.values(), self.tree_id, lft, rgt)
+        record_change(self.tree_id, lft, rgt + 1)
+        if not parent_node.is_root:
+            record_change(tree_id, start, stop)
+        return new_bounds[self.id][1:3]
+
+    def get_subtree(self, max_depth=None, version=None):
+        """
+        Nested subtree of the node, without descendants deeper than max_depth below it.
+        With a version the replica is used only if it has loaded the tree at least at that version.
+        """
+        root_id = self.get_root_id()
+        subtree = {**self._item(), 'children': []}
+        # children lists of open nodes, the subtree root is never closed
+        stack = [(self.tree_id, self.rgt, subtree['children'])]
+        for id, name, parent_id, tree_id, rgt in self._get_subtree_rows(version):
+            # rows of the root subtree come tree by tree
+            while len(stack) > 1 and (tree_id != stack[-1][0] or rgt >= stack[-1][1]):
+                # level up
+                stack.pop()
+
+            children = []
+            # the depth of the row is the number of its open ancestors
+            if max_depth is None or len(stack) - self.is_root <= max_depth:
+                stack[-1][2].append({
+                    'id': id,
+                    'name': name,
+                    'parent_id': parent_id if parent_id != root_id else None,
+                    'children': children
+                })
+            stack.append((tree_id, rgt, children))
+
+        return subtree
+
+    def get_subtree_columns(self, max_depth=None, version=None):
+        """
+        Subtree as parallel lists of ids, parent ids, depths and names in lft order, starting
+        with the node itself unless it is the root (top-level items have depth 0).
+        """
+        root_id = self.get_root_id()
+        ids, parent_ids, depths, names = [], [], [], []
+        if not self.is_root:
+            ids.append(self.id)
+            parent_ids.append(self._item()['parent_id'])
+            depths.append(0)
+            names.append(self.name)
+        # open nodes, the subtree root is never closed
+        stack = [(self.tree_id, self.rgt)]
+        for id, name, parent_id, tree_id, rgt in self._get_subtree_rows(version):
+            while len(stack) > 1 and (tree_id != stack[-1][0] or rgt >= stack[-1][1]):
+                stack.pop()
+            depth = len(stack) - self.is_root
+            if max_depth is None or depth <= max_depth:
+                ids.append(id)
+                parent_ids.append(parent_id if parent_id != root_id else None)
+                depths.append(depth)
+                names.append(name)
+            stack.append((tree_id, rgt))
+        return {'ids': ids, 'parent_ids': parent_ids, 'depths': depths, 'names': names}
+
+    def has_position(self, tree_id, lft):
+        """Whether a (tree_id, lft) position of get_subtree_page state is in the node's subtree."""
+        return self.is_root or (tree_id == self.tree_id and self.lft <= lft < self.rgt)
+
+    def get_subtree_page(self, limit, after=None, max_depth=None):
+        """
+        Up to `limit` items of the subtree in lft order with their depth below the node
+        (top-level items of the hierarchy have depth 0). Rows are read with a server-side cursor
+        starting after the previous page, whose state is (tree_id, lft, rgts of open ancestors)
+        of its last item. Returns the items and the state of the page or None if it is the last one.
+        """
+        root_id = self.get_root_id()
+        items = []
+        # open nodes, the subtree root is never closed
+        stack = [(self.tree_id, self.rgt)]
+        if after is None:
+            if not self.is_root:
+                items.append({**self._item(), 'depth': 0})
+            state = (self.tree_id, self.lft, [])
+            position = None
+        else:
+            tree_id, lft, rgts = state = after
+            stack += [(tree_id, rgt) for rgt in rgts]
+            position = (tree_id, lft)
+
+        with closing(self._iter_subtree_rows(f'{SUBTREE_COLUMNS}, lft', position, limit + 1)) as rows:
+            for id, name, parent_id, tree_id, rgt, lft in rows:
+                while len(stack) > 1 and (tree_id != stack[-1][0] or rgt >= stack[-1][1]):
+                    stack.pop()
+
+                depth = len(stack) - self.is_root
+                if max_depth is None or depth <= max_depth:
+                    # one more item shows that the page is not the last one
+                    if len(items) == limit:
+                        return items, state
+                    items.append({
+                        'id': id,
+                        'name': name,
+                        'parent_id': parent_id if parent_id != root_id else None,
+                        'depth': depth,
+                    })
+                    state = (tree_id, lft, [rgt for _, rgt in stack[1:]] + [rgt])
+                stack.append((tree_id, rgt))
+        return items, None
+    
+    def _get_subtree_rows(self, version=None):
+        """Descendants of the node in lft order."""
+        replica = get_replica()
+        rows = replica and replica.get_subtree_rows(self, version)
+        if rows is not None:
+            return rows
+        with get_db_conn().cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute(*self._get_subtree_query(SUBTREE_COLUMNS))
             res = cur.fetchall()
         return res
 
+    def _get_subtree_query(self, columns, after=None):
+        """
+        Descendants of the node in lft order, after a (tree_id, lft) position if given.
+        Descendants are bounded by lft only, so the whole range comes from the (tree_id, lft) index.
+        """
+        if self.is_root:
+            if after is None:
+                return (
+                    f'SELECT {columns} FROM node WHERE tree_id IS NOT NULL ORDER BY tree_id, lft ASC',
+                    ()
+                )
+            return (
+                f'SELECT {columns} FROM node WHERE tree_id IS NOT NULL AND (tree_id, lft) > (%s, %s) '
+                'ORDER BY tree_id, lft ASC',
+                after
+            )
+        return (
+            f'SELECT {columns} FROM node WHERE tree_id = %s AND lft > %s and lft < %s ORDER BY lft ASC',
+            (self.tree_id, self.lft if after is None else after[1], self.rgt)
+        )
+
+    def stream_subtree(self, children_only=False, max_depth=None):
+        """
+        Subtree as chunks of JSON. Rows are read with a server-side cursor in lft order,
+        so memory is bounded by the depth of the tree rather than its size.
+        """
+        chunk = ['['] if children_only else [self._item_json(self.id, self.name, self.parent_id)]
+        # open nodes, the subtree root is never closed
+        stack = [(self.tree_id, self.rgt)]
+        first_child = True
+        for id, name, parent_id, tree_id, rgt in self._iter_subtree_rows():
+            # rows of the root subtree come tree by tree
+            while len(stack) > 1 and (tree_id != stack[-1][0] or rgt >= stack[-1][1]):
+                stack.pop()
+                # nodes deeper than max_depth are not written
+                if max_depth is None or len(stack) - self.is_root <= max_depth:
+                    chunk.append(']}')
+                    first_child = False
+            if max_depth is None or len(stack) - self.is_root <= max_depth:
+                if not first_child:
+                    chunk.append(',')
+                chunk.append(self._item_json(id, name, parent_id))
+                first_child = True
+            stack.append((tree_id, rgt))
+
+            if len(chunk) >= STREAM_CHUNK_ITEMS:
+                yield ''.join(chunk)
+                chunk = []
+
+        open_items = len(stack) - 1
+        if max_depth is not None:
+            open_items = min(open_items, max_depth + self.is_root)
+        chunk.append(']}' * open_items)
+        chunk.append(']' if children_only else ']}')
+        yield ''.join(chunk)
+
+    def _item_json(self, id, name, parent_id):
+        """Opening part of a subtree node, up to the list of children."""
+        if parent_id == self.get_root_id():
+            parent_id = None
+        return f'{{"id": {id}, "name": {json.dumps(name)}, "parent_id": {json.dumps(parent_id)}, "children": ['
+
+    def _iter_subtree_rows(self, columns=SUBTREE_COLUMNS, after=None, itersize=STREAM_CHUNK_ITEMS):
+        with get_db_conn().cursor(f'subtree_{self.id}', cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = itersize
+            cur.execute(*self._get_subtree_query(columns, after))
+            yield from cur
+
     @classmethod
     def get_hierarchy(cls):
-        return cls.get_root_node().get_subtree()['children']
\ No newline at end of file
+        return cls.get_root_node().get_subtree()['children']
+
+@dataclass(frozen=True)
+class AdjacencyListNode(Node):
+    """
+    Storage engine for write-heavy trees keeping only parent links. lft is the position of a node
+    among its siblings and rgt is unused, so creating, moving and deleting a node never shifts other
+    nodes: a moved subtree only changes its tree_id if it goes to another tree. Reads of paths,
+    counts and subtrees follow the links with recursive queries instead of reading bound ranges.
+
+    Nested set rows are valid rows of this engine, going back needs `flask renumber-trees`.
+    The in-memory replica (READ_REPLICA) and sparse numbering only work with nested sets.
+    """
+
+    def _open_gap(self, cur, width):
+        """`width` free positions after the last child, the tree is locked so nobody takes them."""
+        cur.execute('SELECT max(lft) FROM node WHERE parent_id = %s AND tree_id = %s', (self.id, self.tree_id))
+        start = (cur.fetchone()[0] or 0) + 1
+        return start, start + width
+
+    def get_children(self, limit, after=None):
+        scope, scope_params = self._get_children_scope()
+        with get_db_conn().cursor() as cur:
+            cur.execute(
+                f'SELECT * FROM node WHERE parent_id = %s AND {scope} AND lft > %s ORDER BY lft LIMIT %s',
+                (self.id, *scope_params, -1 if after is None else after, limit)
+            )
+            return [self.__class__(**res) for res in cur.fetchall()]
+
+    @classmethod
+    def _get_counts(cls, nodes):
+        """{id: (depth, descendant_count)} of the nodes, from one walk up and one walk down the links."""
+        ids = [node.id for node in nodes]
+        with get_db_conn().cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute(
+                'WITH RECURSIVE up AS ('
+                '    SELECT n.id AS node_id, n.parent_id AS id FROM node n WHERE n.id = ANY(%(ids)s) '
+                '    UNION ALL '
+                '    SELECT up.node_id, n.parent_id FROM up JOIN node n ON n.id = up.id'
+                '), down AS ('
+                '    SELECT n.id AS node_id, n.id, n.tree_id FROM node n WHERE n.id = ANY(%(ids)s) '
+                '    UNION ALL '
+                '    SELECT down.node_id, n.id, n.tree_id FROM down JOIN node n ON n.parent_id = down.id AND n.tree_id = down.tree_id'
+                ') '
+                # ancestors end with the root and NULL above it
+                'SELECT node_id, count(id) - 1, NULL FROM up GROUP BY node_id '
+                'UNION ALL '
+                'SELECT node_id, NULL, count(*) - 1 FROM down GROUP BY node_id',
+                {'ids': ids}
+            )
+            counts = {id: [0, 0] for id in ids}
+            for id, depth, count in cur.fetchall():
+                if depth is not None:
+                    counts[id][0] = depth
+                else:
+                    counts[id][1] = count
+        return {id: tuple(value) for id, value in counts.items()}
+
+    def _delete_subtree(self, cur):
+        cur.execute(
+            f'DELETE FROM node WHERE id IN (SELECT id FROM ({self._get_subtree_nodes_query()}) AS s)', {'id': self.id}
+        )
+
+    def _contains(self, node):
+        return self.tree_id == node.tree_id and any(ancestor.id == self.id for ancestor in node.get_path())
+
+    def _place(self, cur, parent_node, tree_id):
+        if tree_id != self.tree_id:
+            cur.execute(
+                f'UPDATE node SET tree_id = %(tree_id)s WHERE id IN (SELECT id FROM ({self._get_subtree_nodes_query()}) AS s)',
+                {'id': self.id, 'tree_id': tree_id}
+            )
+        # top-level nodes come in tree_id order, their positions do not matter
+        lft, rgt = (1, 2) if parent_node.is_root else parent_node._open_gap(cur, 1)
+        cur.execute('UPDATE node SET lft = %s, rgt = %s WHERE id = %s AND tree_id = %s', (lft, rgt, self.id, tree_id))
+        return lft, rgt
+
+    @staticmethod
+    def _get_subtree_nodes_query():
+        return (
+            'WITH RECURSIVE subtree AS ('
+            '    SELECT * FROM node WHERE id = %(id)s '
+            '    UNION ALL '
+            '    SELECT n.* FROM subtree s JOIN node n ON n.parent_id = s.id AND n.tree_id = s.tree_id'
+            ') '
+            'SELECT * FROM subtree'
+        )
+
+    def has_position(self, tree_id, lft):
+        return self.is_root or (tree_id == self.tree_id and lft >= self.lft)
+
+    def _get_subtree_query(self, columns, after=None):
+        """
+        Descendants of the node in preorder, which is the order of paths of (position, id) pairs.
+        Rows get the lft and rgt the subtree builders of Node expect: lft numbers them after
+        the node's own lft, and rgt is minus the depth, so a row closes every open node
+        at its depth or deeper.
+        """
+        query = (
+            'WITH RECURSIVE subtree AS ('
+            '    SELECT n.*, ARRAY[n.lft, n.id] AS path FROM node n WHERE n.parent_id = %(id)s '
+            '    UNION ALL '
+            '    SELECT n.*, s.path || ARRAY[n.lft, n.id] FROM subtree s '
+            '    JOIN node n ON n.parent_id = s.id AND n.tree_id = s.tree_id'
+            '), numbered AS ('
+            '    SELECT id, name, parent_id, tree_id, '
+            '        %(lft)s + row_number() OVER (PARTITION BY tree_id ORDER BY path) AS lft, '
+            '        -cardinality(path) AS rgt '
+            '    FROM subtree'
+            ') '
+            f'SELECT {columns} FROM numbered '
+        )
+        params = {'id': self.id, 'lft': self.lft}
+        if after is not None:
+            query += 'WHERE (tree_id, lft) > (%(after_tree_id)s, %(after_lft)s) '
+            params['after_tree_id'], params['after_lft'] = after
+        return query + 'ORDER BY tree_id, lft', params
+
+
+# node classes of STORAGE_ENGINE
+STORAGE_ENGINES = {
+    'nested_set': Node,
+    'adjacency_list': AdjacencyListNode,
+}
@@ -0,0 +1,162 @@
+"""
+Hash partitioning of the node table by tree_id (NODE_PARTITIONS, `flask partition-nodes`).
+
+Queries of Node are scoped by tree_id wherever the tree is known, so the planner reads and rewrites
+a single partition: lft/rgt shifts of a hot tree leave dead tuples and index bloat only in its partition.
+Lookups by id alone (get_by_id) probe the primary key of every partition.
+
+PostgreSQL cannot enforce keys without the partition key on a partitioned table, so partitions have
+primary keys of their own, ids stay unique through the sequence, and the parent_id foreign key is dropped.
+
+An existing table is repartitioned online: a trigger mirrors every change of node into the new table,
+trees are copied one at a time under their advisory lock, and the tables are swapped at the end under
+a short exclusive lock.
+"""
+from flask import current_app
+
+from app.db import get_db_conn
+
+
+NEW_TABLE = 'node_partitioned'
+
+
+def get_partition_count():
+    """Number of partitions of the node table, 0 if it is a plain table."""
+    with get_db_conn().cursor() as cur:
+        cur.execute("SELECT count(*) FROM pg_inherits WHERE inhparent = 'node'::regclass")
+        return cur.fetchone()[0]
+
+
+def _create_table(cur, partitions):
+    cur.execute("SELECT pg_get_serial_sequence('node', 'id')")
+    sequence = cur.fetchone()[0]
+    cur.execute(
+        f'CREATE TABLE {NEW_TABLE} ('
+        f"    id INTEGER NOT NULL DEFAULT nextval('{sequence}'::regclass),"
+        '    parent_id INTEGER,'
+        '    name TEXT NOT NULL,'
+        '    lft BIGINT NOT NULL,'
+        '    rgt BIGINT NOT NULL,'
+        '    tree_id INTEGER,'
+        '    UNIQUE (tree_id, name)'
+        ') PARTITION BY HASH (tree_id)'
+    )
+    for i in range(partitions):
+        cur.execute(
+            f'CREATE TABLE {NEW_TABLE}_p{i} PARTITION OF {NEW_TABLE} (PRIMARY KEY (id)) '
+            f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i}) WITH (fillfactor = 70)'
+        )
+    # the indexes of app/schema.sql
+    cur.execute(f'CREATE INDEX {NEW_TABLE}_tree_lft_idx ON {NEW_TABLE} (tree_id, lft) WITH (fillfactor = 70)')
+    cur.execute(f'CREATE INDEX {NEW_TABLE}_tree_rgt_idx ON {NEW_TABLE} (tree_id, rgt) WITH (fillfactor = 70)')
+    cur.execute(f'CREATE INDEX {NEW_TABLE}_parent_idx ON {NEW_TABLE} (parent_id, lft) WITH (fillfactor = 70)')
+    cur.execute(f'CREATE INDEX {NEW_TABLE}_name_key_idx ON {NEW_TABLE} ((name_search_key(name) COLLATE "C"), id)')
+    cur.execute(
+        f'CREATE INDEX {NEW_TABLE}_tree_name_key_idx ON {NEW_TABLE} (tree_id, (name_search_key(name) COLLATE "C"), id)'
+    )
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+    if cur.fetchone()[0]:
+        cur.execute(f'CREATE INDEX {NEW_TABLE}_name_trgm_idx ON {NEW_TABLE} USING gin (name_search_key(name) gin_trgm_ops)')
+
+
+def _create_mirror_trigger(cur):
+    # rows are found by id in every partition: an update can move a row to another tree
+    cur.execute(
+        'CREATE OR REPLACE FUNCTION node_mirror() RETURNS trigger AS $$ '
+        'BEGIN '
+        "    IF TG_OP IN ('UPDATE', 'DELETE') THEN "
+        f'        DELETE FROM {NEW_TABLE} WHERE id = OLD.id; '
+        '    END IF; '
+        "    IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+        f'        INSERT INTO {NEW_TABLE} (id, parent_id, name, lft, rgt, tree_id) '
+        '        VALUES (NEW.id, NEW.parent_id, NEW.name, NEW.lft, NEW.rgt, NEW.tree_id); '
+        '    END IF; '
+        '    RETURN NULL; '
+        'END '
+        '$$ LANGUAGE plpgsql'
+    )
+    cur.execute(
+        'CREATE TRIGGER node_mirror AFTER INSERT OR UPDATE OR DELETE ON node '
+        'FOR EACH ROW EXECUTE FUNCTION node_mirror()'
+    )
+
+
+def _copy_tree(cur, tree_id):
+    from app.models import TREE_LOCK
+
+    # writers of the tree wait, rows they changed before are mirrored already and are replaced
+    cur.execute('SELECT pg_advisory_xact_lock(%s, %s)', (TREE_LOCK, tree_id))
+    cur.execute(f'DELETE FROM {NEW_TABLE} WHERE tree_id = %s', (tree_id,))
+    cur.execute(
+        f'INSERT INTO {NEW_TABLE} (id, parent_id, name, lft, rgt, tree_id) '
+        'SELECT id, parent_id, name, lft, rgt, tree_id FROM node WHERE tree_id = %s',
+        (tree_id,)
+    )
+
+
+def _swap_tables(cur):
+    cur.execute('LOCK TABLE node IN ACCESS EXCLUSIVE MODE')
+    cur.execute("SELECT pg_get_serial_sequence('node', 'id')")
+    # the sequence would be dropped with the old table
+    cur.execute(f'ALTER SEQUENCE {cur.fetchone()[0]} OWNED BY {NEW_TABLE}.id')
+    cur.execute('DROP TABLE node')
+    cur.execute('DROP FUNCTION node_mirror()')
+    cur.execute(
+        "SELECT relname, CASE WHEN relkind IN ('i', 'I') THEN 'INDEX' ELSE 'TABLE' END FROM pg_class "
+        "WHERE relname LIKE %s AND relkind IN ('r', 'p', 'i', 'I') AND relnamespace = 'public'::regnamespace",
+        (NEW_TABLE + '%',)
+    )
+    for name, kind in cur.fetchall():
+        cur.execute(f'ALTER {kind} {name} RENAME TO {"node" + name[len(NEW_TABLE):]}')
+    cur.execute('ANALYZE node')
+
+
+def partition_nodes(partitions, progress=None):
+    """
+    Replace the node table with one hash partitioned by tree_id into `partitions` partitions,
+    while the app keeps writing. Each tree is copied in its own transaction, `progress` is called
+    with the number of trees copied so far and their total after each of them.
+    Returns the number of copied trees.
+    """
+    if partitions < 1:
+        raise ValueError('"partitions" should be positive')
+    from app.models import Node
+
+    conn = get_db_conn()
+    with conn.cursor() as cur:
+        # leftovers of an interrupted run
+        cur.execute('DROP TRIGGER IF EXISTS node_mirror ON node')
+        cur.execute(f'DROP TABLE IF EXISTS {NEW_TABLE}')
+        _create_table(cur, partitions)
+        _create_mirror_trigger(cur)
+    conn.commit()
+
+    # trees created from now on are mirrored by the trigger from the start
+    with conn.cursor() as cur:
+        cur.execute(
+            f'INSERT INTO {NEW_TABLE} (id, parent_id, name, lft, rgt, tree_id) '
+            'SELECT id, parent_id, name, lft, rgt, tree_id FROM node WHERE id = %s',
+            (Node.get_root_id(),)
+        )
+        cur.execute('SELECT id FROM node WHERE parent_id = %s ORDER BY id', (Node.get_root_id(),))
+        tree_ids = [res[0] for res in cur.fetchall()]
+    conn.commit()
+
+    for i, tree_id in enumerate(tree_ids):
+        with conn.cursor() as cur:
+            _copy_tree(cur, tree_id)
+        conn.commit()
+        if progress is not None:
+            progress(i + 1, len(tree_ids))
+
+    with conn.cursor() as cur:
+        _swap_tables(cur)
+    conn.commit()
+    return len(tree_ids)
+
+
+def init_partitions():
+    """Partition the node table of a new database if NODE_PARTITIONS is set."""
+    partitions = current_app.config.get('NODE_PARTITIONS', 0)
+    if partitions:
+        partition_nodes(partitions)
@@ -0,0 +1,546 @@
+"""
+Optional in-memory copy of the node table kept by each worker process (READ_REPLICA).
+
+Every write records the window of lft values it rewrote in each tree (see record_change) and
+publishes it with the previous and the new version of the tree on the `tree_versions` channel.
+A listener thread of each worker marks these trees stale, reads rows of the window and the few rows
+enclosing it from the database and splices them into the arrays of the tree. A tree is reloaded whole
+only when its versions have a gap or a write did not record its window (new trees, renumbering).
+Reads of stale trees, or before the first load completes, go to the database.
+"""
+import bisect
+import heapq
+import json
+import os
+import select
+import sys
+import threading
+import time
+from array import array
+
+import psycopg2
+import psycopg2.extensions
+from flask import current_app, g
+
+from app.db import connect, get_connect_params, get_db_conn, before_commit, on_commit
+
+
+CHANNEL = 'tree_versions'
+
+# bytes of a notification, payloads are limited to 8000
+NOTIFY_BYTES = 7000
+
+# seconds between checks of the listener connection and reconnection attempts
+POLL_INTERVAL = 1
+
+
+class TreeArrays:
+    """Rows of one tree as parallel arrays sorted by lft, positions of ids are found with binary search."""
+
+    __slots__ = ('tree_id', 'version', 'ids', 'parent_ids', 'lfts', 'rgts', 'names', 'sorted_ids', 'sorted_positions')
+
+    def __init__(self, tree_id, version, rows):
+        self.tree_id = tree_id
+        self.version = version
+        self.ids = array('q', (row[0] for row in rows))
+        self.parent_ids = array('q', (row[1] for row in rows))
+        self.names = [sys.intern(row[2]) for row in rows]
+        self.lfts = array('q', (row[3] for row in rows))
+        self.rgts = array('q', (row[4] for row in rows))
+        order = sorted(range(len(rows)), key=self.ids.__getitem__)
+        self.sorted_ids = array('q', (self.ids[i] for i in order))
+        self.sorted_positions = array('q', order)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, id):
+        i = bisect.bisect_left(self.sorted_ids, id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == id:
+            return self.sorted_positions[i]
+        return None
+
+    def subtree_end(self, i):
+        """Position after the last descendant of the row at position i."""
+        return bisect.bisect_left(self.lfts, self.rgts[i], i + 1)
+
+    def enclosing_positions(self, lft):
+        """Positions of rows starting before lft and ending at or after it, i.e. ancestors of the position."""
+        positions = []
+        i = bisect.bisect_left(self.lfts, lft) - 1
+        while i is not None and i >= 0:
+            if self.rgts[i] >= lft:
+                positions.append(i)
+            i = self.position(self.parent_ids[i])
+        return positions
+
+    def splice(self, version, window, rows, enclosing):
+        """
+        Arrays of the tree after a change of the (lo, hi, shift) window: rows with lft in [lo, hi) are replaced
+        with (id, parent_id, name, lft, rgt) rows, the ones after them are shifted and `enclosing` rows,
+        which start before lo, take new values. None if the rows do not fit the arrays.
+        """
+        lo, hi, shift = window
+        i = bisect.bisect_left(self.lfts, lo)
+        j = bisect.bisect_left(self.lfts, hi, i)
+        # rows of the window can not come from the rest of the tree
+        if any(k is not None and not i <= k < j for k in (self.position(row[0]) for row in rows)):
+            return None
+
+        tree = TreeArrays(self.tree_id, version, ())
+        tree.ids = self.ids[:i] + array('q', (row[0] for row in rows)) + self.ids[j:]
+        tree.parent_ids = self.parent_ids[:i] + array('q', (row[1] for row in rows)) + self.parent_ids[j:]
+        tree.names = self.names[:i] + [sys.intern(row[2]) for row in rows] + self.names[j:]
+        lfts, rgts = self.lfts[j:], self.rgts[j:]
+        if shift:
+            lfts, rgts = array('q', (lft + shift for lft in lfts)), array('q', (rgt + shift for rgt in rgts))
+        tree.lfts = self.lfts[:i] + array('q', (row[3] for row in rows)) + lfts
+        tree.rgts = self.rgts[:i] + array('q', (row[4] for row in rows)) + rgts
+        for id, parent_id, name, lft, rgt in enclosing:
+            k = self.position(id)
+            if k is None or k >= i or self.lfts[k] != lft:
+                return None
+            tree.parent_ids[k], tree.names[k], tree.rgts[k] = parent_id, sys.intern(name), rgt
+        end = i + len(rows)
+        # the window and its neighbours keep lft order
+        if any(tree.lfts[k - 1] >= tree.lfts[k] for k in (i, end) if 0 < k < len(tree)):
+            return None
+
+        if tree.ids[i:end] == self.ids[i:j]:
+            # the same rows in the same order, e.g. a rename
+            tree.sorted_ids, tree.sorted_positions = self.sorted_ids, self.sorted_positions
+        else:
+            added = len(rows) - (j - i)
+            kept = (
+                (id, k if k < i else k + added)
+                for id, k in zip(self.sorted_ids, self.sorted_positions) if not i <= k < j
+            )
+            index = list(heapq.merge(kept, sorted((row[0], i + k) for k, row in enumerate(rows))))
+            tree.sorted_ids = array('q', (id for id, _ in index))
+            tree.sorted_positions = array('q', (k for _, k in index))
+        return tree
+
+    def row(self, i):
+        return {
+            'id': self.ids[i],
+            'name': self.names[i],
+            'parent_id': self.parent_ids[i],
+            'lft': self.lfts[i],
+            'rgt': self.rgts[i],
+            'tree_id': self.tree_id,
+        }
+
+
+class Replica:
+    def __init__(self, connect_params):
+        self.pid = os.getpid()
+        self._connect_params = connect_params
+        self._lock = threading.Lock()
+        self._trees = {}
+        # tree of every loaded node
+        self._node_trees = {}
+        self._root = None
+        # greatest version loaded, the version of the whole hierarchy
+        self._version = 0
+        # trees with published versions newer than the loaded ones
+        self._stale = {}
+        # {tree_id: [version, window, version last found behind the database]} changes not applied yet
+        self._changes = {}
+        self._closed = False
+        self.ready = threading.Event()
+        self.stats = {'hits': 0, 'fallbacks': 0, 'updates': 0, 'reloads': 0}
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, 'trees': len(self._trees), 'nodes': len(self._node_trees), 'stale': len(self._stale)}
+
+    def mark_stale(self, versions):
+        """Versions of trees changed by a committed write, {tree_id: version}."""
+        with self._lock:
+            for tree_id, version in versions.items():
+                tree = self._trees.get(tree_id)
+                if tree is None or tree.version < version:
+                    self._stale[tree_id] = max(version, self._stale.get(tree_id, 0))
+
+    def wait(self, version=0, timeout=10):
+        """Wait until the replica is loaded at least at the version and has no stale trees, mostly for tests."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.ready.is_set() and not self._stale and self._version >= version:
+                return True
+            time.sleep(0.01)
+        return False
+
+    # reads, None means the replica can not answer and the database should be used
+
+    def _get_tree(self, tree_id, version=None):
+        tree = self._trees.get(tree_id)
+        fresh = (
+            self.ready.is_set() and tree is not None and tree_id not in self._stale
+            and (version is None or tree.version >= version)
+        )
+        self.stats['hits' if fresh else 'fallbacks'] += 1
+        return tree if fresh else None
+
+    def _locate(self, id):
+        with self._lock:
+            tree_id = self._node_trees.get(id)
+            tree = self._get_tree(tree_id) if tree_id is not None else None
+        if tree is None:
+            return None, None
+        return tree, tree.position(id)
+
+    def get_row(self, id):
+        if id == self._root_id():
+            return self._root
+        tree, i = self._locate(id)
+        return tree.row(i) if tree is not None else None
+
+    def get_subtree_rows(self, node, version=None):
+        """(id, name, parent_id, tree_id, rgt) rows of descendants in lft order, like Node._get_subtree_rows."""
+        if node.is_root:
+            with self._lock:
+                if not self.ready.is_set() or self._stale or (version is not None and self._version < version):
+                    self.stats['fallbacks'] += 1
+                    return None
+                self.stats['hits'] += 1
+                trees = [self._trees[tree_id] for tree_id in sorted(self._trees)]
+            return [
+                (tree.ids[i], tree.names[i], tree.parent_ids[i], tree.tree_id, tree.rgts[i])
+                for tree in trees for i in range(len(tree))
+            ]
+
+        with self._lock:
+            tree = self._get_tree(node.tree_id, version)
+        i = tree and tree.position(node.id)
+        if i is None:
+            return None
+        return [
+            (tree.ids[j], tree.names[j], tree.parent_ids[j], tree.tree_id, tree.rgts[j])
+            for j in range(i + 1, tree.subtree_end(i))
+        ]
+
+    def get_path_rows(self, node):
+        tree, i = self._locate(node.id)
+        if tree is None:
+            return None
+        path = [tree.row(i)]
+        while path[-1]['parent_id'] != self._root_id():
+            path.append(tree.row(tree.position(path[-1]['parent_id'])))
+        return path[::-1]
+
+    def get_children_rows(self, node, limit, after=None):
+        tree, i = self._locate(node.id)
+        if tree is None:
+            return None
+        end = tree.subtree_end(i)
+        if after is None:
+            j = i + 1
+        else:
+            # the previous page ended with a child at lft `after`
+            j = bisect.bisect_left(tree.lfts, after, i + 1, end)
+            if j == end or tree.lfts[j] != after:
+                return None
+            j = tree.subtree_end(j)
+        rows = []
+        while j < end and len(rows) < limit:
+            rows.append(tree.row(j))
+            j = tree.subtree_end(j)
+        return rows
+
+    def get_counts(self, node):
+        """(depth, descendant_count) of the node."""
+        tree, i = self._locate(node.id)
+        if tree is None:
+            return None
+        depth = 0
+        parent_id = tree.parent_ids[i]
+        while parent_id != self._root_id():
+            depth += 1
+            parent_id = tree.parent_ids[tree.position(parent_id)]
+        return depth, tree.subtree_end(i) - i - 1
+
+    @staticmethod
+    def _root_id():
+        return 1
+
+    # loading
+
+    def _listen(self):
+        while not self._closed:
+            conn = None
+            try:
+                conn = connect(**self._connect_params)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    # listen before loading, so no change is missed
+                    cur.execute(f'LISTEN {CHANNEL}')
+                self._load_all(conn)
+                self.ready.set()
+                while not self._closed:
+                    # queries of the listener receive notifications too
+                    if not conn.notifies and select.select([conn], [], [], POLL_INTERVAL) != ([], [], []):
+                        conn.poll()
+                    while conn.notifies:
+                        payload = json.loads(conn.notifies.pop(0).payload)
+                        self._add_changes({int(tree_id): change for tree_id, change in payload.items()})
+                    self._apply_changes(conn)
+            except (psycopg2.Error, RuntimeError, OSError):
+                # reads go to the database until the replica is loaded again
+                self.ready.clear()
+                time.sleep(POLL_INTERVAL)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _load_all(self, conn):
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT id, name, parent_id, lft, rgt, tree_id FROM node WHERE id = %s', (self._root_id(),))
+                root = cur.fetchone()
+                cur.execute('SELECT tree_id, version FROM tree_version')
+                versions = dict(cur.fetchall())
+            trees = {}
+            with conn.cursor('replica_load', cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.itersize = 10000
+                cur.execute(
+                    'SELECT tree_id, id, parent_id, name, lft, rgt FROM node WHERE tree_id IS NOT NULL '
+                    'ORDER BY tree_id, lft'
+                )
+                for tree_id, id, parent_id, name, lft, rgt in cur:
+                    trees.setdefault(tree_id, []).append((id, parent_id, name, lft, rgt))
+            conn.commit()
+        finally:
+            conn.autocommit = True
+        with self._lock:
+            self._root = dict(root) if root is not None else None
+            self._version = max(versions.values(), default=0)
+            self._trees = {
+                tree_id: TreeArrays(tree_id, versions.get(tree_id, 0), rows) for tree_id, rows in trees.items()
+            }
+            self._node_trees = {id: tree.tree_id for tree in self._trees.values() for id in tree.ids}
+            self._stale = {
+                tree_id: version for tree_id, version in self._stale.items() if versions.get(tree_id, 0) < version
+            }
+            self._changes = {}
+
+    def _add_changes(self, changes):
+        """
+        Merge {tree_id: [previous version, version, lo, hi, shift]} changes of a notification into the pending
+        ones, changes without a window or following a version that was not seen make the tree reload whole.
+        """
+        self.mark_stale({tree_id: change[1] for tree_id, change in changes.items()})
+        for tree_id, (previous, version, *window) in changes.items():
+            window = tuple(window) or None
+            tree = self._trees.get(tree_id)
+            loaded = tree.version if tree is not None else 0
+            if version <= loaded:
+                # already loaded with the tree
+                continue
+            pending = self._changes.get(tree_id)
+            if pending is None:
+                self._changes[tree_id] = [version, window if tree is not None and previous == loaded else None, None]
+            elif previous == pending[0]:
+                pending[:2] = version, merge_windows(pending[1], window)
+            else:
+                pending[:2] = max(version, pending[0]), None
+
+    def _apply_changes(self, conn):
+        for tree_id, (version, window, checked) in list(self._changes.items()):
+            conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+            conn.autocommit = False
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT version FROM tree_version WHERE tree_id = %s', (tree_id,))
+                    res = cur.fetchone()
+                    current = res[0] if res is not None else 0
+                    if current > version and checked != version:
+                        # notifications of the newer writes are on the way, they are merged first
+                        self._changes[tree_id][2] = version
+                        continue
+                    tree, ids = None, None
+                    if current == version and window is not None:
+                        tree, ids = self._update_tree(cur, self._trees[tree_id], current, window)
+                    if tree is None:
+                        cur.execute(
+                            'SELECT id, parent_id, name, lft, rgt FROM node WHERE tree_id = %s ORDER BY lft', (tree_id,)
+                        )
+                        tree, ids = TreeArrays(tree_id, current, cur.fetchall()), None
+                        self.stats['reloads'] += 1
+                    else:
+                        self.stats['updates'] += 1
+                conn.commit()
+            finally:
+                conn.autocommit = True
+            del self._changes[tree_id]
+            self._replace_tree(tree_id, tree, ids)
+
+    def _update_tree(self, cur, tree, version, window):
+        """
+        Arrays of the tree with rows of the window read again and (removed, added) ids of the window,
+        Nones if the rows do not fit.
+        """
+        lo, hi, shift = window
+        enclosing = [tree.ids[i] for i in tree.enclosing_positions(lo)]
+        cur.execute(
+            'SELECT id, parent_id, name, lft, rgt FROM node WHERE tree_id = %s AND lft >= %s AND lft < %s ORDER BY lft',
+            (tree.tree_id, lo, hi + shift)
+        )
+        rows = cur.fetchall()
+        cur.execute(
+            'SELECT id, parent_id, name, lft, rgt FROM node WHERE tree_id = %s AND id = ANY(%s)',
+            (tree.tree_id, enclosing)
+        )
+        enclosing_rows = cur.fetchall()
+        if len(enclosing_rows) != len(enclosing):
+            return None, None
+        i = bisect.bisect_left(tree.lfts, lo)
+        removed = tree.ids[i:bisect.bisect_left(tree.lfts, hi, i)]
+        return tree.splice(version, window, rows, enclosing_rows), (removed, [row[0] for row in rows])
+
+    def _replace_tree(self, tree_id, tree, ids=None):
+        """Swap arrays of the tree, `ids` are (removed, added) ids if only some of them changed."""
+        with self._lock:
+            old = self._trees.pop(tree_id, None)
+            removed, added = ids if ids is not None else (old.ids if old is not None else (), tree.ids)
+            if old is not None:
+                for id in removed:
+                    # the node could have been moved to a tree loaded before
+                    if self._node_trees.get(id) == tree_id:
+                        del self._node_trees[id]
+            if len(tree):
+                self._trees[tree_id] = tree
+                self._node_trees.update((id, tree_id) for id in added)
+            self._version = max(self._version, tree.version)
+            if self._stale.get(tree_id, 0) <= tree.version:
+                self._stale.pop(tree_id, None)
+
+
+def merge_windows(window, change):
+    """
+    Window of two consecutive changes of a tree, None if either of them needs a reload. A window (lo, hi, shift)
+    means that rows with lft in [lo, hi) were rewritten (with lft in [lo, hi + shift) now) and the ones after them
+    were shifted by `shift`. Bounds of the second change are the ones after the first change.
+    """
+    if window is None or change is None:
+        return None
+    lo, hi, shift = window
+    change_lo, change_hi, change_shift = change
+    # bounds of the change before the first one, positions within the first window map to the whole of it
+    if change_lo >= hi + shift:
+        change_lo -= shift
+    elif change_lo >= lo:
+        change_lo = lo
+    if change_hi > hi + shift:
+        change_hi -= shift
+    elif change_hi > lo:
+        change_hi = hi
+    return min(lo, change_lo), max(hi, change_hi), shift + change_shift
+
+
+def get_replica():
+    """
+    Replica of the app if READ_REPLICA is set, started on first use in each worker. None within atomic
+    functions, their reads have to see the writes of the transaction, which the replica gets after the commit.
+    """
+    config = current_app.config
+    # the replica answers reads with nested set bounds
+    if not config.get('READ_REPLICA', False) or config.get('STORAGE_ENGINE', 'nested_set') != 'nested_set':
+        return None
+    if g.get('db_atomic', False):
+        return None
+    replica = current_app.extensions.get('replica')
+    # the listener thread does not survive a fork
+    if replica is None or replica.pid != os.getpid():
+        with _replica_lock:
+            replica = current_app.extensions.get('replica')
+            if replica is None or replica.pid != os.getpid():
+                replica = current_app.extensions['replica'] = Replica(get_connect_params(current_app.config))
+    return replica
+
+
+_replica_lock = threading.Lock()
+
+
+def close_replica(app):
+    replica = app.extensions.pop('replica', None)
+    if replica is not None and replica.pid == os.getpid():
+        replica.close()
+
+
+class PendingTreeChanges(dict):
+    """
+    {tree_id: [previous version, version]} of trees written by the current transaction with windows
+    of the rows they changed, published to replicas of all workers right before the commit.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.windows = {}
+        # trees with windows recorded after their last version
+        self.recorded = set()
+
+    def record(self, tree_id, window):
+        self.windows[tree_id] = merge_windows(self.windows[tree_id], window) if tree_id in self.windows else window
+        self.recorded.add(tree_id)
+
+    def bump(self, tree_id, previous, version):
+        if tree_id not in self.recorded:
+            # the write did not tell which rows it changed
+            self.windows[tree_id] = None
+        self.recorded.discard(tree_id)
+        self.setdefault(tree_id, [previous or 0, version])[1] = version
+
+    def __call__(self):
+        payloads, size = [{}], 0
+        for tree_id, versions in self.items():
+            change = [*versions, *(self.windows[tree_id] or ())]
+            change_size = len(json.dumps({tree_id: change}))
+            if size + change_size > NOTIFY_BYTES:
+                payloads.append({})
+                size = 0
+            payloads[-1][tree_id] = change
+            size += change_size
+        with get_db_conn().cursor() as cur:
+            for payload in filter(None, payloads):
+                cur.execute('SELECT pg_notify(%s, %s)', (CHANNEL, json.dumps(payload)))
+        # notifications are delivered on commit, the replica of this worker is told directly
+        # so that it never serves data older than the worker's own writes
+        replica = current_app.extensions.get('replica')
+        if replica is not None and replica.pid == os.getpid():
+            versions = {tree_id: version for tree_id, (_, version) in self.items()}
+            on_commit(lambda: replica.mark_stale(versions))
+
+
+def _get_pending():
+    pending = next((callback for callback in g.db_before_commit if isinstance(callback, PendingTreeChanges)), None)
+    if pending is None:
+        pending = PendingTreeChanges()
+        before_commit(pending)
+    return pending
+
+
+def record_change(tree_id, lo, hi, shift=0):
+    """
+    Record that the current atomic function rewrote rows of the tree with lft in [lo, hi) and shifted
+    the ones after them by `shift`, with bounds as they were right before the change.
+    Trees with new versions and no recorded changes are reloaded whole by replicas.
+    """
+    if current_app.config.get('READ_REPLICA', False):
+        _get_pending().record(tree_id, (lo, hi, shift))
+
+
+def publish_versions(versions):
+    """Publish {tree_id: (previous version, version)} of trees written by the current atomic function."""
+    if current_app.config.get('READ_REPLICA', False):
+        pending = _get_pending()
+        for tree_id, (previous, version) in versions.items():
+            pending.bump(tree_id, previous, version)
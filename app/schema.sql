@@ -1,12 +1,79 @@
 DROP TABLE IF EXISTS node;
+DROP TABLE IF EXISTS schema_migration;
+DROP TABLE IF EXISTS tree_version;
+DROP TABLE IF EXISTS tree_gap;
+DROP SEQUENCE IF EXISTS tree_version_seq;
+DROP TABLE IF EXISTS change_log;
+DROP TABLE IF EXISTS change_log_horizon;
 
+-- app/partitions.py replaces it with a table hash partitioned by tree_id (NODE_PARTITIONS),
+-- keep its copy of the indexes in sync
 CREATE TABLE node (
     id SERIAL PRIMARY KEY,
     parent_id INTEGER,
     name TEXT NOT NULL,
-    lft INTEGER NOT NULL,
-    rgt INTEGER NOT NULL,
+    lft BIGINT NOT NULL,
+    rgt BIGINT NOT NULL,
     tree_id INTEGER,
     FOREIGN KEY (parent_id) REFERENCES node (id),
     UNIQUE (tree_id, name)
+) WITH (fillfactor = 70);
+
+-- range scans and lft/rgt shifts are always scoped by tree_id
+CREATE INDEX node_tree_lft_idx ON node (tree_id, lft) WITH (fillfactor = 70);
+CREATE INDEX node_tree_rgt_idx ON node (tree_id, rgt) WITH (fillfactor = 70);
+CREATE INDEX node_parent_idx ON node (parent_id, lft) WITH (fillfactor = 70);
+
+-- search keys of names, see Node.search
+CREATE OR REPLACE FUNCTION name_search_key(name TEXT) RETURNS TEXT AS $$
+    SELECT translate(lower(name), 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ', 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя')
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+CREATE INDEX node_name_key_idx ON node ((name_search_key(name) COLLATE "C"), id);
+CREATE INDEX node_tree_name_key_idx ON node (tree_id, (name_search_key(name) COLLATE "C"), id);
+
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX node_name_trgm_idx ON node USING gin (name_search_key(name) gin_trgm_ops);
+EXCEPTION WHEN feature_not_supported OR undefined_file OR insufficient_privilege THEN
+    RAISE NOTICE 'pg_trgm is not available, substring search reads the whole table';
+END
+$$;
+
+-- bumped on every write to the tree, see Node.get_version
+CREATE SEQUENCE tree_version_seq;
+
+CREATE TABLE tree_version (
+    tree_id INTEGER PRIMARY KEY,
+    version BIGINT NOT NULL
+);
+
+CREATE INDEX tree_version_version_idx ON tree_version (version);
+
+-- lft/rgt positions of dense trees left unused by deferred deletes, see DEFERRED_DELETE
+CREATE TABLE tree_gap (
+    tree_id INTEGER PRIMARY KEY,
+    positions BIGINT NOT NULL
+);
+
+-- appended by every write in commit order, see app/changes.py
+CREATE TABLE change_log (
+    version BIGSERIAL PRIMARY KEY,
+    op TEXT NOT NULL,
+    node_id INTEGER NOT NULL,
+    parent_id INTEGER,
+    name TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- the newest version removed from the log
+CREATE TABLE change_log_horizon (
+    version BIGINT NOT NULL
+);
+
+INSERT INTO change_log_horizon (version) VALUES (0);
+
+CREATE TABLE schema_migration (
+    name TEXT PRIMARY KEY
 );
\ No newline at end of file
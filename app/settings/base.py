@@ -18,4 +18,62 @@ if not POSTGRES_USER:
 
 POSTGRES_DB = os.getenv('POSTGRES_DB')
 if not POSTGRES_DB:
-    raise ValueError('POSTGRES_DB is not set')
\ No newline at end of file
+    raise ValueError('POSTGRES_DB is not set')
+
+# Host of the primary server, host[:port] of streaming replicas serving GET requests (comma separated)
+POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'postgres')
+POSTGRES_REPLICA_HOSTS = [host for host in os.getenv('POSTGRES_REPLICA_HOSTS', '').split(',') if host]
+
+# Seconds a read waits for a replica to replay the client's last write before going to the primary
+REPLICA_MAX_WAIT = float(os.getenv('REPLICA_MAX_WAIT', 0.1))
+
+# Connections kept by each worker process
+POSTGRES_POOL_SIZE = int(os.getenv('POSTGRES_POOL_SIZE', 10))
+
+# Seconds to wait for a free connection
+POSTGRES_POOL_TIMEOUT = float(os.getenv('POSTGRES_POOL_TIMEOUT', 30))
+
+# Times a write is retried after colliding with a concurrent one
+TRANSACTION_RETRIES = int(os.getenv('TRANSACTION_RETRIES', 5))
+
+# How trees are stored: nested_set, or adjacency_list for write-heavy trees (see app/models.py).
+# Switching from adjacency_list to nested_set needs `flask renumber-trees`
+STORAGE_ENGINE = os.getenv('STORAGE_ENGINE', 'nested_set')
+if STORAGE_ENGINE not in ('nested_set', 'adjacency_list'):
+    raise ValueError('Unknown STORAGE_ENGINE')
+
+# Distance between lft/rgt values of new nodes. 0 keeps numbering dense,
+# a positive value leaves gaps so that inserts do not shift other nodes
+NESTED_SET_GAP = int(os.getenv('NESTED_SET_GAP', 0))
+
+# Deletes from dense trees leave their lft/rgt positions unused instead of shifting the rest of the tree,
+# `flask compact` renumbers trees with unused positions
+DEFERRED_DELETE = os.getenv('DEFERRED_DELETE', '') == '1'
+
+# Hash partitions of the node table by tree_id created by `flask init-db`, 0 keeps it a plain table.
+# `flask partition-nodes` partitions an existing table
+NODE_PARTITIONS = int(os.getenv('NODE_PARTITIONS', 0))
+
+# Memory budget of serialized subtrees cached by each worker process, 0 disables the cache
+SUBTREE_CACHE_BYTES = int(os.getenv('SUBTREE_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Requests taking at least this many seconds are logged with their SQL, 0 disables the log
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', 0))
+
+# Stream /hierarchy and /subtree responses instead of building them in memory (and caching)
+STREAM_SUBTREES = os.getenv('STREAM_SUBTREES', '') == '1'
+
+# Keep a copy of the hierarchy in memory of each worker process and answer reads from it,
+# writes notify the workers of changed trees
+READ_REPLICA = os.getenv('READ_REPLICA', '') == '1'
+if READ_REPLICA and STORAGE_ENGINE != 'nested_set':
+    raise ValueError('READ_REPLICA needs the nested_set STORAGE_ENGINE')
+
+# Threads running requests of each worker process served with app.asgi (uvicorn's WSGI middleware).
+# A request holds a connection while it runs, so threads beyond POSTGRES_POOL_SIZE would only wait for one
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', POSTGRES_POOL_SIZE))
+
+# Changes served by GET /changes are kept for this many seconds and at most this many,
+# clients asking for older ones reload the hierarchy
+CHANGE_LOG_RETENTION_SECONDS = int(os.getenv('CHANGE_LOG_RETENTION_SECONDS', 7 * 24 * 3600))
+CHANGE_LOG_MAX_ROWS = int(os.getenv('CHANGE_LOG_MAX_ROWS', 1000000))
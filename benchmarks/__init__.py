@@ -0,0 +1,49 @@
+"""
+Benchmarks run against the database from POSTGRES_* environment variables,
+the same one the tests use. They recreate the schema, so never point them at real data.
+"""
+import io
+import os
+
+from app import create_app
+from app.db import get_db_conn
+
+
+def make_app(**config):
+    return create_app({
+        'POSTGRES_PASSWORD': os.getenv('POSTGRES_PASSWORD'),
+        'POSTGRES_PORT': os.getenv('POSTGRES_PORT'),
+        'POSTGRES_USER': os.getenv('POSTGRES_USER'),
+        'POSTGRES_DB': os.getenv('POSTGRES_DB'),
+        **config,
+    })
+
+
+class RowsReader(io.TextIOBase):
+    """File-like COPY source producing lines from rows as they are read, so memory does not grow with their number."""
+
+    def __init__(self, rows):
+        self._lines = ('\t'.join(map(str, row)) + '\n' for row in rows)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            size = len(self._buffer)
+        res, self._buffer = self._buffer[:size], self._buffer[size:]
+        return res
+
+
+def load_rows(rows):
+    """Load (id, parent_id, name, lft, rgt, tree_id) rows with one COPY."""
+    with get_db_conn().cursor() as cur:
+        cur.copy_from(RowsReader(rows), 'node', columns=('id', 'parent_id', 'name', 'lft', 'rgt', 'tree_id'))
+        cur.execute("SELECT setval(pg_get_serial_sequence('node', 'id'), max(id)) FROM node")
+    get_db_conn().commit()
+    with get_db_conn().cursor() as cur:
+        cur.execute('ANALYZE node')
+    get_db_conn().commit()
@@ -0,0 +1,60 @@
+"""Synthetic trees as valid nested set rows: (id, parent_id, name, lft, rgt, tree_id)."""
+from app.models import Node
+
+
+def balanced_tree(size, fanout=10, gap=0, first_id=2):
+    """A tree where every node has `fanout` children, ids go in heap order."""
+    def children(i):
+        return range(fanout * i + 1, min(fanout * i + fanout + 1, size))
+    return nested_set_rows(size, children, gap, first_id)
+
+
+def wide_tree(size, gap=0, first_id=2):
+    """A root with size - 1 children."""
+    def children(i):
+        return range(1, size) if i == 0 else ()
+    return nested_set_rows(size, children, gap, first_id)
+
+
+def deep_tree(size, gap=0, first_id=2):
+    """A chain of size nodes, every node but the last one has a single child."""
+    def children(i):
+        return (i + 1,) if i + 1 < size else ()
+    return nested_set_rows(size, children, gap, first_id)
+
+
+def many_trees(trees, size, shape=balanced_tree, gap=0, first_id=2):
+    """`trees` trees of `size` nodes each, ids are consecutive across trees."""
+    for i in range(trees):
+        yield from shape(size, gap=gap, first_id=first_id + i * size)
+
+
+SHAPES = {
+    'balanced': balanced_tree,
+    'wide': wide_tree,
+    'deep': deep_tree,
+}
+
+
+def nested_set_rows(size, children, gap=0, first_id=2):
+    """
+    Number a tree of `size` nodes given by `children(i)` -> indexes of child nodes,
+    node 0 is the tree root. Rows are generated in rgt order.
+    """
+    step = max(gap, 1)
+    lft = [0] * size
+    parent = [None] * size
+    pos = lft[0] = 1
+    stack = [(0, iter(children(0)))]
+    while stack:
+        i, it = stack[-1]
+        child = next(it, None)
+        pos += step
+        if child is None:
+            stack.pop()
+            parent_id = Node.get_root_id() if i == 0 else first_id + parent[i]
+            yield (first_id + i, parent_id, f'node {first_id + i}', lft[i], pos, first_id)
+        else:
+            lft[child] = pos
+            parent[child] = i
+            stack.append((child, iter(children(child))))
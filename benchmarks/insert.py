@@ -0,0 +1,50 @@
+"""
+Insert throughput of dense and sparse (NESTED_SET_GAP) numbering:
+
+    python -m benchmarks.insert --size 100000 --size 1000000 --inserts 100 --gap 1024
+"""
+import argparse
+import json
+import random
+import time
+
+from app.db import init_db
+from app.models import Node
+from benchmarks import make_app, load_rows
+from benchmarks.generators import balanced_tree
+
+
+def run(size, inserts, gap, fanout):
+    app = make_app(NESTED_SET_GAP=gap)
+    with app.app_context():
+        init_db()
+        load_rows(balanced_tree(size, fanout, gap))
+        random.seed(0)
+        parent_ids = random.choices(range(2, size + 2), k=inserts)
+        start = time.perf_counter()
+        for i, parent_id in enumerate(parent_ids):
+            Node.create(f'new node {i}', Node.get_by_id(parent_id))
+        elapsed = time.perf_counter() - start
+    return {
+        'numbering': 'sparse' if gap else 'dense',
+        'size': size,
+        'inserts': inserts,
+        'seconds': round(elapsed, 3),
+        'inserts_per_second': round(inserts / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, action='append', help='tree sizes, 100000 and 1000000 by default')
+    parser.add_argument('--inserts', type=int, default=100)
+    parser.add_argument('--gap', type=int, default=1024)
+    parser.add_argument('--fanout', type=int, default=10)
+    args = parser.parse_args()
+    for size in args.size or [100000, 1000000]:
+        for gap in (0, args.gap):
+            print(json.dumps(run(size, args.inserts, gap, args.fanout)))
+
+
+if __name__ == '__main__':
+    main()
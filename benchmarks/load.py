@@ -0,0 +1,231 @@
+"""
+Mixed read/write HTTP workload against the app serving a synthetic hierarchy.
+Reports throughput and latency percentiles per operation as JSON:
+
+    python -m benchmarks.load --shape balanced --size 1000000 --concurrency 8 --requests 20000
+    python -m benchmarks.load --shape balanced --trees 1000 --size 1000 --mix get_item=80,create=20
+    python -m benchmarks.load --size 100000 --engine nested_set --engine adjacency_list --mix create=50,move=50
+
+The hierarchy is loaded into the database and served by a threaded server started in a child
+process, or pass --url of an already running app (e.g. gunicorn with several workers) that uses
+the same database. Runs are reproducible for the same arguments: every client has its own seed.
+With several --engine options the same workload runs against each storage engine in turn,
+on a freshly loaded hierarchy, and every run prints its own line.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from werkzeug.serving import make_server
+
+from app.db import init_db, close_pool
+from app.models import STORAGE_ENGINES
+from benchmarks import make_app, load_rows
+from benchmarks.generators import SHAPES, many_trees
+
+
+DEFAULT_MIX = 'get_item=30,get_subtree=10,children=15,path=10,create=15,rename=5,move=10,delete=5'
+
+
+class Client:
+    """Issues random operations on nodes with ids from 2 to max_id, deletes only nodes it created."""
+
+    def __init__(self, url, max_id, mix, seed):
+        self.url = url.rstrip('/')
+        self.max_id = max_id
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.created = []
+        self.requests = 0
+
+    def request(self, method, path, data=None):
+        body = json.dumps(data).encode() if data is not None else None
+        req = urllib.request.Request(
+            self.url + path, data=body, method=method, headers={'Content-Type': 'application/json'}
+        )
+        try:
+            with urllib.request.urlopen(req) as response:
+                response.read()
+                return response.status, response.headers
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, e.headers
+
+    def random_id(self):
+        return self.random.randint(2, self.max_id)
+
+    def run_operation(self, operation):
+        self.requests += 1
+        name = f'client {self.seed} node {self.requests}'
+        if operation == 'get_item':
+            return self.request('GET', f'/item/{self.random_id()}')[0]
+        if operation == 'get_subtree':
+            return self.request('GET', f'/subtree/{self.random_id()}')[0]
+        if operation == 'children':
+            return self.request('GET', f'/item/{self.random_id()}/children?limit=100')[0]
+        if operation == 'path':
+            return self.request('GET', f'/item/{self.random_id()}/path')[0]
+        if operation == 'create':
+            status, headers = self.request('POST', '/item', {'name': name, 'parent_id': self.random_id()})
+            if status == 201:
+                self.created.append(int(headers['Location'].rsplit('/', 1)[1]))
+            return status
+        if operation == 'rename':
+            return self.request('POST', f'/item/{self.random_id()}', {'name': name})[0]
+        if operation == 'move':
+            return self.request('POST', f'/item/{self.random_id()}', {'parent_id': self.random_id()})[0]
+        if operation == 'delete':
+            if not self.created:
+                return self.run_operation('create')
+            return self.request('DELETE', f'/item/{self.created.pop()}')[0]
+        raise ValueError(f'Unknown operation {operation}')
+
+    def run(self, requests, results):
+        for _ in range(requests):
+            operation = self.random.choices(self.operations, self.weights)[0]
+            start = time.perf_counter()
+            status = self.run_operation(operation)
+            results.append((operation, status, time.perf_counter() - start))
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def summarize(results, seconds):
+    operations = {}
+    for operation, status, latency in results:
+        operations.setdefault(operation, []).append((status, latency))
+    summary = {}
+    for operation, values in sorted(operations.items()):
+        latencies = sorted(latency for _, latency in values)
+        summary[operation] = {
+            'requests': len(values),
+            # client errors such as moves under own children are expected, server errors are not
+            'server_errors': sum(status >= 500 for status, _ in values),
+            'requests_per_second': round(len(values) / seconds, 1),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        }
+    return summary
+
+
+def run_workload(url, max_id, mix, concurrency, requests, seed=0):
+    """Run `requests` operations split between `concurrency` client threads."""
+    results = []
+    clients = [Client(url, max_id, mix, seed * concurrency + i) for i in range(concurrency)]
+    threads = [
+        threading.Thread(target=client.run, args=(requests // concurrency + (i < requests % concurrency), results))
+        for i, client in enumerate(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(results) / seconds, 1),
+        'operations': summarize(results, seconds),
+    }
+
+
+def parse_mix(mix):
+    """'get_item=30,create=10' -> {'get_item': 30, 'create': 10}"""
+    return {operation: float(weight) for operation, weight in (part.split('=') for part in mix.split(','))}
+
+
+def serve(app, port, ready):
+    # the request log of the development server would slow it down
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    ready.set()
+    server.serve_forever()
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_engine(args, engine):
+    """Load the hierarchy and run the workload against an app with the storage engine."""
+    app = make_app(NESTED_SET_GAP=args.gap, STORAGE_ENGINE=engine)
+    with app.app_context():
+        init_db()
+        # nested set rows are valid rows of every engine
+        load_rows(many_trees(args.trees, args.size, SHAPES[args.shape], args.gap))
+    # connections of this process must not be shared with the server process
+    close_pool(app)
+
+    server = None
+    url = args.url
+    if url is None:
+        ready = multiprocessing.get_context('fork').Event()
+        server = multiprocessing.get_context('fork').Process(target=serve, args=(app, args.port, ready), daemon=True)
+        server.start()
+        ready.wait()
+        url = f'http://127.0.0.1:{args.port}'
+
+    try:
+        return run_workload(url, 1 + args.trees * args.size, parse_mix(args.mix), args.concurrency, args.requests, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='balanced')
+    parser.add_argument('--size', type=int, default=100000, help='nodes in each tree')
+    parser.add_argument('--trees', type=int, default=1)
+    parser.add_argument('--gap', type=int, default=0, help='NESTED_SET_GAP of the generated trees and the app')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'weights of operations, {DEFAULT_MIX} by default')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--engine', action='append', choices=sorted(STORAGE_ENGINES),
+        help='STORAGE_ENGINE of the app, repeat to compare engines (nested_set by default)'
+    )
+    parser.add_argument(
+        '--url', help='URL of a running app with the same --engine, a server is started on --port otherwise'
+    )
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    for engine in args.engine or ['nested_set']:
+        result = run_engine(args, engine)
+        print(json.dumps({
+            'commit': get_commit(),
+            'engine': engine,
+            'shape': args.shape,
+            'trees': args.trees,
+            'size': args.size,
+            'gap': args.gap,
+            'mix': args.mix,
+            **result,
+        }), flush=True)
+
+
+if __name__ == '__main__':
+    main()
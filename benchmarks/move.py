@@ -0,0 +1,80 @@
+"""
+Latency and rows rewritten by moves within one dense tree, by the distance moved
+(in lft/rgt positions) and the size of the tree:
+
+    python -m benchmarks.move --size 100000 --size 1000000 --distance 10 --distance 1000 --distance 100000
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+from app.db import init_db, get_db_conn
+from app.models import Node
+from benchmarks import make_app, load_rows
+from benchmarks.generators import balanced_tree
+
+
+def find_leaf(cur, lft):
+    """First leaf of the benchmark tree starting at lft or after it."""
+    cur.execute(
+        'SELECT * FROM node WHERE tree_id = 2 AND lft >= %s AND rgt = lft + 1 ORDER BY lft LIMIT 1',
+        (lft,)
+    )
+    res = cur.fetchone()
+    return Node(**res) if res is not None else None
+
+
+def run(size, distances, moves, fanout):
+    app = make_app()
+    with app.app_context():
+        init_db()
+        load_rows(balanced_tree(size, fanout))
+        rnd = random.Random(0)
+        for distance in distances:
+            # leave room for the leaves around both positions
+            if distance > size:
+                continue
+            rows, latencies = [], []
+            while len(latencies) < moves:
+                with get_db_conn().cursor() as cur:
+                    node = find_leaf(cur, rnd.randint(1, 2 * size - distance))
+                    parent_node = node and find_leaf(cur, node.rgt + distance)
+                    if parent_node is None:
+                        continue
+                    # rows the move rewrites: the subtree and the band up to the new position
+                    cur.execute(
+                        'SELECT count(*) FROM node WHERE tree_id = 2 AND '
+                        '(lft BETWEEN %(lft)s AND %(rgt)s OR rgt BETWEEN %(lft)s AND %(rgt)s)',
+                        {'lft': node.lft, 'rgt': parent_node.rgt - 1}
+                    )
+                    rows.append(cur.fetchone()[0])
+                get_db_conn().commit()
+                start = time.perf_counter()
+                node.move(parent_node)
+                latencies.append(time.perf_counter() - start)
+            yield {
+                'size': size,
+                'distance': distance,
+                'moves': moves,
+                'rows_rewritten': round(statistics.mean(rows), 1),
+                'ms_per_move': round(statistics.mean(latencies) * 1000, 2),
+                'p50_ms': round(statistics.median(latencies) * 1000, 2),
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, action='append', help='tree sizes, 100000 and 1000000 by default')
+    parser.add_argument('--distance', type=int, action='append', help='10, 1000 and 100000 by default')
+    parser.add_argument('--moves', type=int, default=50)
+    parser.add_argument('--fanout', type=int, default=10)
+    args = parser.parse_args()
+    for size in args.size or [100000, 1000000]:
+        for result in run(size, args.distance or [10, 1000, 100000], args.moves, args.fanout):
+            print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
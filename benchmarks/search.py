@@ -0,0 +1,90 @@
+"""
+Where the time of a /search page goes, by the size of the tree: the statement finding the matches
+(an index scan), the one following parent links of every match, building nodes of the rows in Python
+(the rest of Node.search) and the whole request:
+
+    python -m benchmarks.search --size 100000 --size 1000000
+"""
+import argparse
+import json
+import statistics
+import time
+
+from flask import g
+
+from app.db import init_db, get_db_conn
+from app.metrics import RequestStats
+from app.models import Node
+from benchmarks import make_app, load_rows
+from benchmarks.generators import balanced_tree
+
+
+def ms(latencies):
+    return round(statistics.median(latencies) * 1000, 2)
+
+
+def run(size, reads, fanout, limit, query, prefix):
+    app = make_app()
+    with app.app_context():
+        init_db()
+        load_rows(balanced_tree(size, fanout))
+        with get_db_conn().cursor() as cur:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'node_name_trgm_idx')")
+            trigram_index = cur.fetchone()[0]
+        get_db_conn().commit()
+
+        matches, ancestors, depth = 0, 0, 0
+        match_latencies, path_latencies, python_latencies, search_latencies = [], [], [], []
+        for _ in range(reads):
+            # statements of Node.search are timed by the metrics of the cursor
+            g.request_stats = stats = RequestStats('search', 'GET', keep_statements=True)
+            start = time.perf_counter()
+            res = Node.search(query, limit + 1, prefix=prefix)
+            search_latencies.append(time.perf_counter() - start)
+            (match_time, _), (path_time, _) = stats.statements
+            match_latencies.append(match_time)
+            path_latencies.append(path_time)
+            python_latencies.append(search_latencies[-1] - match_time - path_time)
+            matches = len(res)
+            ancestors = sum(len(path) for _, path in res)
+            depth = max(len(path) for _, path in res)
+        g.pop('request_stats')
+
+    client = app.test_client()
+    url = f'/search?q={query}&prefix={int(prefix)}&limit={limit}'
+    request_latencies = []
+    for _ in range(reads):
+        start = time.perf_counter()
+        assert client.get(url).status_code == 200
+        request_latencies.append(time.perf_counter() - start)
+    return {
+        'size': size,
+        'query': query,
+        'prefix': prefix,
+        'trigram_index': trigram_index,
+        'matches': matches,
+        'ancestors': ancestors,
+        'max_path_length': depth,
+        'match_ms': ms(match_latencies),
+        'paths_ms': ms(path_latencies),
+        'python_ms': ms(python_latencies),
+        'search_ms': ms(search_latencies),
+        'request_ms': ms(request_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, action='append', help='tree sizes, 10000 and 100000 by default')
+    parser.add_argument('--reads', type=int, default=20)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--query', default='node 1', help='names of generated nodes are "node <id>"')
+    parser.add_argument('--substring', action='store_true', help='search substrings instead of prefixes')
+    args = parser.parse_args()
+    for size in args.size or [10000, 100000]:
+        print(json.dumps(run(size, args.reads, args.fanout, args.limit, args.query, not args.substring)))
+
+
+if __name__ == '__main__':
+    main()
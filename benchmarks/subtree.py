@@ -0,0 +1,47 @@
+"""
+Time to read and build a whole subtree with one query, by the size of the tree:
+
+    python -m benchmarks.subtree --size 10000 --size 100000 --size 1000000
+"""
+import argparse
+import json
+import statistics
+import time
+
+from app.db import init_db
+from app.models import Node
+from benchmarks import make_app, load_rows
+from benchmarks.generators import balanced_tree
+
+
+def run(size, reads, fanout):
+    app = make_app()
+    with app.app_context():
+        init_db()
+        load_rows(balanced_tree(size, fanout))
+        node = Node.get_by_id(2)
+        latencies = []
+        for _ in range(reads):
+            start = time.perf_counter()
+            node.get_subtree()
+            latencies.append(time.perf_counter() - start)
+    return {
+        'size': size,
+        'reads': reads,
+        'ms_per_read': round(statistics.mean(latencies) * 1000, 2),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, action='append', help='tree sizes, 10000 and 100000 by default')
+    parser.add_argument('--reads', type=int, default=5)
+    parser.add_argument('--fanout', type=int, default=10)
+    args = parser.parse_args()
+    for size in args.size or [10000, 100000]:
+        print(json.dumps(run(size, args.reads, args.fanout)))
+
+
+if __name__ == '__main__':
+    main()
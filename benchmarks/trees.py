@@ -0,0 +1,75 @@
+"""
+Latency of writes to one tree as the number of trees grows, with a plain node table
+and a node table hash partitioned by tree_id (NODE_PARTITIONS):
+
+    python -m benchmarks.trees --trees 10 --trees 100 --trees 1000 --size 1000 --partitions 0 --partitions 16
+
+Every write goes to a random tree: a leaf is created, moved under another node of its tree and deleted.
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+from app.db import init_db
+from app.models import Node
+from benchmarks import make_app, load_rows
+from benchmarks.generators import many_trees
+
+
+def run(trees, size, partitions, writes):
+    app = make_app(NODE_PARTITIONS=partitions)
+    with app.app_context():
+        init_db()
+        load_rows(many_trees(trees, size))
+        rnd = random.Random(0)
+        latencies = {'create': [], 'move': [], 'delete': []}
+        for i in range(writes):
+            # ids of every tree are consecutive, starting with its top node
+            first_id = 2 + rnd.randrange(trees) * size
+            parent_node, new_parent_node = Node.get_by_ids([first_id + rnd.randrange(size) for _ in range(2)])
+
+            start = time.perf_counter()
+            node = Node.create(f'new node {i}', parent_node)
+            latencies['create'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            node = node.move(new_parent_node)
+            latencies['move'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            node.delete()
+            latencies['delete'].append(time.perf_counter() - start)
+    return {
+        'partitions': partitions,
+        'trees': trees,
+        'size': size,
+        'writes': writes,
+        **{
+            f'{op}_p50_ms': round(statistics.median(values) * 1000, 2)
+            for op, values in latencies.items()
+        },
+        **{
+            f'{op}_ms': round(statistics.mean(values) * 1000, 2)
+            for op, values in latencies.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trees', type=int, action='append', help='numbers of trees, 10, 100 and 1000 by default')
+    parser.add_argument('--size', type=int, default=1000, help='nodes of every tree')
+    parser.add_argument(
+        '--partitions', type=int, action='append', help='NODE_PARTITIONS, 0 (a plain table) and 16 by default'
+    )
+    parser.add_argument('--writes', type=int, default=200, help='creates, moves and deletes of each')
+    args = parser.parse_args()
+    for partitions in args.partitions or [0, 16]:
+        for trees in args.trees or [10, 100, 1000]:
+            print(json.dumps(run(trees, args.size, partitions, args.writes)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,48 @@
 import os
+from contextlib import contextmanager
 
 import pytest
+from flask import g
 
 from app import create_app
-from app.db import init_db
+from app.db import init_db, close_pool, get_db_conn
+from app.replica import close_replica
 
 
-@pytest.fixture
-def app():
+STORAGE_ENGINES = ['nested_set', 'adjacency_list']
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-slow', action='store_true', help='run tests marked slow, e.g. of large trees')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'nested_set: the test relies on nested set bounds')
+    config.addinivalue_line('markers', 'slow: the test loads large trees, skipped without --run-slow')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-slow'):
+        return
+    skip_slow = pytest.mark.skip(reason='needs --run-slow')
+    for item in items:
+        if item.get_closest_marker('slow'):
+            item.add_marker(skip_slow)
+
+
+@pytest.fixture(params=STORAGE_ENGINES)
+def app(request):
+    # tests run with every storage engine or override settings with indirect parametrization
+    settings = request.param if isinstance(request.param, dict) else {'STORAGE_ENGINE': request.param}
+    if request.node.get_closest_marker('nested_set') and settings.get('STORAGE_ENGINE', 'nested_set') != 'nested_set':
+        pytest.skip('nested set only')
     app = create_app({
         'TESTING': True,
         'POSTGRES_PASSWORD': os.getenv('POSTGRES_PASSWORD'),
         'POSTGRES_PORT': os.getenv('POSTGRES_PORT'),
         'POSTGRES_USER': os.getenv('POSTGRES_USER'),
         'POSTGRES_DB': os.getenv('POSTGRES_DB'),
+        **settings,
     })
 
     with app.app_context():
@@ -21,7 +50,79 @@ def app():
 
     yield app
 
+    close_replica(app)
+    close_pool(app)
+
 
 @pytest.fixture
 def client(app):
-    return app.test_client()
\ No newline at end of file
+    return app.test_client()
+
+
+class QueryLog(list):
+    def __init__(self, explain):
+        super().__init__()
+        self.explain = explain
+        self.plans = []
+
+
+class RecordingConnection:
+    def __init__(self, conn, log):
+        self._conn = conn
+        self._log = log
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self._conn.cursor(*args, **kwargs), self._conn, self._log)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class RecordingCursor:
+    def __init__(self, cur, conn, log):
+        object.__setattr__(self, '_cur', cur)
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_log', log)
+
+    def execute(self, query, vars=None):
+        query = self._cur.mogrify(query, vars).decode()
+        self._log.append(query)
+        if self._log.explain:
+            with self._conn.cursor() as cur:
+                cur.execute('EXPLAIN ' + query)
+                self._log.plans.append('\n'.join(row[0] for row in cur.fetchall()))
+        return self._cur.execute(query)
+
+    def __enter__(self):
+        self._cur.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cur.__exit__(*exc_info)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cur, name, value)
+
+
+@pytest.fixture
+def record_queries():
+    """
+    Context manager recording statements executed with get_db_conn() in the current app context,
+    with `explain` their plans are recorded too.
+    """
+    @contextmanager
+    def record(explain=False):
+        conn = get_db_conn()
+        log = QueryLog(explain)
+        g.db_conn = RecordingConnection(conn, log)
+        try:
+            yield log
+        finally:
+            g.db_conn = conn
+    return record
@@ -1,8 +1,10 @@
 import pytest
 
+from app import formats
+from app.cache import get_subtree_cache
 from app.models import Node
 
-from tests.test_data import example_hierarchy
+from tests.test_data import example_hierarchy, assert_nested_sets
 
 
 def test_get_item(client, app, example_hierarchy):
@@ -11,10 +13,30 @@ def test_get_item(client, app, example_hierarchy):
     assert data == {
         'id': item['id'],
         'name': item['name'],
-        'parent_id': item['parent_id']
+        'parent_id': item['parent_id'],
+        'depth': 0,
+        'descendant_count': 2
     }
 
 
+def test_get_item_path(client, example_hierarchy):
+    assert client.get('/item/4/path').get_json() == {'items': [
+        {'id': 2, 'name': 'level1-1', 'parent_id': None},
+        {'id': 4, 'name': 'level2-2', 'parent_id': 2},
+    ]}
+    assert client.get('/item/1/path').status_code == 404
+
+
+def test_get_item_children(client, example_hierarchy):
+    data = client.get('/item/2/children?limit=1').get_json()
+    assert data['items'] == [{'id': 3, 'name': 'level2-1', 'parent_id': 2, 'depth': 1, 'descendant_count': 0}]
+    data = client.get(f'/item/2/children?limit=1&after={data["next"]}').get_json()
+    assert [item['id'] for item in data['items']] == [4] and data['next'] is None
+    assert client.get('/item/7/children').get_json() == {'items': [], 'next': None}
+    assert client.get('/item/2/children?limit=0').status_code == 400
+    assert client.get('/item/2/children?after=a').status_code == 400
+
+
 def test_create_item(client, app, example_hierarchy):
     item_data = {'name': 'test item', 'parent_id': None}
     response = client.post('/item', json={'name': 'test item', 'parent_id': None})
@@ -31,6 +53,259 @@ def test_get_subtree(client, app, example_hierarchy):
     assert client.get('/subtree/2').get_json() == example_hierarchy[0]
 
 
+def test_get_items(client, example_hierarchy):
+    data = client.get('/items?ids=6,1,2,100').get_json()
+    assert data == {'items': [
+        {'id': 6, 'name': 'level2-3', 'parent_id': 5, 'depth': 1, 'descendant_count': 0},
+        {'id': 2, 'name': 'level1-1', 'parent_id': None, 'depth': 0, 'descendant_count': 2},
+    ]}
+    assert client.get('/items?ids=a').status_code == 400
+
+
+class TestBatch:
+    def test_apply(self, client, example_hierarchy):
+        response = client.post('/batch', json=[
+            {'op': 'create', 'name': 'a', 'parent_id': 7},
+            {'op': 'create', 'name': 'b', 'parent_id': 7},
+            {'op': 'rename', 'id': 3, 'name': 'renamed'},
+            {'op': 'move', 'id': 4, 'parent_id': 5},
+            {'op': 'delete', 'id': 6},
+            {'op': 'create', 'name': 'c', 'parent_id': None},
+        ])
+        assert response.status_code == 200
+        results = response.get_json()['results']
+        a, b, c = results[0]['id'], results[1]['id'], results[5]['id']
+        assert results[0:2] == [
+            {'id': a, 'name': 'a', 'parent_id': 7, 'depth': 1, 'descendant_count': 0},
+            {'id': b, 'name': 'b', 'parent_id': 7, 'depth': 1, 'descendant_count': 0},
+        ]
+        assert results[5] == {'id': c, 'name': 'c', 'parent_id': None, 'depth': 0, 'descendant_count': 0}
+        assert results[2:5] == [
+            {'id': 3, 'name': 'renamed', 'parent_id': 2, 'depth': 1, 'descendant_count': 0},
+            {'id': 4, 'name': 'level2-2', 'parent_id': 5, 'depth': 1, 'descendant_count': 0},
+            None,
+        ]
+        assert client.get('/hierarchy').get_json() == [
+            {'id': 2, 'name': 'level1-1', 'parent_id': None, 'children': [
+                {'id': 3, 'name': 'renamed', 'parent_id': 2, 'children': []},
+            ]},
+            {'id': 5, 'name': 'level1-2', 'parent_id': None, 'children': [
+                {'id': 4, 'name': 'level2-2', 'parent_id': 5, 'children': []},
+            ]},
+            {'id': 7, 'name': 'level1-3', 'parent_id': None, 'children': [
+                {'id': a, 'name': 'a', 'parent_id': 7, 'children': []},
+                {'id': b, 'name': 'b', 'parent_id': 7, 'children': []},
+            ]},
+            {'id': c, 'name': 'c', 'parent_id': None, 'children': []},
+        ]
+        with client.application.app_context():
+            assert_nested_sets()
+
+    def test_rollback(self, client, example_hierarchy):
+        response = client.post('/batch', json=[
+            {'op': 'rename', 'id': 3, 'name': 'renamed'},
+            {'op': 'create', 'name': 'a', 'parent_id': 2},
+            {'op': 'create', 'name': 'renamed', 'parent_id': 2},
+        ])
+        assert response.status_code == 400 and response.get_json()['index'] == 2
+        assert client.get('/hierarchy').get_json() == example_hierarchy
+
+    def test_not_found(self, client, example_hierarchy):
+        response = client.post('/batch', json=[{'op': 'delete', 'id': 6}, {'op': 'delete', 'id': 6}])
+        assert response.status_code == 404 and response.get_json()['index'] == 1
+        assert client.get('/hierarchy').get_json() == example_hierarchy
+
+
+class TestBulk:
+    def test_nested(self, client, example_hierarchy):
+        items = [{'name': 'a', 'children': [{'name': 'a1'}, {'name': 'a2', 'children': []}]}]
+        response = client.post('/bulk?parent_id=7', json=items)
+        assert response.status_code == 201
+        ids = response.get_json()['ids']
+        assert client.get('/subtree/7').get_json()['children'] == [{
+            'id': ids[0], 'name': 'a', 'parent_id': 7, 'children': [
+                {'id': ids[1], 'name': 'a1', 'parent_id': ids[0], 'children': []},
+                {'id': ids[2], 'name': 'a2', 'parent_id': ids[0], 'children': []},
+            ]
+        }]
+
+    def test_ndjson(self, client, example_hierarchy):
+        data = '{"name": "a", "parent": null}\n{"name": "a1", "parent": "a"}\n\n{"name": "b", "parent": null}\n'
+        response = client.post('/bulk', data=data, content_type='application/x-ndjson')
+        assert response.status_code == 201
+        a, a1, b = response.get_json()['ids']
+        hierarchy = client.get('/hierarchy').get_json()
+        assert hierarchy[3:] == [
+            {'id': a, 'name': 'a', 'parent_id': None, 'children': [
+                {'id': a1, 'name': 'a1', 'parent_id': a, 'children': []}
+            ]},
+            {'id': b, 'name': 'b', 'parent_id': None, 'children': []},
+        ]
+
+    def test_errors(self, client, example_hierarchy):
+        data = '{"name": "a", "parent": "b"}\nnot json\n{"name": " a", "parent": null}\n'
+        response = client.post('/bulk?parent_id=2', data=data, content_type='application/x-ndjson')
+        assert response.status_code == 400
+        assert [error['row'] for error in response.get_json()['errors']] == [0, 1]
+        data = b'{"name": "a", "parent": null}\n{"name": "\xff", "parent": null}\n'
+        response = client.post('/bulk?parent_id=2', data=data, content_type='application/x-ndjson')
+        assert response.status_code == 400
+        assert response.get_json()['errors'] == [{'row': 1, 'message': 'Invalid UTF-8'}]
+        client.post('/item', json={'name': 'existing', 'parent_id': 3})
+        response = client.post('/bulk?parent_id=2', json=[{'name': 'existing'}, {'name': ' a'}])
+        assert response.status_code == 400
+        assert [error['row'] for error in response.get_json()['errors']] == [0, 1]
+        assert len(client.get('/subtree/2').get_json()['children']) == 2
+
+    def test_invalid_parent(self, client):
+        assert client.post('/bulk?parent_id=100', json=[]).status_code == 400
+
+
+@pytest.mark.parametrize('app', [{'STREAM_SUBTREES': True}], indirect=True)
+class TestStreaming:
+    def test_get_hierarchy(self, client, example_hierarchy):
+        assert client.get('/hierarchy').get_json() == example_hierarchy
+
+    def test_get_subtree(self, client, example_hierarchy):
+        assert client.get('/subtree/2').get_json() == example_hierarchy[0]
+
+    def test_empty_hierarchy(self, client):
+        assert client.get('/hierarchy').get_json() == []
+
+    def test_depth(self, client, example_hierarchy):
+        assert client.get('/hierarchy?depth=0').get_json() == [
+            {**item, 'children': []} for item in example_hierarchy
+        ]
+
+    def test_not_modified(self, client, example_hierarchy):
+        with client.get('/subtree/5') as response:
+            etag = response.headers['ETag']
+        assert client.get('/subtree/5', headers={'If-None-Match': etag}).status_code == 304
+
+
+class TestSubtreeDepth:
+    def test_subtree(self, client, example_hierarchy):
+        assert client.get('/subtree/2?depth=0').get_json() == {**example_hierarchy[0], 'children': []}
+        assert client.get('/subtree/2?depth=1').get_json() == example_hierarchy[0]
+
+    def test_hierarchy(self, client, example_hierarchy):
+        assert client.get('/hierarchy?depth=0').get_json() == [
+            {**item, 'children': []} for item in example_hierarchy
+        ]
+        assert client.get('/hierarchy?depth=1').get_json() == example_hierarchy
+
+    def test_invalid_depth(self, client, example_hierarchy):
+        assert client.get('/subtree/2?depth=-1').status_code == 400
+        assert client.get('/hierarchy?depth=a').status_code == 400
+
+
+class TestSubtreePages:
+    def get_pages(self, client, url):
+        ids, after = [], ''
+        while after is not None:
+            data = client.get(f'{url}&after={after}' if after else url).get_json()
+            ids += [(item['id'], item['depth']) for item in data['items']]
+            after = data['next']
+        return ids
+
+    def test_hierarchy(self, client, example_hierarchy):
+        assert self.get_pages(client, '/hierarchy?limit=2') == [(2, 0), (3, 1), (4, 1), (5, 0), (6, 1), (7, 0)]
+        assert self.get_pages(client, '/hierarchy?limit=2&depth=0') == [(2, 0), (5, 0), (7, 0)]
+
+    def test_subtree(self, client, example_hierarchy):
+        data = client.get('/subtree/2?limit=2').get_json()
+        assert data['items'] == [
+            {'id': 2, 'name': 'level1-1', 'parent_id': None, 'depth': 0},
+            {'id': 3, 'name': 'level2-1', 'parent_id': 2, 'depth': 1},
+        ]
+        assert self.get_pages(client, '/subtree/2?limit=1') == [(2, 0), (3, 1), (4, 1)]
+
+    def test_invalid_token(self, client, example_hierarchy):
+        token = client.get('/subtree/5?limit=1').get_json()['next']
+        assert client.get(f'/subtree/2?after={token}').status_code == 400
+        assert client.get('/subtree/2?after=a').status_code == 400
+        assert client.get('/subtree/2?limit=0').status_code == 400
+
+
+class TestSubtreeFormats:
+    hierarchy_columns = {
+        'ids': [2, 3, 4, 5, 6, 7],
+        'parent_ids': [None, 2, 2, None, 5, None],
+        'depths': [0, 1, 1, 0, 1, 0],
+        'names': ['level1-1', 'level2-1', 'level2-2', 'level1-2', 'level2-3', 'level1-3'],
+    }
+
+    def test_columns_json(self, client, example_hierarchy):
+        response = client.get('/hierarchy', headers={'Accept': formats.COLUMNS_JSON})
+        assert response.mimetype == formats.COLUMNS_JSON
+        assert response.get_json(force=True) == self.hierarchy_columns
+        response = client.get('/subtree/5?depth=0', headers={'Accept': formats.COLUMNS_JSON})
+        assert response.get_json(force=True) == {'ids': [5], 'parent_ids': [None], 'depths': [0], 'names': ['level1-2']}
+
+    def test_columns_binary(self, client, example_hierarchy):
+        response = client.get('/hierarchy', headers={'Accept': formats.COLUMNS_BINARY})
+        assert response.mimetype == formats.COLUMNS_BINARY
+        assert formats.decode_columns_binary(response.get_data()) == self.hierarchy_columns
+        response = client.get('/subtree/2', headers={'Accept': formats.COLUMNS_BINARY})
+        assert formats.decode_columns_binary(response.get_data())['ids'] == [2, 3, 4]
+
+    def test_nested_json_by_default(self, client, example_hierarchy):
+        for accept in ('*/*', 'application/json', 'text/html'):
+            response = client.get('/hierarchy', headers={'Accept': accept})
+            assert response.mimetype == 'application/json'
+            assert response.get_json() == example_hierarchy
+            assert response.headers['Vary'] == 'Accept'
+
+    def test_etags_differ(self, client, example_hierarchy):
+        etag = client.get('/subtree/2').headers['ETag']
+        response = client.get('/subtree/2', headers={'Accept': formats.COLUMNS_BINARY, 'If-None-Match': etag})
+        assert response.status_code == 200
+        response = client.get(
+            '/subtree/2', headers={'Accept': formats.COLUMNS_BINARY, 'If-None-Match': response.headers['ETag']}
+        )
+        assert response.status_code == 304
+
+    def test_etags_differ_by_query(self, client, example_hierarchy):
+        etags = {
+            client.get(path).headers['ETag']
+            for path in ('/subtree/2', '/subtree/2?depth=0', '/subtree/2?limit=1', '/subtree/2?limit=2')
+        }
+        assert len(etags) == 4
+        page = client.get('/subtree/2?limit=1')
+        etag = client.get(f'/subtree/2?limit=1&after={page.get_json()["next"]}').headers['ETag']
+        assert etag not in etags
+        assert client.get('/subtree/2?limit=1', headers={'If-None-Match': page.headers['ETag']}).status_code == 304
+
+
+class TestSubtreeCache:
+    def test_not_modified(self, client, example_hierarchy):
+        etag = client.get('/subtree/2').headers['ETag']
+        response = client.get('/subtree/2', headers={'If-None-Match': etag})
+        assert response.status_code == 304 and response.headers['ETag'] == etag
+
+    def test_other_tree_write(self, client, example_hierarchy):
+        etag = client.get('/subtree/2').headers['ETag']
+        hierarchy_etag = client.get('/hierarchy').headers['ETag']
+        client.post('/item', json={'name': 'new item', 'parent_id': 5})
+        assert client.get('/subtree/2', headers={'If-None-Match': etag}).status_code == 304
+        assert client.get('/hierarchy', headers={'If-None-Match': hierarchy_etag}).status_code == 200
+
+    def test_same_tree_write(self, client, app, example_hierarchy):
+        etag = client.get('/subtree/2').headers['ETag']
+        client.post('/item/3', json={'name': 'renamed'})
+        response = client.get('/subtree/2', headers={'If-None-Match': etag})
+        example_hierarchy[0]['children'][0]['name'] = 'renamed'
+        assert response.status_code == 200 and response.get_json() == example_hierarchy[0]
+        assert response.headers['ETag'] != etag
+
+    def test_cached(self, client, app, example_hierarchy):
+        client.get('/subtree/2')
+        client.get('/subtree/2')
+        with app.app_context():
+            stats = get_subtree_cache().get_stats()
+        assert stats['hits'] == 1 and stats['items'] == 1
+
+
 class TestUpdateItem:
     def test_update_name(self, client, app):
         with app.app_context():
@@ -40,7 +315,9 @@ class TestUpdateItem:
         assert updated_item == {
             'id': node.id,
             'name': 'new name',
-            'parent_id': None
+            'parent_id': None,
+            'depth': 0,
+            'descendant_count': 0
         }
 
     def test_update_parent(self, client, example_hierarchy):
@@ -49,7 +326,9 @@ class TestUpdateItem:
         assert updated_item == {
             'id': item["id"],
             'name': item["name"],
-            'parent_id': 6
+            'parent_id': 6,
+            'depth': 2,
+            'descendant_count': 0
         }
 
 
@@ -57,3 +336,56 @@ def test_delete_item(client, example_hierarchy):
     item = example_hierarchy[0]['children'].pop(1)
     client.delete(f'/item/{item["id"]}')
     assert client.get('/hierarchy').get_json() == example_hierarchy
+
+
+class TestCopyItem:
+    def test_copy(self, client, example_hierarchy):
+        response = client.post('/item/2/copy', json={'parent_id': 5})
+        assert response.status_code == 201
+        item = response.get_json()
+        assert response.headers['Location'].endswith(f'/item/{item["id"]}')
+        assert item == {**item, 'name': 'level1-1', 'parent_id': 5, 'depth': 1, 'descendant_count': 2}
+
+        response = client.post('/item/2/copy', json={'parent_id': None})
+        assert response.get_json()['parent_id'] is None
+        assert [tree['name'] for tree in client.get('/hierarchy').get_json()] == [
+            'level1-1', 'level1-2', 'level1-3', 'level1-1'
+        ]
+
+    def test_name_conflict(self, client, example_hierarchy):
+        assert client.post('/item/3/copy', json={'parent_id': 2}).status_code == 400
+        response = client.post('/item/3/copy', json={'parent_id': 2, 'on_conflict': 'rename'})
+        assert response.get_json()['name'] == 'level2-1 copy'
+
+    def test_invalid(self, client, example_hierarchy):
+        assert client.post('/item/100/copy', json={'parent_id': 2}).status_code == 404
+        assert client.post('/item/3/copy', json={}).status_code == 400
+        assert client.post('/item/3/copy', json={'parent_id': 100}).status_code == 400
+        assert client.post('/item/3/copy', json={'parent_id': 5, 'on_conflict': 'skip'}).status_code == 400
+
+
+class TestSearch:
+    def test_search(self, client, example_hierarchy):
+        client.post('/item', json={'name': 'Ёлка', 'parent_id': 3})
+        response = client.get('/search?q=ЁЛ')
+        assert response.status_code == 200
+        item = response.get_json()['items'][0]
+        assert item == {
+            'id': item['id'], 'name': 'Ёлка', 'parent_id': 3, 'path': [
+                {'id': 2, 'name': 'level1-1', 'parent_id': None}, {'id': 3, 'name': 'level2-1', 'parent_id': 2}
+            ]
+        }
+
+        assert [item['name'] for item in client.get('/search?q=level2&tree_id=5').get_json()['items']] == ['level2-3']
+        assert client.get('/search?q=evel&prefix=1').get_json() == {'items': [], 'next': None}
+
+    def test_pages(self, client, example_hierarchy):
+        page = client.get('/search?q=level&limit=4').get_json()
+        assert [item['name'] for item in page['items']] == ['level1-1', 'level1-2', 'level1-3', 'level2-1']
+        page = client.get('/search', query_string={'q': 'level', 'limit': 4, 'after': page['next']}).get_json()
+        assert [item['name'] for item in page['items']] == ['level2-2', 'level2-3']
+        assert page['next'] is None
+
+    @pytest.mark.parametrize('query', ['', 'q=', 'q=a&limit=0', 'q=a&tree_id=x', 'q=a&prefix=2', 'q=a&after=x.y'])
+    def test_invalid_arguments(self, client, query):
+        assert client.get(f'/search?{query}').status_code == 400
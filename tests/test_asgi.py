@@ -0,0 +1,122 @@
+"""
+Tests of the ASGI entry point. The API tests of tests/test_api.py run here again
+with requests going through app.asgi instead of straight to the WSGI app.
+"""
+import asyncio
+import json
+from urllib.parse import quote
+
+import pytest
+from werkzeug.http import HTTP_STATUS_CODES
+
+from app.asgi import wrap_wsgi_app
+from app.db import get_pool
+from tests.test_api import *  # noqa: F401,F403
+from tests.test_data import example_hierarchy
+
+
+@pytest.fixture
+def asgi_app(app):
+    asgi_app = wrap_wsgi_app(app.wsgi_app, app.config)
+    yield asgi_app
+    asgi_app.executor.shutdown()
+
+
+@pytest.fixture
+def client(app, asgi_app):
+    """Test client of the app whose requests go through the ASGI app."""
+    app.wsgi_app = call_asgi_app(asgi_app)
+    return app.test_client()
+
+
+def call_asgi_app(asgi_app):
+    """WSGI app making an ASGI request of every WSGI one."""
+    def wsgi_app(environ, start_response):
+        headers = [
+            (name[5:].lower().replace('_', '-').encode('latin-1'), value.encode('latin-1'))
+            for name, value in environ.items() if name.startswith('HTTP_')
+        ]
+        for name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if environ.get(name):
+                headers.append((name.lower().replace('_', '-').encode('latin-1'), environ[name].encode('latin-1')))
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': environ['REQUEST_METHOD'],
+            'path': environ['PATH_INFO'].encode('latin-1').decode(),
+            # HTTP clients send non-ASCII characters of the query percent-encoded
+            'query_string': quote(environ['QUERY_STRING'].encode('latin-1'), safe='&=%+').encode(),
+            'headers': headers,
+        }
+        status, response_headers, body = asyncio.run(send_request(asgi_app, scope, environ['wsgi.input'].read()))
+        start_response(
+            f'{status} {HTTP_STATUS_CODES.get(status, "")}',
+            [(name.decode('latin-1'), value.decode('latin-1')) for name, value in response_headers]
+        )
+        return [body]
+    return wsgi_app
+
+
+async def send_request(asgi_app, scope, body):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    start, *bodies = messages
+    assert not bodies[-1].get('more_body', False)
+    return start['status'], start['headers'], b''.join(message['body'] for message in bodies)
+
+
+async def request(asgi_app, method, path, data=None, headers=()):
+    path, _, query = path.partition('?')
+    body = json.dumps(data).encode() if data is not None else b''
+    headers = [*headers, (b'content-length', str(len(body)).encode())]
+    if data is not None:
+        headers.append((b'content-type', b'application/json'))
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'path': path,
+        'query_string': query.encode(),
+        'headers': headers,
+    }
+    status, headers, body = await send_request(asgi_app, scope, body)
+    return status, dict(headers), body
+
+
+def call(asgi_app, method, path, data=None, headers=()):
+    return asyncio.run(request(asgi_app, method, path, data, headers))
+
+
+@pytest.mark.parametrize('app', [{'STREAM_SUBTREES': True}], indirect=True)
+def test_streamed_hierarchy(asgi_app, example_hierarchy):
+    status, _, body = call(asgi_app, 'GET', '/hierarchy')
+    assert status == 200
+    assert json.loads(body) == example_hierarchy
+
+
+@pytest.mark.parametrize('app', [{'STREAM_SUBTREES': True, 'ASGI_THREADS': 4}], indirect=True)
+def test_concurrent_streamed_requests_return_connections(app, asgi_app, example_hierarchy):
+    async def run():
+        return await asyncio.gather(*(request(asgi_app, 'GET', '/hierarchy') for i in range(20)))
+
+    assert all(json.loads(body) == example_hierarchy for _, _, body in asyncio.run(run()))
+    with app.app_context():
+        assert get_pool().get_stats()['in_use'] == 0
+
+
+def test_concurrent_requests(asgi_app, example_hierarchy):
+    async def run():
+        return await asyncio.gather(*(
+            request(asgi_app, 'POST', '/item', {'name': f'item {i}', 'parent_id': 2 + i % 3}) for i in range(30)
+        ), *(request(asgi_app, 'GET', '/hierarchy') for i in range(30)))
+
+    assert {status for status, _, _ in asyncio.run(run())} == {200, 201}
+    status, _, body = call(asgi_app, 'GET', '/subtree/2')
+    assert len(json.loads(body)['children']) == 12
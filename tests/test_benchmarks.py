@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from werkzeug.serving import make_server
+
+from app.models import Node
+from benchmarks import load_rows
+from benchmarks.generators import SHAPES, balanced_tree, many_trees
+from benchmarks.load import run_workload, parse_mix, DEFAULT_MIX
+
+from tests.test_data import assert_nested_sets
+
+
+def count_nodes(subtree):
+    return 1 + sum(count_nodes(child) for child in subtree['children'])
+
+
+@pytest.mark.parametrize('size', [10 ** 4, pytest.param(10 ** 5, marks=pytest.mark.slow)])
+def test_get_subtree(app, record_queries, size):
+    with app.app_context():
+        load_rows(balanced_tree(size))
+        node = Node.get_by_id(2)
+        with record_queries() as queries:
+            subtree = node.get_subtree()
+
+    assert len(queries) == 1
+    assert count_nodes(subtree) == size
+
+
+def test_get_hierarchy(app, record_queries):
+    with app.app_context():
+        load_rows(balanced_tree(100, first_id=2))
+        load_rows(balanced_tree(100, first_id=102))
+        root_node = Node.get_root_node()
+        with record_queries() as queries:
+            hierarchy = root_node.get_subtree()['children']
+
+    assert len(queries) == 1
+    assert [count_nodes(tree) for tree in hierarchy] == [100, 100]
+
+
+@pytest.mark.parametrize('shape', sorted(SHAPES))
+def test_generators(app, shape):
+    with app.app_context():
+        load_rows(many_trees(3, 50, SHAPES[shape]))
+        assert_nested_sets()
+        assert len(Node.get_hierarchy()) == 3
+        assert count_nodes(Node.get_by_id(2).get_subtree()) == 50
+
+
+def test_run_workload(app):
+    with app.app_context():
+        load_rows(balanced_tree(100))
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        result = run_workload(f'http://127.0.0.1:{server.port}', 101, parse_mix(DEFAULT_MIX), 2, 100)
+    finally:
+        server.shutdown()
+        thread.join()
+
+    assert result['requests'] == 100
+    assert set(result['operations']) <= set(parse_mix(DEFAULT_MIX))
+    for stats in result['operations'].values():
+        assert stats['server_errors'] == 0 and stats['p50_ms'] <= stats['p95_ms'] <= stats['p99_ms']
+    with app.app_context():
+        assert_nested_sets()
@@ -0,0 +1,25 @@
+from app.cache import SubtreeCache
+
+
+def test_get_version_mismatch():
+    cache = SubtreeCache(max_bytes=100)
+    cache.set(2, 1, b'[]')
+    assert cache.get(2, 1) == b'[]'
+    assert cache.get(2, 2) is None
+
+
+def test_evict_least_recently_used():
+    cache = SubtreeCache(max_bytes=10)
+    cache.set(2, 1, b'1234')
+    cache.set(3, 1, b'1234')
+    cache.get(2, 1)
+    cache.set(4, 1, b'1234')
+    assert cache.get(3, 1) is None
+    assert cache.get(2, 1) == cache.get(4, 1) == b'1234'
+    assert cache.get_stats()['bytes'] == 8
+
+
+def test_skip_too_large_value():
+    cache = SubtreeCache(max_bytes=4)
+    cache.set(2, 1, b'12345')
+    assert cache.get(2, 1) is None
@@ -0,0 +1,108 @@
+import pytest
+
+from app.changes import compact_changes
+from app.db import get_db_conn
+from tests.test_data import example_hierarchy
+
+
+def apply_changes(items, changes):
+    """Mirror of the hierarchy as {id: item} updated with changes."""
+    for change in changes:
+        if change['op'] == 'create':
+            items[change['id']] = {'id': change['id'], 'name': change['name'], 'parent_id': change['parent_id']}
+        elif change['op'] == 'rename':
+            items[change['id']]['name'] = change['name']
+        elif change['op'] == 'move':
+            items[change['id']]['parent_id'] = change['parent_id']
+        else:
+            deleted = {change['id']}
+            while True:
+                children = {id for id, item in items.items() if item['parent_id'] in deleted} - deleted
+                if not children:
+                    break
+                deleted |= children
+            for id in deleted:
+                del items[id]
+    return items
+
+
+def flatten(subtrees):
+    items = {}
+    for subtree in subtrees:
+        items[subtree['id']] = {'id': subtree['id'], 'name': subtree['name'], 'parent_id': subtree['parent_id']}
+        items.update(flatten(subtree['children']))
+    return items
+
+
+def test_mirror_hierarchy(client, example_hierarchy):
+    response = client.get('/hierarchy')
+    mirror = flatten(response.json)
+    since = int(response.headers['X-Changes-Version'])
+
+    new_id = int(client.post('/item', json={'name': 'new item', 'parent_id': 3}).headers['Location'].rsplit('/', 1)[1])
+    client.post('/bulk?parent_id=5', json=[{'name': 'bulk item', 'children': [{'name': 'bulk child'}]}])
+    client.post('/item/3', json={'name': 'renamed'})
+    client.post('/item/6', json={'parent_id': new_id})
+    client.post('/item/4', json={'parent_id': None})
+    client.delete('/item/2')
+
+    changes = client.get(f'/changes?since={since}').json
+    assert [change['op'] for change in changes['items']] == [
+        'create', 'create', 'create', 'rename', 'move', 'move', 'delete'
+    ]
+    assert changes['items'][0] == {
+        'version': since + 1, 'op': 'create', 'id': new_id, 'parent_id': 3, 'name': 'new item'
+    }
+    assert not changes['more']
+    assert apply_changes(mirror, changes['items']) == flatten(client.get('/hierarchy').json)
+
+    assert client.get(f'/changes?since={changes["next"]}').json == {
+        'items': [], 'next': changes['next'], 'more': False
+    }
+
+
+def test_pages(client, example_hierarchy):
+    for i in range(5):
+        client.post('/item', json={'name': f'item {i}', 'parent_id': 2})
+    page = client.get('/changes?limit=2').json
+    assert [change['name'] for change in page['items']] == ['item 0', 'item 1']
+    assert page['more']
+    page = client.get(f'/changes?limit=2&since={page["next"]}').json
+    assert [change['name'] for change in page['items']] == ['item 2', 'item 3']
+
+
+def test_failed_write_is_not_logged(client, example_hierarchy):
+    assert client.post('/item', json={'name': 'level2-2', 'parent_id': 2}).status_code == 400
+    assert client.get('/changes').json['items'] == []
+
+
+def test_resync(app, client, example_hierarchy):
+    for i in range(5):
+        client.post('/item', json={'name': f'item {i}', 'parent_id': 2})
+    with app.app_context():
+        assert compact_changes(max_age=3600, max_rows=2) == 3
+        get_db_conn().commit()
+
+    assert client.get('/changes?since=2').status_code == 410
+    assert [change['version'] for change in client.get('/changes?since=3').json['items']] == [4, 5]
+    # a version from before the database was recreated
+    assert client.get('/changes?since=10').status_code == 410
+    assert client.get('/hierarchy').headers['X-Changes-Version'] == '5'
+
+    with app.app_context():
+        assert compact_changes(max_age=0, max_rows=100) == 2
+        get_db_conn().commit()
+    assert client.get('/changes?since=3').status_code == 410
+    assert client.get('/changes?since=5').json['items'] == []
+    assert client.get('/subtree/2').headers['X-Changes-Version'] == '5'
+
+
+@pytest.mark.parametrize('app', [{'POSTGRES_REPLICA_HOSTS': ['postgres']}], indirect=True)
+def test_lagging_replica(client, example_hierarchy):
+    # a version seen on a fresher replica is not an unknown one
+    assert client.get('/changes?since=10').json == {'items': [], 'next': 10, 'more': False}
+
+
+@pytest.mark.parametrize('query', ['since=-1', 'since=a', 'limit=0'])
+def test_invalid_arguments(client, query):
+    assert client.get(f'/changes?{query}').status_code == 400
@@ -0,0 +1,85 @@
+import multiprocessing
+import random
+
+import pytest
+
+from app.db import get_db_conn, close_pool
+from app.models import Node
+
+from tests.test_data import assert_nested_sets
+from tests.test_models import SPARSE
+
+
+WORKERS = 4
+OPERATIONS = 50
+TREES = 3
+
+
+def run_workers(app, target):
+    # connections of the parent must not be shared with forked workers
+    close_pool(app)
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=target, args=(app, seed)) for seed in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0] * WORKERS
+
+
+def create_nodes(app, seed):
+    with app.app_context():
+        for i in range(OPERATIONS):
+            parent_node = Node.get_by_id(random.Random(seed * OPERATIONS + i).randint(2, 1 + TREES))
+            Node.create(f'worker {seed} node {i}', parent_node)
+
+
+def write_randomly(app, seed):
+    rnd = random.Random(seed)
+    with app.app_context():
+        for i in range(OPERATIONS):
+            with get_db_conn().cursor() as cur:
+                cur.execute('SELECT id FROM node WHERE tree_id IS NOT NULL ORDER BY id')
+                ids = [res[0] for res in cur.fetchall()]
+            node = Node.get_by_id(rnd.choice(ids))
+            op = rnd.random()
+            try:
+                if node is None:
+                    continue
+                if op < 0.5:
+                    Node.create(f'worker {seed} node {i}', node)
+                elif op < 0.8:
+                    parent_node = Node.get_by_id(rnd.choice(ids))
+                    if parent_node is not None:
+                        node.move(parent_node)
+                elif op < 0.9:
+                    node.rename(f'worker {seed} renamed {i}')
+                # keep the trees from disappearing
+                elif node.id > 1 + TREES:
+                    node.delete()
+            except ValueError:
+                # moves under own children and deleted nodes
+                pass
+
+
+@pytest.fixture
+def trees(app):
+    with app.app_context():
+        for i in range(TREES):
+            Node.create(f'tree {i}', Node.get_root_node())
+
+
+@pytest.mark.parametrize('app', [{}, SPARSE], indirect=True)
+class TestConcurrentWrites:
+    def test_create(self, app, trees):
+        run_workers(app, create_nodes)
+        with app.app_context():
+            assert_nested_sets(dense=not app.config.get('NESTED_SET_GAP'))
+            with get_db_conn().cursor() as cur:
+                cur.execute('SELECT count(*) FROM node WHERE tree_id IS NOT NULL')
+                assert cur.fetchone()[0] == TREES + WORKERS * OPERATIONS
+
+    def test_random_writes(self, app, trees):
+        run_workers(app, write_randomly)
+        with app.app_context():
+            assert_nested_sets(dense=not app.config.get('NESTED_SET_GAP'))
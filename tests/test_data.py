@@ -1,6 +1,50 @@
+from itertools import groupby
+
 import pytest
 
 from app.db import get_db_conn
+from app.models import Node
+
+
+def assert_nested_sets(dense=True):
+    """
+    Every tree should be a valid nested set, dense numbering should have no gaps.
+    Trees of the adjacency list engine only have to agree with parent links.
+    """
+    if Node.get_engine() is not Node:
+        return assert_parent_links()
+    with get_db_conn().cursor() as cur:
+        cur.execute('SELECT tree_id, id, parent_id, lft, rgt FROM node WHERE tree_id IS NOT NULL ORDER BY tree_id, lft')
+        rows = cur.fetchall()
+    for tree_id, tree_rows in groupby(rows, key=lambda row: row[0]):
+        stack = []
+        bounds = []
+        for _, id, parent_id, lft, rgt in tree_rows:
+            assert lft < rgt
+            while stack and stack[-1][2] < lft:
+                stack.pop()
+            if stack:
+                assert rgt < stack[-1][2] and parent_id == stack[-1][0]
+            else:
+                assert id == tree_id and parent_id == Node.get_root_id() and lft == 1
+            stack.append((id, lft, rgt))
+            bounds += [lft, rgt]
+        assert len(set(bounds)) == len(bounds)
+        if dense:
+            assert sorted(bounds) == list(range(1, len(bounds) + 1))
+
+
+def assert_parent_links():
+    """Every node should be in the tree of its parent, top-level nodes identify their trees."""
+    with get_db_conn().cursor() as cur:
+        cur.execute(
+            'SELECT n.id, n.tree_id, p.id, p.tree_id FROM node n LEFT JOIN node p ON p.id = n.parent_id '
+            'WHERE n.tree_id IS NOT NULL'
+        )
+        rows = cur.fetchall()
+    for id, tree_id, parent_id, parent_tree_id in rows:
+        assert parent_id is not None
+        assert tree_id == (id if parent_id == Node.get_root_id() else parent_tree_id)
 
 
 @pytest.fixture
@@ -9,15 +53,14 @@ def example_hierarchy(app):
         ('level1-1', 1, 1, 6, 2),
         ('level2-1', 2, 2, 3, 2),
         ('level2-2', 2, 4, 5, 2),
-        ('level1-2', 1, 7, 10, 5),
-        ('level2-3', 5, 8, 9, 5),
-        ('level1-3', 1, 11, 12, 7),
+        ('level1-2', 1, 1, 4, 5),
+        ('level2-3', 5, 2, 3, 5),
+        ('level1-3', 1, 1, 2, 7),
     ]
     with app.app_context():
         with get_db_conn().cursor() as cur:
             for t in values:
                 cur.execute('INSERT INTO node (name, parent_id, lft, rgt, tree_id) VALUES (%s, %s, %s, %s, %s)', t)
-            cur.execute('UPDATE node SET rgt = 13 WHERE id = 1')
         get_db_conn().commit()
 
     return [
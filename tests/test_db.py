@@ -0,0 +1,198 @@
+import pytest
+
+from app.db import get_db_conn, get_pool, get_replica_pools, migrate, atomic, TransactionConflict
+from app.models import Node
+
+from tests.test_data import example_hierarchy, assert_nested_sets
+
+
+@pytest.mark.nested_set
+def test_migrate_per_tree_nested_sets(app, example_hierarchy):
+    # global numbering used before 0001_per_tree_nested_sets.sql
+    values = [(1, 6, 2), (2, 3, 3), (4, 5, 4), (7, 10, 5), (8, 9, 6), (11, 12, 7), (0, 13, 1)]
+    with app.app_context():
+        with get_db_conn().cursor() as cur:
+            cur.executemany('UPDATE node SET lft = %s, rgt = %s WHERE id = %s', values)
+            cur.execute("DELETE FROM schema_migration WHERE name = '0001_per_tree_nested_sets.sql'")
+        get_db_conn().commit()
+
+        migrate()
+
+        assert Node.get_root_node().rgt == 1
+        assert Node.get_by_id(5) == Node(id=5, name='level1-2', parent_id=1, lft=1, rgt=4, tree_id=5)
+        assert Node.get_hierarchy() == example_hierarchy
+
+
+class TestConnectionPool:
+    def test_reuse_connection(self, app):
+        with app.app_context():
+            conn = get_db_conn()
+        with app.app_context():
+            assert get_db_conn() is conn
+            stats = get_pool().get_stats()
+        assert stats['connects'] == 1 and stats['checkouts'] == 3 and stats['in_use'] == 1
+
+    def test_rollback_on_return(self, app):
+        with app.app_context():
+            with get_db_conn().cursor() as cur:
+                cur.execute("INSERT INTO node (name, lft, rgt) VALUES ('uncommitted', 0, 1)")
+        with app.app_context():
+            with get_db_conn().cursor() as cur:
+                cur.execute("SELECT count(*) FROM node WHERE name = 'uncommitted'")
+                assert cur.fetchone()[0] == 0
+
+    def test_discard_broken_connection(self, app):
+        with app.app_context():
+            conn = get_db_conn()
+            conn.close()
+        with app.app_context():
+            assert get_db_conn() is not conn
+            assert get_pool().get_stats()['discarded'] == 1
+
+    @pytest.mark.parametrize('app', [{'POSTGRES_POOL_SIZE': 1, 'POSTGRES_POOL_TIMEOUT': 0.01}], indirect=True)
+    def test_checkout_timeout(self, app):
+        with app.app_context():
+            get_db_conn()
+            with pytest.raises(RuntimeError):
+                get_pool().getconn()
+            assert get_pool().get_stats()['checkout_timeouts'] == 1
+
+
+class TestAtomic:
+    def test_retry_conflict(self, app, monkeypatch):
+        monkeypatch.setattr('app.db.RETRY_DELAY', 0)
+        calls = []
+
+        @atomic
+        def write():
+            calls.append(None)
+            Node.create(f'node {len(calls)}', Node.get_root_node())
+            if len(calls) < 3:
+                raise TransactionConflict()
+
+        with app.app_context():
+            write()
+            # changes of failed attempts are rolled back
+            assert [item['name'] for item in Node.get_hierarchy()] == ['node 3']
+
+    @pytest.mark.parametrize('app', [{'TRANSACTION_RETRIES': 2}], indirect=True)
+    def test_give_up(self, app, monkeypatch):
+        monkeypatch.setattr('app.db.RETRY_DELAY', 0)
+        calls = []
+
+        @atomic
+        def write():
+            calls.append(None)
+            raise TransactionConflict()
+
+        with app.app_context():
+            with pytest.raises(TransactionConflict):
+                write()
+        assert len(calls) == 3
+
+
+def test_pool_metrics(client):
+    data = client.get('/metrics/pool').get_json()
+    assert data['size'] == 10 and data['checkouts'] >= 1
+
+
+def test_import_tree_command(app, tmp_path, monkeypatch):
+    path = tmp_path / 'tree.json'
+    path.write_text('[{"name": "a", "children": [{"name": "b"}]}]')
+    result = app.test_cli_runner().invoke(args=['import-tree', str(path)])
+    assert 'Imported 2 items' in result.output
+    with app.app_context():
+        assert [tree['name'] for tree in Node.get_hierarchy()] == ['a']
+
+    path.write_text('{"name": "c", "parent": "x"}')
+    result = app.test_cli_runner().invoke(args=['import-tree', '--ndjson', '--parent-id', '2', str(path)])
+    assert result.exit_code != 0 and 'Row 0: Invalid "parent"' in result.output
+
+    path.write_text('[{"name": "a"')
+    result = app.test_cli_runner().invoke(args=['import-tree', str(path)])
+    assert result.exit_code == 1 and result.output.startswith('Error: Expecting')
+
+    path.write_bytes(b'{"name": "\xff"}')
+    result = app.test_cli_runner().invoke(args=['import-tree', '--ndjson', str(path)])
+    assert result.exit_code == 1 and 'codec can\'t decode' in result.output
+
+    # the parent is deleted after it is found
+    monkeypatch.setattr(Node, 'get_by_id', lambda id: Node(100, 'deleted', 1, 1, 2, 100))
+    path.write_text('[{"name": "d"}]')
+    result = app.test_cli_runner().invoke(args=['import-tree', '--parent-id', '100', str(path)])
+    assert result.exit_code == 1 and 'Error: Parent node does not exist' in result.output
+
+
+@pytest.mark.parametrize('app', [{'STORAGE_ENGINE': 'adjacency_list'}], indirect=True)
+def test_renumber_trees_command(app, client, example_hierarchy):
+    client.post('/item', json={'name': 'new item', 'parent_id': 3})
+    client.post('/item/2', json={'parent_id': 6})
+    client.post('/item/4', json={'parent_id': None})
+    hierarchy = client.get('/hierarchy').get_json()
+
+    result = app.test_cli_runner().invoke(args=['renumber-trees'])
+    assert 'Renumbered 3 trees of 7 items' in result.output
+    app.config['STORAGE_ENGINE'] = 'nested_set'
+    with app.app_context():
+        assert_nested_sets()
+        assert Node.get_hierarchy() == hierarchy
+
+
+@pytest.mark.parametrize('app', [{'DEFERRED_DELETE': True}], indirect=True)
+def test_compact_command(app, client, example_hierarchy):
+    client.delete('/item/3')
+    client.delete('/item/6')
+    hierarchy = client.get('/hierarchy').get_json()
+
+    result = app.test_cli_runner().invoke(args=['compact'])
+    assert 'Compacted 2 trees of 3 items, 4 positions freed' in result.output
+    with app.app_context():
+        assert_nested_sets()
+        assert Node.get_hierarchy() == hierarchy
+
+
+def test_partition_nodes_command(app, client, example_hierarchy):
+    result = app.test_cli_runner().invoke(args=['partition-nodes', '--partitions', '4'])
+    assert 'Copied 3 of 3 trees' in result.output
+    assert 'Partitioned 3 trees into 4 partitions' in result.output
+    assert client.get('/hierarchy').get_json() == example_hierarchy
+
+    result = app.test_cli_runner().invoke(args=['partition-nodes', '--partitions', '0'])
+    assert result.exit_code != 0
+
+
+class TestReplicaRouting:
+    def checkouts(self, app):
+        with app.app_context():
+            return get_pool().get_stats()['checkouts'], get_replica_pools()[0].get_stats()['checkouts']
+
+    @pytest.mark.parametrize('app', [{'POSTGRES_REPLICA_HOSTS': ['postgres']}], indirect=True)
+    def test_reads_go_to_replica(self, app, client, example_hierarchy):
+        primary, replica = self.checkouts(app)
+        assert client.get('/item/2').status_code == 200
+        assert client.get('/subtree/2').status_code == 200
+        assert self.checkouts(app) == (primary, replica + 2)
+
+        response = client.post('/item', json={'name': 'new item', 'parent_id': 2})
+        assert self.checkouts(app) == (primary + 1, replica + 2)
+        lsn = response.headers['X-LSN']
+        assert client.get_cookie('lsn').value == lsn
+
+        # the replica has replayed the write
+        assert client.get('/subtree/2', headers={'X-LSN': lsn}).status_code == 200
+        assert self.checkouts(app) == (primary + 1, replica + 3)
+
+    @pytest.mark.parametrize(
+        'app', [{'POSTGRES_REPLICA_HOSTS': ['postgres'], 'REPLICA_MAX_WAIT': 0.01}], indirect=True
+    )
+    def test_lagging_replica(self, app, client, example_hierarchy):
+        primary, replica = self.checkouts(app)
+        client.set_cookie('lsn', 'FFFFFFFF/0')
+        assert client.get('/item/2').status_code == 200
+        assert self.checkouts(app) == (primary + 1, replica + 1)
+
+    @pytest.mark.parametrize('app', [{'POSTGRES_REPLICA_HOSTS': ['127.0.0.1:1']}], indirect=True)
+    def test_unavailable_replica(self, app, client, example_hierarchy):
+        assert client.get('/item/2').status_code == 200
+        with app.app_context():
+            assert get_replica_pools()[0].get_stats()['connects'] == 0
@@ -0,0 +1,63 @@
+import re
+
+import pytest
+
+from tests.test_data import example_hierarchy
+
+
+def get_metric(client, name, **labels):
+    text = client.get('/metrics').get_data(as_text=True)
+    label_str = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    series = f'{name}{{{label_str}}}' if labels else name
+    match = re.search(rf'^{re.escape(series)} (\S+)$', text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+
+def test_request_metrics(client, example_hierarchy):
+    client.post('/item', json={'name': 'new item', 'parent_id': 2})
+    client.post('/item/3', json={'parent_id': 5})
+
+    item = {'endpoint': 'api.item', 'method': 'POST'}
+    assert get_metric(client, 'http_requests_total', **item, status=201) == 1
+    assert get_metric(client, 'db_queries_total', **item) > 1
+    # the new row and shifted bounds
+    assert get_metric(client, 'db_rows_affected_total', **item) > 1
+    assert get_metric(client, 'http_request_duration_seconds_count', **item) == 1
+
+    move = {'endpoint': 'api.item_by_id', 'method': 'POST'}
+    assert get_metric(client, 'http_request_queries_count', **move) == 1
+    assert get_metric(client, 'http_request_db_seconds_sum', **move) > 0
+    assert get_metric(client, 'http_request_serialization_seconds_sum', **move) > 0
+
+
+def test_pool_and_cache_gauges(client, example_hierarchy):
+    client.get('/subtree/2')
+    client.get('/subtree/2')
+    assert get_metric(client, 'subtree_cache_hits') == 1
+    assert get_metric(client, 'db_pool_size') == 10
+
+
+@pytest.mark.parametrize('app', [{'DEFERRED_DELETE': True}], indirect=True)
+def test_tree_gap_gauges(client, example_hierarchy):
+    assert get_metric(client, 'tree_gap_positions') == 0
+    client.delete('/item/3')
+    assert get_metric(client, 'tree_gap_trees') == 1
+    assert get_metric(client, 'tree_gap_positions') == 2
+
+
+@pytest.mark.parametrize('app', [{'SLOW_REQUEST_SECONDS': 1e-9}], indirect=True)
+def test_slow_request_log(client, caplog, example_hierarchy):
+    client.post('/item', json={'name': 'new item', 'parent_id': 2})
+    message = next(record.getMessage() for record in caplog.records if 'Slow request' in record.getMessage())
+    assert message.startswith('Slow request POST /item')
+    assert "INSERT INTO node (name, parent_id, lft, rgt, tree_id) VALUES ('new item', 2" in message
+
+
+@pytest.mark.parametrize('app', [{'STREAM_SUBTREES': True}], indirect=True)
+def test_streamed_request(client, example_hierarchy):
+    with client.get('/subtree/2') as response:
+        response.get_data()
+    subtree = {'endpoint': 'api.subtree', 'method': 'GET'}
+    assert get_metric(client, 'http_requests_total', **subtree, status=200) == 1
+    # the version and the server-side cursor
+    assert get_metric(client, 'db_queries_total', **subtree) >= 2
@@ -1,14 +1,23 @@
+import json
+import random
+
 import pytest
 
 from app.db import get_db_conn
-from app.models import Node
+from app.models import Node, BulkError
+from benchmarks import load_rows
+from benchmarks.generators import balanced_tree
+
+from tests.test_data import example_hierarchy, assert_nested_sets
 
-from tests.test_data import example_hierarchy
+
+SPARSE = {'NESTED_SET_GAP': 8}
+DEFERRED = {'DEFERRED_DELETE': True}
 
 
 def test_get_root_node(app):
-    expected_root_node = Node(id=1, name='root', parent_id=None, lft=0, rgt=1)
     with app.app_context():
+        expected_root_node = Node.get_engine()(id=1, name='root', parent_id=None, lft=0, rgt=1)
         root_node = Node.get_root_node()
     
     assert root_node == expected_root_node
@@ -28,6 +37,61 @@ def test_delete_node(app, example_hierarchy):
     assert hierarchy == example_hierarchy
 
 
+def test_stream_subtree(app, monkeypatch):
+    monkeypatch.setattr('app.models.STREAM_CHUNK_ITEMS', 3)
+    random.seed(0)
+    with app.app_context():
+        nodes = [Node.get_root_node()]
+        for i in range(50):
+            nodes.append(Node.create(f'node {i}', Node.get_by_id(random.choice(nodes).id)))
+        for node in nodes[:10]:
+            node = Node.get_by_id(node.id)
+            subtree = node.get_subtree()
+            assert json.loads(''.join(node.stream_subtree())) == subtree
+            assert json.loads(''.join(node.stream_subtree(children_only=True))) == subtree['children']
+
+
+def prune(subtree, max_depth):
+    """Subtree without nodes deeper than max_depth below its root."""
+    children = [] if max_depth == 0 else [prune(child, max_depth - 1) for child in subtree['children']]
+    return {**subtree, 'children': children}
+
+
+def flatten(subtree, depth=0):
+    item = {key: value for key, value in subtree.items() if key != 'children'}
+    return [{**item, 'depth': depth}] + [
+        child_item for child in subtree['children'] for child_item in flatten(child, depth + 1)
+    ]
+
+
+@pytest.mark.parametrize('app', [{}, SPARSE], indirect=True)
+def test_subtree_depth_and_pages(app, monkeypatch):
+    monkeypatch.setattr('app.models.STREAM_CHUNK_ITEMS', 3)
+    random.seed(0)
+    with app.app_context():
+        nodes = [Node.get_root_node()]
+        for i in range(50):
+            nodes.append(Node.create(f'node {i}', Node.get_by_id(random.choice(nodes).id)))
+        for node in nodes[:10]:
+            node = Node.get_by_id(node.id)
+            subtree = node.get_subtree()
+            for max_depth in (0, 1, 3):
+                pruned = prune(subtree, max_depth + node.is_root)
+                assert node.get_subtree(max_depth) == pruned
+                assert json.loads(''.join(node.stream_subtree(max_depth=max_depth))) == pruned
+
+                items, state = [], None
+                while True:
+                    page, state = node.get_subtree_page(4, state, max_depth)
+                    items += page
+                    if state is None:
+                        break
+                    assert len(page) == 4
+                expected = [item for child in pruned['children'] for item in flatten(child)] \
+                    if node.is_root else flatten(pruned)
+                assert items == expected
+
+
 class TestNameValidation:
     @pytest.mark.parametrize(
         'name', ['Simple', 'немного harder', '234 234 444 ', 'path/to/something', 'try_underscores__']
@@ -48,8 +112,9 @@ class TestNameValidation:
 
 
 class TestCreateNode:
+    @pytest.mark.nested_set
     def test_create_node(self, app):
-        expected_root_node = Node(id=1, name='root', parent_id=None, lft=0, rgt=3)
+        expected_root_node = Node(id=1, name='root', parent_id=None, lft=0, rgt=1)
         expected_new_node = Node(id=2, name='new node', parent_id=1, lft=1, rgt=2, tree_id=2)
         with app.app_context():
             new_node = Node.create(expected_new_node.name, Node.get_by_id(expected_new_node.parent_id))
@@ -72,6 +137,173 @@ class TestCreateNode:
             except ValueError:
                 pytest.fail()
 
+    @pytest.mark.nested_set
+    def test_other_trees_untouched(self, app, example_hierarchy):
+        with app.app_context():
+            other_trees = [Node.get_by_id(id) for id in (5, 6, 7)]
+            Node.create('new node', Node.get_by_id(3))
+            assert [Node.get_by_id(id) for id in (5, 6, 7)] == other_trees
+            assert Node.get_by_id(2) == Node(id=2, name='level1-1', parent_id=1, lft=1, rgt=8, tree_id=2)
+
+
+class TestBulkCreate:
+    rows = [('a', None), ('a1', 0), ('a1x', 1), ('a2', 0), ('b', None)]
+
+    @pytest.mark.nested_set
+    def test_create_trees(self, app):
+        with app.app_context():
+            ids = Node.bulk_create(self.rows, Node.get_root_node())
+            assert_nested_sets()
+            assert Node.get_by_id(ids[2]) == Node(id=ids[2], name='a1x', parent_id=ids[1], lft=3, rgt=4, tree_id=ids[0])
+            hierarchy = Node.get_hierarchy()
+        assert [tree['name'] for tree in hierarchy] == ['a', 'b']
+        assert [child['name'] for child in hierarchy[0]['children']] == ['a1', 'a2']
+
+    @pytest.mark.parametrize('app', [{}, SPARSE], indirect=True)
+    def test_create_under_node(self, app, example_hierarchy):
+        with app.app_context():
+            ids = Node.bulk_create(self.rows, Node.get_by_id(3))
+            assert_nested_sets(dense=not app.config.get('NESTED_SET_GAP'))
+            subtree = Node.get_by_id(3).get_subtree()
+        assert [child['id'] for child in subtree['children']] == [ids[0], ids[4]]
+        assert subtree['children'][0]['children'][0]['children'][0]['name'] == 'a1x'
+
+    def test_invalid_rows(self, app, example_hierarchy):
+        rows = [('existing', None), ('', 0), ('x', 0), ('x', 0)]
+        with app.app_context():
+            Node.create('existing', Node.get_by_id(5))
+            with pytest.raises(BulkError) as e:
+                Node.bulk_create(rows, Node.get_by_id(6))
+            assert [error['row'] for error in e.value.errors] == [0, 1, 3]
+            assert Node.get_by_id(9) is None
+
+    def test_names_unique_per_tree(self, app):
+        with app.app_context():
+            with pytest.raises(BulkError):
+                Node.bulk_create([('a', None), ('a', 0)], Node.get_root_node())
+            Node.bulk_create([('a', None), ('b', 0), ('b', None), ('a', 2)], Node.get_root_node())
+
+
+def shape(subtree, suffix=''):
+    return (subtree['name'][:len(subtree['name']) - len(suffix)], [shape(child, suffix) for child in subtree['children']])
+
+
+@pytest.mark.parametrize('app', [{}, SPARSE], indirect=True)
+class TestCopy:
+    def test_copy_to_other_tree(self, app, example_hierarchy):
+        with app.app_context():
+            copy = Node.get_by_id(2).copy(Node.get_by_id(6))
+            assert_nested_sets(dense=not app.config.get('NESTED_SET_GAP'))
+            assert copy.parent_id == 6 and copy.tree_id == 5 and copy.name == 'level1-1'
+            assert shape(copy.get_subtree()) == shape(example_hierarchy[0])
+            # the source is intact
+            assert Node.get_by_id(2).get_subtree() == example_hierarchy[0]
+
+    def test_copy_to_new_tree(self, app, example_hierarchy):
+        with app.app_context():
+            copy = Node.get_by_id(2).copy(Node.get_root_node())
+            assert_nested_sets(dense=not app.config.get('NESTED_SET_GAP'))
+            assert copy.tree_id == copy.id and copy.lft == 1
+            assert shape(copy.get_subtree()) == shape(example_hierarchy[0])
+
+    def test_name_conflicts(self, app, example_hierarchy):
+        with app.app_context():
+            with pytest.raises(ValueError):
+                Node.get_by_id(3).copy(Node.get_by_id(4))
+            with pytest.raises(ValueError):
+                Node.get_by_id(3).copy(Node.get_by_id(4), on_conflict='skip')
+            assert Node.get_by_id(3).copy(Node.get_by_id(4), on_conflict='rename').name == 'level2-1 copy'
+            assert Node.get_by_id(3).copy(Node.get_by_id(4), on_conflict='rename').name == 'level2-1 copy 2'
+            assert_nested_sets(dense=not app.config.get('NESTED_SET_GAP'))
+
+    def test_copy_under_itself(self, app, example_hierarchy):
+        with app.app_context():
+            for _ in range(3):
+                copy = Node.get_by_id(2).copy(Node.get_by_id(3), on_conflict='rename')
+                assert_nested_sets(dense=not app.config.get('NESTED_SET_GAP'))
+            assert copy.name == 'level1-1 copy 3'
+            subtree = Node.get_by_id(2).get_subtree()
+        # every copy is taken from the subtree with the previous copies in it
+        assert [child['name'] for child in subtree['children'][0]['children']] == [
+            'level1-1 copy', 'level1-1 copy 2', 'level1-1 copy 3'
+        ]
+
+
+@pytest.mark.parametrize('app', [{}, SPARSE], indirect=True)
+class TestSearch:
+    @pytest.fixture
+    def names(self, app, example_hierarchy):
+        with app.app_context():
+            parent = Node.get_by_id(3)
+            for name in ['Ёлка', 'ёЖИК', 'Ель 50_50', 'Ель 50x50', 'back\\slash']:
+                Node.create(name, parent)
+
+    def search(self, query, limit=10, **kwargs):
+        return [(node.name, [ancestor.id for ancestor in path]) for node, path in Node.search(query, limit, **kwargs)]
+
+    def test_substring(self, app, names):
+        with app.app_context():
+            assert self.search('LEVEL2') == [('level2-1', [2]), ('level2-2', [2]), ('level2-3', [5])]
+            assert self.search('ЕЛЬ 5') == [('Ель 50_50', [2, 3]), ('Ель 50x50', [2, 3])]
+            # LIKE wildcards are matched literally
+            assert self.search('0_5') == [('Ель 50_50', [2, 3])]
+            assert self.search('k\\s') == [('back\\slash', [2, 3])]
+            assert self.search('лк') == [('Ёлка', [2, 3])]
+            assert self.search('level', tree_id=5) == [('level1-2', []), ('level2-3', [5])]
+            assert self.search('root') == []
+
+    def test_prefix(self, app, names):
+        with app.app_context():
+            assert self.search('ё', prefix=True) == [('ёЖИК', [2, 3]), ('Ёлка', [2, 3])]
+            assert self.search('ЕЛЬ 50', prefix=True) == [('Ель 50_50', [2, 3]), ('Ель 50x50', [2, 3])]
+            assert self.search('vel', prefix=True) == []
+
+    def test_pages(self, app, names):
+        with app.app_context():
+            nodes = [node for node, _ in Node.search('level', 2)]
+            assert [node.name for node in nodes] == ['level1-1', 'level1-2']
+            after = (Node.get_search_key(nodes[-1].name), nodes[-1].id)
+            assert [node.name for node, _ in Node.search('level', 10, after=after)] == [
+                'level1-3', 'level2-1', 'level2-2', 'level2-3'
+            ]
+
+    def test_prefix_index(self, app, names):
+        with app.app_context():
+            with get_db_conn().cursor() as cur:
+                cur.execute('SET LOCAL enable_seqscan = off')
+                for tree_id, index in [(None, 'node_name_key_idx'), (2, 'node_tree_name_key_idx')]:
+                    cur.execute(
+                        'EXPLAIN SELECT * FROM node WHERE name_search_key(name) COLLATE "C" LIKE %s '
+                        'AND (tree_id = %s OR %s IS NULL) ORDER BY name_search_key(name) COLLATE "C", id LIMIT 10',
+                        ('lev%', tree_id, tree_id)
+                    )
+                    assert index in json.dumps(cur.fetchall())
+
+
+class TestNavigation:
+    def test_depth_and_descendant_count(self, app, example_hierarchy):
+        with app.app_context():
+            items = Node.to_items(Node.get_by_ids([2, 3, 5, 6, 7]))
+        assert [(item['depth'], item['descendant_count']) for item in items] == [
+            (0, 2), (1, 0), (0, 1), (1, 0), (0, 0)
+        ]
+
+    def test_path(self, app, example_hierarchy):
+        with app.app_context():
+            level3 = Node.create('level3', Node.get_by_id(6))
+            node = Node.create('level4', level3)
+            path = Node.get_by_id(node.id).get_path()
+            assert [node.name for node in path] == ['level1-2', 'level2-3', 'level3', 'level4']
+            assert Node.get_by_id(node.id).to_item()['depth'] == 3
+            assert Node.get_by_id(5).to_item()['descendant_count'] == 3
+
+    def test_children(self, app, example_hierarchy):
+        with app.app_context():
+            node = Node.get_by_id(2)
+            first_page = node.get_children(1)
+            assert [child.id for child in first_page] == [3]
+            assert [child.id for child in node.get_children(10, first_page[-1].lft)] == [4]
+
 
 class TestMove:
     def test_move_rigth(self, app, example_hierarchy):
@@ -94,6 +326,43 @@ class TestMove:
         
         assert hierarchy == example_hierarchy
 
+    @pytest.mark.parametrize('node_id, parent_id', [(2 + 4, 2 + 3), (2 + 12, 2 + 1)])
+    def test_move_rewrites_only_shifted_rows(self, app, node_id, parent_id):
+        def get_rows():
+            with get_db_conn().cursor() as cur:
+                cur.execute('SELECT id, lft, rgt, xmin::text FROM node WHERE tree_id IS NOT NULL')
+                return {id: (lft, rgt, xmin) for id, lft, rgt, xmin in cur.fetchall()}
+
+        with app.app_context():
+            load_rows(balanced_tree(200, fanout=3))
+            before = get_rows()
+            Node.get_by_id(node_id).move(Node.get_by_id(parent_id))
+            after = get_rows()
+            assert_nested_sets()
+
+        shifted = {id for id in before if before[id][:2] != after[id][:2]}
+        rewritten = {id for id in before if before[id][2] != after[id][2]}
+        assert node_id in shifted and rewritten == shifted
+
+    @pytest.mark.nested_set
+    def test_move_to_root(self, app, example_hierarchy):
+        subtree = example_hierarchy[1]['children'].pop(0)
+        subtree['parent_id'] = None
+        example_hierarchy.insert(2, subtree)
+        with app.app_context():
+            node = Node.get_by_id(6).move(Node.get_root_node())
+            assert node == Node.get_by_id(6) == Node(id=6, name='level2-3', parent_id=1, lft=1, rgt=2, tree_id=6)
+            hierarchy = Node.get_hierarchy()
+
+        assert hierarchy == example_hierarchy
+
+    @pytest.mark.nested_set
+    def test_move_within_tree(self, app, example_hierarchy):
+        with app.app_context():
+            node = Node.get_by_id(3).move(Node.get_by_id(4))
+            assert node == Node.get_by_id(3) == Node(id=3, name='level2-1', parent_id=4, lft=3, rgt=4, tree_id=2)
+            assert Node.get_by_id(4) == Node(id=4, name='level2-2', parent_id=2, lft=2, rgt=5, tree_id=2)
+
     def test_move_under_itself(self, app, example_hierarchy):
         with app.app_context():
             with pytest.raises(ValueError):
@@ -114,4 +383,135 @@ class TestMove:
                 node3.move(node7)
 
 
-        
\ No newline at end of file
+@pytest.mark.parametrize('app', [SPARSE], indirect=True)
+class TestSparseNumbering:
+    def test_create_node(self, app):
+        with app.app_context():
+            tree = Node.create('tree', Node.get_root_node())
+            child = Node.create('child', tree)
+            assert tree == Node.get_by_id(tree.id) == Node(id=2, name='tree', parent_id=1, lft=1, rgt=9, tree_id=2)
+            assert child == Node.get_by_id(child.id) == Node(id=3, name='child', parent_id=2, lft=2, rgt=5, tree_id=2)
+
+    def test_create_does_not_shift(self, app):
+        with app.app_context():
+            tree = Node.create('tree', Node.get_root_node())
+            child = Node.create('child', tree)
+            Node.create('grandchild', child)
+            assert Node.get_by_id(tree.id) == tree and Node.get_by_id(child.id) == child
+
+    def test_renumbering(self, app):
+        random.seed(0)
+        with app.app_context():
+            nodes = [Node.create('tree', Node.get_root_node())]
+            for i in range(300):
+                parent = Node.get_by_id(random.choice(nodes).id)
+                nodes.append(Node.create(f'node {i}', parent))
+                assert_nested_sets(dense=False)
+            assert len(Node.get_by_id(nodes[0].id)._get_subtree_rows()) == len(nodes) - 1
+
+    def test_delete_node(self, app, example_hierarchy):
+        del example_hierarchy[0]['children'][0]
+        with app.app_context():
+            Node.get_by_id(3).delete()
+            assert Node.get_by_id(4) == Node(id=4, name='level2-2', parent_id=2, lft=4, rgt=5, tree_id=2)
+            assert Node.get_hierarchy() == example_hierarchy
+
+    def test_move_rigth(self, app, example_hierarchy):
+        item = example_hierarchy[0]['children'].pop(0)
+        item['parent_id'] = 7
+        example_hierarchy[2]['children'].append(item)
+        with app.app_context():
+            node = Node.get_by_id(3).move(Node.get_by_id(7))
+            assert node == Node.get_by_id(3)
+            assert_nested_sets(dense=False)
+            assert Node.get_hierarchy() == example_hierarchy
+
+    def test_move_subtree(self, app, example_hierarchy):
+        subtree = example_hierarchy.pop(1)
+        subtree['parent_id'] = 2
+        example_hierarchy[0]['children'].append(subtree)
+        with app.app_context():
+            Node.get_by_id(5).move(Node.get_by_id(2))
+            assert_nested_sets(dense=False)
+            assert Node.get_hierarchy() == example_hierarchy
+
+    def test_move_to_root(self, app, example_hierarchy):
+        subtree = example_hierarchy[0]['children'].pop(1)
+        subtree['parent_id'] = None
+        example_hierarchy.insert(1, subtree)
+        with app.app_context():
+            Node.get_by_id(4).move(Node.get_root_node())
+            assert_nested_sets(dense=False)
+            assert Node.get_hierarchy() == example_hierarchy
+
+
+@pytest.mark.parametrize('app', [DEFERRED], indirect=True)
+class TestDeferredDelete:
+    def test_delete_leaves_gap(self, app, example_hierarchy):
+        with app.app_context():
+            Node.get_by_id(3).delete()
+            # bounds of the rest of the tree stay
+            assert Node.get_by_id(4).lft == 4
+            assert Node.get_gap_stats() == {'trees': 1, 'positions': 2}
+            assert Node.get_by_id(2).to_item()['descendant_count'] == 1
+            assert_nested_sets(dense=False)
+
+            Node.create('new item', Node.get_by_id(2))
+            assert Node.get_by_id(2).to_item()['descendant_count'] == 2
+            hierarchy = Node.get_hierarchy()
+
+            assert Node.renumber_tree(2) == 3
+            assert Node.get_gap_stats() == {'trees': 0, 'positions': 0}
+            assert_nested_sets()
+            assert Node.get_hierarchy() == hierarchy
+
+    def test_move_carries_gap(self, app, example_hierarchy):
+        with app.app_context():
+            node = Node.create('new item', Node.get_by_id(3))
+            Node.create('other item', Node.get_by_id(3))
+            node.delete()
+
+            Node.get_by_id(3).move(Node.get_by_id(5))
+            assert Node.get_gap_stats() == {'trees': 1, 'positions': 2}
+            assert Node.get_by_id(2).to_item()['descendant_count'] == 1
+            assert Node.get_by_id(5).to_item()['descendant_count'] == 3
+            assert_nested_sets(dense=False)
+
+            # the gap is gone with its tree
+            Node.get_by_id(5).delete()
+            assert Node.get_gap_stats() == {'trees': 0, 'positions': 0}
+            assert_nested_sets()
+
+
+@pytest.mark.parametrize('app', [{'STORAGE_ENGINE': 'adjacency_list'}], indirect=True)
+class TestAdjacencyList:
+    def rows(self):
+        with get_db_conn().cursor() as cur:
+            cur.execute('SELECT id, parent_id, lft, rgt, tree_id FROM node')
+            return {res[0]: tuple(res) for res in cur.fetchall()}
+
+    def changed(self, before):
+        after = self.rows()
+        return {id for id in before.keys() | after.keys() if before.get(id) != after.get(id)}
+
+    def test_writes_touch_only_their_rows(self, app, example_hierarchy):
+        with app.app_context():
+            before = self.rows()
+            node = Node.create('new item', Node.get_by_id(3))
+            assert self.changed(before) == {node.id}
+
+            before = self.rows()
+            Node.get_by_id(3).move(Node.get_by_id(7))
+            # the moved subtree changes its tree, nothing else is renumbered
+            assert self.changed(before) == {3, node.id}
+
+            before = self.rows()
+            Node.get_by_id(2).delete()
+            assert self.changed(before) == {2, 4}
+
+    def test_sibling_order(self, app, example_hierarchy):
+        with app.app_context():
+            Node.get_by_id(3).move(Node.get_by_id(2))
+            Node.create('new item', Node.get_by_id(2))
+            children = Node.get_by_id(2).get_children(10)
+        assert [child.name for child in children] == ['level2-2', 'level2-1', 'new item']
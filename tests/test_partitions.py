@@ -0,0 +1,53 @@
+import pytest
+
+from app.partitions import partition_nodes, get_partition_count
+from tests.test_data import example_hierarchy, assert_nested_sets
+
+
+def test_partition_nodes(app, client, example_hierarchy):
+    with app.app_context():
+        assert get_partition_count() == 0
+        assert partition_nodes(4) == 3
+        assert get_partition_count() == 4
+        assert_nested_sets()
+    assert client.get('/hierarchy').json == example_hierarchy
+
+    response = client.post('/item', json={'name': 'new item', 'parent_id': 3})
+    assert response.headers['Location'].endswith('/item/8')
+    # to another tree and so to another partition
+    assert client.post('/item/2', json={'parent_id': 6}).status_code == 200
+    assert client.post('/item', json={'name': 'level2-3', 'parent_id': 4}).status_code == 400
+    assert client.get('/item/2').json['depth'] == 2
+    with app.app_context():
+        assert_nested_sets()
+
+
+def test_writes_during_partitioning(app, client, example_hierarchy):
+    hierarchies = []
+
+    def progress(done, total):
+        # writes to copied trees, trees still to be copied and new trees go on meanwhile
+        if done == 1:
+            client.post('/item', json={'name': 'new item', 'parent_id': 3})
+            client.post('/item', json={'name': 'other item', 'parent_id': 6})
+            client.post('/item/6', json={'parent_id': 3})
+            client.post('/item', json={'name': 'new tree', 'parent_id': None})
+            client.post('/item/5', json={'name': 'renamed'})
+            client.delete('/item/7')
+        if done == total:
+            hierarchies.append(client.get('/hierarchy').json)
+
+    with app.app_context():
+        assert partition_nodes(4, progress) == 3
+        assert_nested_sets()
+    assert client.get('/hierarchy').json == hierarchies[0]
+    assert [item['name'] for item in hierarchies[0]] == ['level1-1', 'renamed', 'new tree']
+
+
+@pytest.mark.parametrize('app', [{'NODE_PARTITIONS': 4}], indirect=True)
+def test_repartition(app, client, example_hierarchy):
+    with app.app_context():
+        assert get_partition_count() == 4
+        partition_nodes(2)
+        assert get_partition_count() == 2
+    assert client.get('/hierarchy').json == example_hierarchy
@@ -0,0 +1,69 @@
+import re
+
+import pytest
+
+from app.models import Node
+from benchmarks import load_rows
+from benchmarks.generators import balanced_tree
+
+from tests.test_models import SPARSE
+
+
+TREES = 20
+TREE_SIZE = 1000
+
+PARTITIONED = {'NODE_PARTITIONS': 4}
+
+# lookups by id alone, which have to probe every partition
+BY_ID = re.compile(r'SELECT \* FROM node WHERE id ?(=|= ANY)')
+
+
+@pytest.fixture
+def large_hierarchy(app):
+    with app.app_context():
+        for i in range(TREES):
+            load_rows(balanced_tree(TREE_SIZE, gap=app.config.get('NESTED_SET_GAP', 0), first_id=2 + i * TREE_SIZE))
+
+
+def run_operations():
+    node = Node.get_by_id(2 + TREE_SIZE + 1)
+    node.get_version()
+    node.to_item()
+    node.get_path()
+    node.get_children(10, node.lft + 1)
+    node.get_subtree()
+    ''.join(node.stream_subtree())
+    node.get_subtree_page(10, node.get_subtree_page(10)[1])
+    Node.get_root_node().get_subtree_page(10, (2 + TREE_SIZE, 5, []))
+    new_node = Node.create('new node', node)
+    new_node.rename('renamed node')
+    Node.create('new tree', Node.get_root_node())
+    # within the tree, to another tree and to the root
+    Node.get_by_id(2 + TREE_SIZE + 5).move(Node.get_by_id(2 + TREE_SIZE + 30))
+    Node.get_by_id(2 + TREE_SIZE + 6).move(Node.get_by_id(2 + 3 * TREE_SIZE + 30))
+    Node.get_by_id(2 + TREE_SIZE + 7).move(Node.get_root_node())
+    Node.get_by_id(2 + TREE_SIZE + 8).delete()
+
+
+@pytest.mark.parametrize('app', [{}, SPARSE, PARTITIONED], indirect=True)
+def test_no_seq_scans(app, large_hierarchy, record_queries):
+    with app.app_context():
+        with record_queries(explain=True) as queries:
+            run_operations()
+
+    assert len(queries) > 10
+    for query, plan in zip(queries, queries.plans):
+        assert 'Seq Scan on node' not in plan, f'{query}\n{plan}'
+
+
+@pytest.mark.parametrize('app', [PARTITIONED, {**PARTITIONED, **SPARSE}], indirect=True)
+def test_partition_pruning(app, large_hierarchy, record_queries):
+    with app.app_context():
+        with record_queries(explain=True) as queries:
+            run_operations()
+
+    for query, plan in zip(queries, queries.plans):
+        # pages of the whole hierarchy go through all trees
+        if BY_ID.match(query) or 'tree_id IS NOT NULL' in query:
+            continue
+        assert len(set(re.findall(r'node_p\d+', plan))) <= 1, f'{query}\n{plan}'
@@ -0,0 +1,152 @@
+import random
+
+import pytest
+
+from app.db import get_connect_params, get_db_conn
+from app.models import Node
+from app.replica import Replica, get_replica
+from tests.test_data import example_hierarchy
+
+
+pytestmark = pytest.mark.parametrize('app', [{'READ_REPLICA': True}], indirect=True)
+
+
+def read_all(node):
+    return (
+        Node.get_by_id(node.id),
+        Node.get_by_ids([6, 2, 100]),
+        node.get_path(),
+        node.get_children(1),
+        node.get_children(10, after=2),
+        Node.to_items([node, Node.get_by_id(3)]),
+        node.get_subtree(),
+        Node.get_root_node().get_subtree(max_depth=0),
+    )
+
+
+def test_reads_match_database(app, example_hierarchy):
+    with app.app_context():
+        replica = get_replica()
+        assert replica.wait()
+        node = Node.get_by_id(2)
+        from_replica = read_all(node)
+        assert replica.stats['fallbacks'] == 0
+
+        app.config['READ_REPLICA'] = False
+        assert read_all(node) == from_replica
+
+
+def test_reads_own_writes(app, client, example_hierarchy):
+    with app.app_context():
+        replica = get_replica()
+        assert replica.wait()
+
+    new_id = int(client.post('/item', json={'name': 'new item', 'parent_id': 3}).headers['Location'].rsplit('/', 1)[1])
+    client.post('/item/4', json={'name': 'renamed'})
+    response = client.get('/subtree/2')
+    assert [child['name'] for child in response.json['children']] == ['level2-1', 'renamed']
+    assert response.json['children'][0]['children'][0]['id'] == new_id
+
+    assert replica.wait()
+    hits = replica.stats['hits']
+    assert client.get(f'/item/{new_id}').json['depth'] == 2
+    assert client.get(f'/item/{new_id}/path').json['items'][0]['id'] == 2
+    assert replica.stats['hits'] > hits
+    # changed rows are spliced into the loaded trees
+    assert replica.stats['updates'] >= 1
+    assert replica.stats['reloads'] == 0
+
+
+def test_batch_sees_its_own_operations(app, client, example_hierarchy):
+    client.post('/item/5', json={'name': 'old name'})
+    with app.app_context():
+        assert get_replica().wait(Node.get_by_id(5).get_version())
+
+    response = client.post('/batch', json=[
+        {'op': 'rename', 'id': 5, 'name': 'new name'},
+        {'op': 'rename', 'id': 5, 'name': 'old name'},
+        {'op': 'move', 'id': 3, 'parent_id': 4},
+        {'op': 'rename', 'id': 4, 'name': 'parent'},
+        {'op': 'move', 'id': 3, 'parent_id': 2},
+    ])
+    assert response.status_code == 200
+    # items are read in the transaction, not from the replica
+    results = response.json['results']
+    assert (results[2]['parent_id'], results[2]['depth']) == (4, 2)
+    assert (results[3]['name'], results[3]['descendant_count']) == ('parent', 1)
+    assert (results[4]['parent_id'], results[4]['depth']) == (2, 1)
+    with app.app_context():
+        app.config['READ_REPLICA'] = False
+        assert Node.get_by_id(5).name == 'old name'
+        assert Node.get_by_id(3).parent_id == 2
+
+
+def test_other_workers_are_notified(app, example_hierarchy):
+    with app.app_context():
+        other = Replica(get_connect_params(app.config))
+        try:
+            assert other.wait()
+            node = Node.create('new item', Node.get_by_id(5))
+            Node.get_by_id(3).move(Node.get_by_id(6))
+            Node.get_by_id(7).delete()
+            assert other.wait(Node.get_root_node().get_version())
+            app.config['READ_REPLICA'] = False
+            assert other.get_row(node.id) == vars(Node.get_by_id(node.id))
+            assert other.get_row(3)['tree_id'] == 5
+            assert other.get_row(7) is None
+            assert [row['id'] for row in other.get_path_rows(Node.get_by_id(3))] == [5, 6, 3]
+        finally:
+            other.close()
+
+
+@pytest.mark.parametrize('settings', [{}, {'NESTED_SET_GAP': 4}, {'DEFERRED_DELETE': True}])
+def test_changes_are_applied_in_place(app, settings, example_hierarchy):
+    app.config.update(settings)
+    rng = random.Random(0)
+    with app.app_context():
+        other = Replica(get_connect_params(app.config))
+        try:
+            assert other.wait()
+            for i in range(100):
+                with get_db_conn().cursor() as cur:
+                    cur.execute('SELECT id FROM node WHERE tree_id IS NOT NULL ORDER BY id')
+                    ids = [res['id'] for res in cur.fetchall()]
+                node, parent_node = (Node.get_by_id(id, replica=False) for id in rng.sample(ids, 2))
+                op = rng.choice(['create', 'rename', 'move', 'delete', 'copy'])
+                try:
+                    if op == 'create':
+                        Node.create(f'item {i}', parent_node)
+                    elif op == 'rename':
+                        node.rename(f'renamed {i}')
+                    elif op == 'move':
+                        node.move(parent_node)
+                    elif op == 'delete' and node.id != node.tree_id:
+                        node.delete()
+                    elif op == 'copy':
+                        node.copy(parent_node, on_conflict='rename')
+                except ValueError:
+                    pass
+            assert other.wait(Node.get_root_node().get_version())
+
+            with get_db_conn().cursor() as cur:
+                cur.execute(
+                    'SELECT tree_id, id, parent_id, name, lft, rgt FROM node WHERE tree_id IS NOT NULL ORDER BY lft'
+                )
+                rows = {}
+                for res in cur.fetchall():
+                    rows.setdefault(res['tree_id'], []).append(tuple(res.values())[1:])
+            assert set(other._trees) == set(rows)
+            for tree_id, tree in other._trees.items():
+                assert list(zip(tree.ids, tree.parent_ids, tree.names, tree.lfts, tree.rgts)) == rows[tree_id]
+                assert [tree.position(id) for id in tree.ids] == list(range(len(tree)))
+            assert other.stats['updates'] > 0
+            assert other.stats['reloads'] == 0
+        finally:
+            other.close()
+
+
+def test_gauges(client, example_hierarchy):
+    client.get('/item/2')
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'replica_hits ' in text
+    assert 'replica_nodes ' in text